@@ -0,0 +1,6 @@
+'''Performance benchmarks of the ledger and the web application.
+
+Run them with:
+
+    python -m benchmarks.run --scales 10k,100k --output results.json
+'''
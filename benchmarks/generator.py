@@ -0,0 +1,74 @@
+'''Deterministic synthetic ledgers.'''
+from bisect import bisect_left
+from datetime import date, timedelta
+import random
+
+from ledger import Ledger
+
+
+def generate_accounts(count):
+    '''Return a list of (code, name, type) spread across account types.'''
+    accounts = []
+    for index in range(count):
+        type_index = index % len(Ledger.ACCOUNT_TYPES)
+        type = Ledger.ACCOUNT_TYPES[type_index]
+        code = '{}{:04d}'.format(type_index + 1, index)
+        accounts.append((code, '{} #{}'.format(type.title(), index), type))
+    return accounts
+
+
+def generate_transactions(accounts, item_count, start_date=date(2010, 1, 1),
+                          days=5 * 365, seed=0):
+    '''Iterate over balanced transactions with item_count items in total.
+
+    Transactions are dated in order within days from start_date, more of
+    them on weekdays and around month ends, and have two to five items.
+    '''
+    rng = random.Random(seed)
+    codes = [account[0] for account in accounts]
+
+    # Cumulative weights approximating the activity of a business over the
+    # calendar; transactions are spread over the days proportionally.
+    cumulative_weights = []
+    total_weight = 0.0
+    for offset in range(days):
+        day = start_date + timedelta(offset)
+        weight = 1.0 if day.weekday() < 5 else 0.2
+        if (day + timedelta(3)).month != day.month:
+            weight *= 3
+        total_weight += weight
+        cumulative_weights.append(total_weight)
+
+    transaction_count = 0
+    produced_items = 0
+    while produced_items < item_count:
+        offset = bisect_left(
+            cumulative_weights,
+            total_weight * produced_items / float(item_count)
+        )
+        size = min(rng.randint(2, 5), max(item_count - produced_items, 2))
+        items = []
+        balance = 0
+        for _ in range(size - 1):
+            amount = rng.randint(-500000, 500000) or 1
+            items.append((rng.choice(codes), amount))
+            balance += amount
+        items.append((rng.choice(codes), -balance))
+
+        transaction_count += 1
+        produced_items += size
+        yield (start_date + timedelta(offset),
+               'Transaction #{}'.format(transaction_count),
+               items)
+
+
+def populate(ledger, account_count, item_count, seed=0, batch_size=10000):
+    '''Fill a ledger with synthetic accounts and transactions.'''
+    accounts = generate_accounts(account_count)
+    for code, name, type in accounts:
+        ledger.create_account(code, name, type)
+    ledger.record_transactions(
+        generate_transactions(accounts, item_count, seed=seed),
+        batch_size=batch_size
+    )
+    return accounts
@@ -0,0 +1,299 @@
+'''Time the ledger and the web application on synthetic ledgers.
+
+The results are printed, or written to --output, as JSON so that runs on
+different commits can be compared.
+'''
+import argparse
+from datetime import date
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from benchmarks.generator import generate_transactions, populate
+from columnar import ColumnarLedger
+from fenwick import FenwickLedger
+from ledger import Ledger, Transaction
+
+SCALES = {'10k': 10 ** 4, '100k': 10 ** 5, '1M': 10 ** 6, '10M': 10 ** 7}
+
+BALANCE_SHEET_DATE = date(2012, 6, 30)
+INCOME_STATEMENT_START_DATE = date(2012, 1, 1)
+INCOME_STATEMENT_END_DATE = date(2012, 12, 31)
+
+
+def measure(function, repeat):
+    '''Return timing statistics of calling function repeat times.'''
+    timings = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        function()
+        timings.append(timeit.default_timer() - start)
+    timings.sort()
+    return {
+        'repeat': repeat,
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'max': timings[-1],
+    }
+
+
+def benchmark_reports(ledger, repeat):
+    results = {}
+    results['get_balance_sheet'] = measure(
+        lambda: ledger.get_balance_sheet(BALANCE_SHEET_DATE), repeat
+    )
+    results['get_income_statement'] = measure(
+        lambda: ledger.get_income_statement(INCOME_STATEMENT_START_DATE,
+                                            INCOME_STATEMENT_END_DATE),
+        repeat
+    )
+    results['get_income_statement_series'] = measure(
+        lambda: ledger.get_income_statement_series(
+            INCOME_STATEMENT_START_DATE, INCOME_STATEMENT_END_DATE, 'month'
+        ),
+        repeat
+    )
+    return results
+
+
+def benchmark_ledger(ledger, accounts, repeat):
+    results = benchmark_reports(ledger, repeat)
+    results['get_transactions'] = measure(
+        lambda: ledger.get_transactions(limit=1000), repeat
+    )
+
+    # Appended after the other benchmarks so they see the same data on every
+    # scale. The transactions are dated within the populated range.
+    transactions = list(generate_transactions(accounts, 3 * repeat,
+                                              seed=repeat))
+    results['record_transaction'] = measure(
+        lambda: ledger.record_transaction(*transactions.pop()),
+        len(transactions)
+    )
+    return results
+
+
+def benchmark_columnar(ledger, accounts, repeat):
+    start = timeit.default_timer()
+    columnar = ColumnarLedger(ledger)
+    load_time = timeit.default_timer() - start
+
+    results = benchmark_reports(columnar, repeat)
+    results['load'] = load_time
+    results['post_backdated'] = benchmark_backdated(columnar, accounts,
+                                                    repeat)
+    ledger.listeners.remove(columnar)
+    return results
+
+
+def benchmark_fenwick(ledger, accounts, repeat, path):
+    start = timeit.default_timer()
+    fenwick = FenwickLedger(ledger, path)
+    load_time = timeit.default_timer() - start
+
+    results = benchmark_reports(fenwick, repeat)
+    results['load'] = load_time
+    results['save'] = measure(fenwick.save, repeat)
+    ledger.listeners.remove(fenwick)
+    results['load_snapshot'] = measure(
+        lambda: FenwickLedger(ledger, path).ledger.listeners.pop(), repeat
+    )
+    results['post_backdated'] = benchmark_backdated(fenwick, accounts,
+                                                    repeat)
+    return results
+
+
+def benchmark_backdated(engine, accounts, repeat):
+    '''Time posting transactions dated at the start of the ledger.
+
+    They're posted straight to the engine, leaving the database intact.
+    '''
+    transactions = [
+        Transaction(*transaction)
+        for transaction in generate_transactions(accounts, 3 * repeat,
+                                                 days=1, seed=repeat)
+    ]
+    return measure(
+        lambda: engine.on_transaction_recorded(0, transactions.pop()),
+        len(transactions)
+    )
+
+
+def benchmark_routes(database_url, repeat):
+    import webapp
+
+    webapp.app.config['DATABASE_URL'] = database_url
+    # Measure the work done by the routes, not the report cache.
+    webapp.app.config['REPORT_CACHE_SIZE'] = 0
+    client = webapp.app.test_client()
+
+    urls = [
+        '/balance-sheets/{}.json'.format(BALANCE_SHEET_DATE),
+        '/balance-sheets/{}.html'.format(BALANCE_SHEET_DATE),
+        '/balance-sheets/series.json?from={}&to={}&step=month'.format(
+            INCOME_STATEMENT_START_DATE, INCOME_STATEMENT_END_DATE
+        ),
+        '/income-statements/{}-to-{}.json'.format(
+            INCOME_STATEMENT_START_DATE, INCOME_STATEMENT_END_DATE
+        ),
+        '/income-statements/{}-to-{}.html'.format(
+            INCOME_STATEMENT_START_DATE, INCOME_STATEMENT_END_DATE
+        ),
+        '/income-statements/series.json?from={}&to={}&step=month'.format(
+            INCOME_STATEMENT_START_DATE, INCOME_STATEMENT_END_DATE
+        ),
+        '/transactions?limit=1000',
+    ]
+
+    results = {}
+    for url in urls:
+        status_codes = set()
+
+        def get():
+            status_codes.add(client.get(url).status_code)
+
+        results[url] = measure(get, repeat)
+        results[url]['status_codes'] = sorted(status_codes)
+    return results
+
+
+def benchmark_serialization(database_url, accounts, repeat):
+    '''Time the first byte and the whole body of streamed JSON responses.'''
+    import webapp
+
+    webapp.app.config['DATABASE_URL'] = database_url
+    webapp.app.config['REPORT_CACHE_SIZE'] = 0
+    client = webapp.app.test_client()
+
+    urls = [
+        '/balance-sheets/series.json?from={}&to={}&step=day'.format(
+            INCOME_STATEMENT_START_DATE, INCOME_STATEMENT_END_DATE
+        ),
+        '/income-statements/series.json?from={}&to={}&step=week'.format(
+            INCOME_STATEMENT_START_DATE, INCOME_STATEMENT_END_DATE
+        ),
+        '/accounts/{}/ledger?limit=10000'.format(accounts[0][0]),
+        '/transactions?limit=10000',
+    ]
+
+    results = {}
+    for url in urls:
+        first_byte_times = []
+        times = []
+        sizes = []
+        for _ in range(repeat):
+            start = timeit.default_timer()
+            response = client.get(url, buffered=False)
+            chunks = iter(response.response)
+            size = len(next(chunks, ''))
+            first_byte_times.append(timeit.default_timer() - start)
+            for chunk in chunks:
+                size += len(chunk)
+            response.close()
+            times.append(timeit.default_timer() - start)
+            sizes.append(size)
+        first_byte_times.sort()
+        times.sort()
+        median = times[len(times) // 2]
+        results[url] = {
+            'repeat': repeat,
+            'first_byte': first_byte_times[len(first_byte_times) // 2],
+            'median': median,
+            'bytes': sizes[-1],
+            'bytes_per_second': sizes[-1] / median if median else None,
+        }
+    return results
+
+
+def benchmark_scale(directory, name, item_count, account_count, repeat,
+                    seed):
+    database_url = os.path.join(directory, '{}.sqlite3'.format(name))
+    db = sqlite3.connect(database_url)
+    ledger = Ledger(db)
+    ledger.init()
+
+    start = timeit.default_timer()
+    accounts = populate(ledger, account_count, item_count, seed=seed)
+    populate_time = timeit.default_timer() - start
+
+    transaction_count = ledger.count_transactions()
+    result = {
+        'scale': name,
+        'items': ledger.count_transaction_items(),
+        'transactions': transaction_count,
+        'accounts': account_count,
+        'populate': populate_time,
+        # Recorded with Ledger.record_transactions, as imports are.
+        'populate_transactions_per_second': transaction_count / populate_time,
+        'ledger': benchmark_ledger(ledger, accounts, repeat),
+        'columnar': benchmark_columnar(ledger, accounts, repeat),
+        'fenwick': benchmark_fenwick(
+            ledger, accounts, repeat,
+            os.path.join(directory, '{}.fenwick'.format(name))
+        ),
+        'routes': benchmark_routes(database_url, repeat),
+        'serialization': benchmark_serialization(database_url, accounts,
+                                                 repeat),
+    }
+    db.close()
+    return result
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scales', default='10k,100k',
+                        help='comma-separated subset of {}'.format(
+                            ', '.join(sorted(SCALES, key=SCALES.get))
+                        ))
+    parser.add_argument('--accounts', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to a file')
+    args = parser.parse_args(argv)
+
+    scales = args.scales.split(',')
+    for scale in scales:
+        if scale not in SCALES:
+            parser.error('unknown scale {}'.format(scale))
+
+    directory = tempfile.mkdtemp(prefix='ledger-benchmarks-')
+    try:
+        results = {
+            'commit': get_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'scales': [
+                benchmark_scale(directory, scale, SCALES[scale],
+                                args.accounts, args.repeat, args.seed)
+                for scale in scales
+            ],
+        }
+    finally:
+        shutil.rmtree(directory)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+'''Answer reports from compact in-memory columns instead of SQLite.'''
+from array import array
+from bisect import bisect_right
+import threading
+
+from ledger import Account, _balance_sheet_from_rows, \
+    _income_statement_from_rows, _sum_closed_amounts, split_periods
+
+
+class InMemoryLedger(object):
+    '''The base of reporting engines keeping balances of a Ledger in memory.
+
+    Subclasses load the balances of every account into _balances, keyed by
+    account code, and implement _new_balances, returning the balances of an
+    account without postings, _get_balance and on_transaction_recorded. The
+    engine listens to accounts created and periods closed through the ledger.
+    '''
+
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self._accounts = {}
+        self._balances = {}
+        self._closings = []
+        self._lock = threading.Lock()
+        self.load()
+        ledger.listeners.append(self)
+
+    def load(self):
+        '''Load all accounts and transactions from the ledger.'''
+        raise NotImplementedError
+
+    def on_account_created(self, account):
+        '''Add a new account without postings.'''
+        with self._lock:
+            self._accounts[account.code] = account
+            self._balances[account.code] = self._new_balances()
+
+    def on_period_closed(self, end_date, closed_amounts):
+        '''Leave the closing entry out of income statements.'''
+        with self._lock:
+            self._closings.append((end_date, closed_amounts))
+
+    def get_balance_sheet(self, date):
+        '''Return a balance sheet.'''
+        return self.get_balance_sheet_series([date])[0]
+
+    def get_balance_sheet_series(self, dates):
+        '''Return a list of balance sheets on the specified dates.'''
+        dates = sorted(dates)
+        with self._lock:
+            return [
+                _balance_sheet_from_rows(date, [
+                    account + (self._get_balance(account.code,
+                                                 date.toordinal()),)
+                    for account in self._accounts.itervalues()
+                ])
+                for date in dates
+            ]
+
+    def get_income_statement(self, start_date, end_date):
+        '''Return an income statement.'''
+        with self._lock:
+            return self._get_income_statement(start_date, end_date)
+
+    def get_income_statement_series(self, start_date, end_date, period):
+        '''Return a list of income statements for consecutive periods.'''
+        periods = list(split_periods(start_date, end_date, period))
+        with self._lock:
+            return [self._get_income_statement(start, end)
+                    for start, end in periods]
+
+    def _get_income_statement(self, start_date, end_date):
+        start_day = start_date.toordinal()
+        end_day = end_date.toordinal()
+        closed = _sum_closed_amounts(self._closings, start_date, end_date)
+        return _income_statement_from_rows(start_date, end_date, [
+            account + (
+                self._get_balance(account.code, end_day) -
+                self._get_balance(account.code, start_day - 1) -
+                closed.get(account.code, 0),
+            )
+            for account in self._accounts.itervalues()
+            if account.type in ('revenue', 'expense')
+        ])
+
+    def _get_account_balances(self, code):
+        balances = self._balances.get(code)
+        if balances is None:
+            # The account was created through another connection.
+            self._accounts[code] = self.ledger.get_account(code)
+            balances = self._balances[code] = self._new_balances()
+        return balances
+
+    def _new_balances(self):
+        raise NotImplementedError
+
+    def _get_balance(self, code, day):
+        '''Return the balance of an account at the end of a day.'''
+        raise NotImplementedError
+
+
+class ColumnarLedger(InMemoryLedger):
+    '''An in-memory reporting engine for a Ledger.
+
+    Every account keeps two parallel arrays: the ordinals of the days it was
+    posted to, in ascending order, and its balance at the end of each of
+    those days. A balance on any date is a binary search away, so reports
+    don't touch the database at all. The columns are loaded once and kept up
+    to date by listening to accounts and transactions created through the
+    ledger.
+
+    Transactions recorded through other Ledger instances or processes aren't
+    seen; call load to pick them up.
+    '''
+
+    def load(self):
+        '''(Re)load all accounts and transactions from the ledger.'''
+        db = self.ledger.db
+        accounts = dict(
+            (row[0], Account(*row))
+            for row in db.execute('SELECT code, name, type FROM accounts')
+        )
+        columns = dict((code, self._new_balances()) for code in accounts)
+        # The daily balances cover archived years, too.
+        rows = db.execute('''
+        SELECT account_code, date, balance
+            FROM account_daily_balances
+            ORDER BY account_code, date
+        ''')
+        for code, date, balance in rows:
+            days, balances = columns[code]
+            days.append(date)
+            balances.append(balance)
+        closings = self.ledger.get_closed_amounts()
+
+        with self._lock:
+            self._accounts = accounts
+            self._balances = columns
+            self._closings = closings
+
+    def on_transaction_recorded(self, tx_id, transaction):
+        '''Add a recorded transaction to the columns.'''
+        day = transaction.date.toordinal()
+        with self._lock:
+            for code, amount in transaction.items:
+                days, balances = self._get_account_balances(code)
+
+                index = bisect_right(days, day)
+                if index == 0 or days[index - 1] != day:
+                    days.insert(index, day)
+                    balances.insert(index,
+                                    balances[index - 1] if index else 0)
+                else:
+                    index -= 1
+                # Back-dated transactions shift all later balances.
+                for i in xrange(index, len(balances)):
+                    balances[i] += amount
+
+    def _new_balances(self):
+        return array('i'), array('l')
+
+    def _get_balance(self, code, day):
+        days, balances = self._balances[code]
+        index = bisect_right(days, day)
+        return balances[index - 1] if index else 0
@@ -0,0 +1,118 @@
+from datetime import date
+import sqlite3
+import unittest
+
+from benchmarks.generator import generate_transactions, populate
+from columnar import ColumnarLedger
+from ledger import Account, Ledger
+
+
+class InMemoryLedgerTests(object):
+    '''Tests shared by the in-memory reporting engines.
+
+    Subclasses set engine_class; the dates reports are compared on span
+    transactions dated before and after the generated ones.
+    '''
+
+    def setUp(self):
+        self.db = sqlite3.connect('test.sqlite3')
+        self.ledger = Ledger(self.db)
+        self.ledger.reset()
+
+    def test_new_account(self):
+        engine = self.engine_class(self.ledger)
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('401', 'Revenue', 'revenue')
+
+        balance_sheet = engine.get_balance_sheet(date(2016, 9, 1))
+        self.assertEqual({Account('101', 'Cash', 'asset'): 0},
+                         balance_sheet.asset)
+
+        self.ledger.record_transaction(date(2016, 9, 1), 'Consulting',
+                                       [('101', 5000), ('401', -5000)])
+        self.ledger.record_transaction(date(2016, 8, 1), 'Consulting',
+                                       [('101', 2000), ('401', -2000)])
+
+        self.assertEqual(
+            self.ledger.get_income_statement(date(2016, 9, 1),
+                                             date(2016, 9, 30)),
+            engine.get_income_statement(date(2016, 9, 1), date(2016, 9, 30))
+        )
+        self.assertEqual(
+            {Account('101', 'Cash', 'asset'): 7000},
+            engine.get_balance_sheet(date(2016, 9, 1)).asset
+        )
+
+    def test_account_created_elsewhere(self):
+        engine = self.engine_class(self.ledger)
+        self.ledger.create_account('101', 'Cash', 'asset')
+        Ledger(sqlite3.connect('test.sqlite3')).create_account(
+            '401', 'Revenue', 'revenue'
+        )
+
+        self.ledger.record_transaction(date(2016, 9, 1), 'Consulting',
+                                       [('101', 5000), ('401', -5000)])
+
+        self.assertEqual(
+            self.ledger.get_income_statement(date(2016, 9, 1),
+                                             date(2016, 9, 30)),
+            engine.get_income_statement(date(2016, 9, 1), date(2016, 9, 30))
+        )
+
+    def assertReportsMatch(self, engine):
+        for day in (date(2004, 12, 31), date(2011, 12, 31),
+                    date(2012, 6, 30), date(2013, 12, 31),
+                    date(2030, 1, 1)):
+            self.assertEqual(self.ledger.get_balance_sheet(day),
+                             engine.get_balance_sheet(day))
+
+        self.assertEqual(
+            self.ledger.get_balance_sheet_series([date(2012, 3, 31),
+                                                  date(2012, 9, 30)]),
+            engine.get_balance_sheet_series([date(2012, 3, 31),
+                                             date(2012, 9, 30)])
+        )
+        self.assertEqual(
+            self.ledger.get_income_statement(date(2012, 2, 1),
+                                             date(2012, 11, 15)),
+            engine.get_income_statement(date(2012, 2, 1),
+                                        date(2012, 11, 15))
+        )
+        self.assertEqual(
+            self.ledger.get_income_statement_series(
+                date(2012, 1, 1), date(2012, 12, 31), 'quarter'
+            ),
+            engine.get_income_statement_series(
+                date(2012, 1, 1), date(2012, 12, 31), 'quarter'
+            )
+        )
+
+
+class ColumnarLedgerTestCase(InMemoryLedgerTests, unittest.TestCase):
+    engine_class = ColumnarLedger
+
+    def test_reports_match_ledger(self):
+        accounts = populate(self.ledger, 20, 2000, seed=1)
+        columnar = ColumnarLedger(self.ledger)
+
+        self.assertReportsMatch(columnar)
+
+        # Appended through the hook, including back-dated transactions.
+        self.ledger.record_transactions(
+            generate_transactions(accounts, 500, seed=2), batch_size=100
+        )
+        for transaction in generate_transactions(accounts, 50, seed=3):
+            self.ledger.record_transaction(*transaction)
+
+        self.assertReportsMatch(columnar)
+
+        self.ledger.close_period(
+            date(2012, 12, 31),
+            next(code for code, _, type in accounts if type == 'equity')
+        )
+        self.assertReportsMatch(columnar)
+        self.assertReportsMatch(ColumnarLedger(self.ledger))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,236 @@
+'''Answer reports from per-account Fenwick trees over day numbers.'''
+from array import array
+import cPickle
+import os
+
+from columnar import InMemoryLedger
+from ledger import Account
+
+
+class FenwickLedger(InMemoryLedger):
+    '''An in-memory reporting engine for a Ledger tolerating back-dating.
+
+    Every account has a binary indexed (Fenwick) tree over the days between
+    first_day and first_day + size - 1. Posting an amount on any day, however
+    far in the past, updates O(log size) nodes and the balance at the end of
+    any day is a sum of O(log size) nodes. Reports take O(accounts * log
+    size) time regardless of the order the transactions were dated in. The
+    range grows, by powers of two, to cover the days posted to.
+
+    Like ColumnarLedger it listens to accounts and transactions created
+    through the ledger. If path is given the trees are saved there by save
+    and loaded from there by load, which then reads only the transactions
+    recorded since the snapshot was taken. The snapshot must have been saved
+    for the same database. Call load to pick up transactions recorded through
+    other Ledger instances or processes.
+    '''
+
+    # Bump when the snapshot format changes; older snapshots are ignored.
+    SNAPSHOT_VERSION = 1
+
+    def __init__(self, ledger, path=None):
+        self.path = path
+        self.first_day = None
+        self.size = 0
+        # Every transaction up to _last_id has been posted, as well as the
+        # ones in _posted_ids which were recorded out of order.
+        self._last_id = 0
+        self._posted_ids = set()
+        InMemoryLedger.__init__(self, ledger)
+
+    def load(self):
+        '''Bring the trees up to date with the ledger.
+
+        Trees already in memory, or else the snapshot at path, are kept and
+        only transactions recorded since are read from the database.
+        '''
+        db = self.ledger.db
+        with self._lock:
+            if not self._balances and self.path is not None:
+                self._read_snapshot()
+            partitions = self.ledger.get_partitions()
+            max_id = max(
+                partition.execute(
+                    'SELECT COALESCE(MAX(id), 0) FROM transactions'
+                ).fetchone()[0]
+                for partition in partitions
+            )
+            if max_id < self._last_id:
+                # The database was reset since the trees were built.
+                self._reset()
+
+            self._accounts = dict(
+                (row[0], Account(*row))
+                for row in db.execute('SELECT code, name, type FROM accounts')
+            )
+            for code in self._accounts:
+                if code not in self._balances:
+                    self._balances[code] = self._new_balances()
+
+            amounts_by_account = {}
+            for partition in partitions:
+                rows = partition.execute('''
+                SELECT t.id, ti.account_code, t.date, SUM(ti.amount)
+                    FROM transactions t
+                    JOIN transaction_items ti ON ti.transaction_id = t.id
+                    WHERE t.id > ?
+                    GROUP BY t.id, ti.account_code
+                ''', (self._last_id,))
+                for tx_id, code, day, amount in rows:
+                    # Recorded after max_id was read.
+                    max_id = max(max_id, tx_id)
+                    if tx_id not in self._posted_ids:
+                        amounts_by_account.setdefault(code, []).append(
+                            (day, amount)
+                        )
+            self._post_many(amounts_by_account)
+            self._last_id = max(max_id, self._last_id)
+            self._posted_ids.clear()
+            self._closings = self.ledger.get_closed_amounts()
+
+    def save(self):
+        '''Write a snapshot of the trees to path.'''
+        if self.path is None:
+            raise ValueError('a snapshot needs a path')
+        with self._lock:
+            snapshot = {
+                'version': self.SNAPSHOT_VERSION,
+                'first_day': self.first_day,
+                'size': self.size,
+                'last_id': self._last_id,
+                'posted_ids': self._posted_ids,
+                'trees': dict((code, tree.tostring())
+                              for code, tree in self._balances.iteritems()),
+            }
+            # Written aside and renamed so a crash never leaves a partial
+            # snapshot behind.
+            temporary_path = self.path + '.tmp'
+            with open(temporary_path, 'wb') as snapshot_file:
+                cPickle.dump(snapshot, snapshot_file, cPickle.HIGHEST_PROTOCOL)
+            os.rename(temporary_path, self.path)
+
+    def _read_snapshot(self):
+        try:
+            with open(self.path, 'rb') as snapshot_file:
+                snapshot = cPickle.load(snapshot_file)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return
+        if snapshot.get('version') != self.SNAPSHOT_VERSION:
+            return
+
+        self.first_day = snapshot['first_day']
+        self.size = snapshot['size']
+        self._last_id = snapshot['last_id']
+        self._posted_ids = snapshot['posted_ids']
+        self._balances = {}
+        for code, data in snapshot['trees'].iteritems():
+            tree = array('l')
+            tree.fromstring(data)
+            self._balances[code] = tree
+
+    def _reset(self):
+        self.first_day = None
+        self.size = 0
+        self._balances = {}
+        self._last_id = 0
+        self._posted_ids.clear()
+
+    def on_transaction_recorded(self, tx_id, transaction):
+        '''Post a recorded transaction to the trees.'''
+        day = transaction.date.toordinal()
+        with self._lock:
+            for code, amount in transaction.items:
+                self._post(code, day, amount)
+            if tx_id == self._last_id + 1:
+                self._last_id = tx_id
+                while self._last_id + 1 in self._posted_ids:
+                    self._last_id += 1
+                    self._posted_ids.remove(self._last_id)
+            else:
+                self._posted_ids.add(tx_id)
+
+    def _get_balance(self, code, day):
+        '''Return the balance of an account at the end of a day.'''
+        if self.first_day is None or day < self.first_day:
+            return 0
+        tree = self._balances[code]
+        index = min(day - self.first_day + 1, self.size)
+        balance = 0
+        while index:
+            balance += tree[index]
+            index &= index - 1
+        return balance
+
+    def _post(self, code, day, amount):
+        self._cover(day, day)
+        tree = self._get_account_balances(code)
+        index = day - self.first_day + 1
+        while index <= self.size:
+            tree[index] += amount
+            index += index & -index
+
+    def _post_many(self, amounts_by_account):
+        '''Post lists of (day, amount) pairs keyed by account code.'''
+        days = [day for amounts in amounts_by_account.itervalues()
+                for day, _ in amounts]
+        if not days:
+            return
+        # Grow the trees once instead of on every day out of range.
+        self._cover(min(days), max(days))
+        for code, amounts in amounts_by_account.iteritems():
+            if len(amounts) * self.size.bit_length() < 2 * self.size:
+                for day, amount in amounts:
+                    self._post(code, day, amount)
+                continue
+            # Rebuilding the tree in linear time is cheaper.
+            tree = self._get_account_balances(code)
+            _to_amounts(tree, self.size)
+            for day, amount in amounts:
+                tree[day - self.first_day + 1] += amount
+            _build(tree, self.size)
+
+    def _cover(self, first_day, last_day):
+        '''Make sure the trees cover the days from first_day to last_day.'''
+        if self.first_day is not None:
+            if (first_day >= self.first_day and
+                    last_day < self.first_day + self.size):
+                return
+            first_day = min(self.first_day, first_day)
+            last_day = max(self.first_day + self.size - 1, last_day)
+        self._resize(first_day, last_day - first_day + 1)
+
+    def _resize(self, first_day, days):
+        '''Cover at least days days from first_day, rebuilding the trees.'''
+        size = 1
+        while size < days:
+            size *= 2
+        offset = (self.first_day or first_day) - first_day
+        for code, tree in self._balances.iteritems():
+            new_tree = array('l', [0]) * (size + 1)
+            if self.size:
+                # Amounts per day are shifted to the new range.
+                _to_amounts(tree, self.size)
+                new_tree[offset + 1:offset + self.size + 1] = tree[1:]
+                _build(new_tree, size)
+            self._balances[code] = new_tree
+        self.first_day = first_day
+        self.size = size
+
+    def _new_balances(self):
+        return array('l', [0]) * (self.size + 1)
+
+
+def _build(tree, size):
+    '''Turn amounts per day into a Fenwick tree in place in linear time.'''
+    for index in xrange(1, size + 1):
+        parent = index + (index & -index)
+        if parent <= size:
+            tree[parent] += tree[index]
+
+
+def _to_amounts(tree, size):
+    '''Turn a Fenwick tree back into amounts per day in place.'''
+    for index in xrange(size, 0, -1):
+        parent = index + (index & -index)
+        if parent <= size:
+            tree[parent] -= tree[index]
@@ -0,0 +1,90 @@
+from datetime import date
+import os
+import sqlite3
+import unittest
+
+from benchmarks.generator import generate_transactions, populate
+from columnar_test import InMemoryLedgerTests
+from fenwick import FenwickLedger
+from ledger import Ledger
+
+
+class FenwickLedgerTestCase(InMemoryLedgerTests, unittest.TestCase):
+    engine_class = FenwickLedger
+    SNAPSHOT_PATH = 'test.fenwick'
+
+    def setUp(self):
+        InMemoryLedgerTests.setUp(self)
+        if os.path.exists(self.SNAPSHOT_PATH):
+            os.remove(self.SNAPSHOT_PATH)
+
+    def tearDown(self):
+        if os.path.exists(self.SNAPSHOT_PATH):
+            os.remove(self.SNAPSHOT_PATH)
+
+    def test_reports_match_ledger(self):
+        accounts = populate(self.ledger, 20, 2000, seed=1)
+        fenwick = FenwickLedger(self.ledger)
+
+        self.assertReportsMatch(fenwick)
+
+        # Back-dated transactions, including ones before the first posting
+        # and far after the last one, grow the range of the trees.
+        self.ledger.record_transactions(
+            generate_transactions(accounts, 500, seed=2), batch_size=100
+        )
+        for transaction in generate_transactions(
+                accounts, 50, start_date=date(2005, 1, 1), days=20 * 365,
+                seed=3):
+            self.ledger.record_transaction(*transaction)
+
+        self.assertReportsMatch(fenwick)
+
+        self.ledger.close_period(
+            date(2012, 12, 31),
+            next(code for code, _, type in accounts if type == 'equity')
+        )
+        self.assertReportsMatch(fenwick)
+        self.assertReportsMatch(FenwickLedger(self.ledger))
+
+    def test_snapshot(self):
+        accounts = populate(self.ledger, 20, 1000, seed=1)
+        fenwick = FenwickLedger(self.ledger, self.SNAPSHOT_PATH)
+        fenwick.save()
+        self.ledger.listeners.remove(fenwick)
+
+        # Recorded after the snapshot, from another connection.
+        other_ledger = Ledger(sqlite3.connect('test.sqlite3'))
+        other_ledger.record_transactions(
+            generate_transactions(accounts, 300, seed=2)
+        )
+
+        self.assertReportsMatch(
+            FenwickLedger(self.ledger, self.SNAPSHOT_PATH)
+        )
+
+        # A snapshot newer than the database is discarded.
+        self.ledger.reset()
+        fenwick = FenwickLedger(self.ledger, self.SNAPSHOT_PATH)
+        self.assertEqual(0, fenwick.size)
+
+    def test_save_without_path(self):
+        self.assertRaises(ValueError, FenwickLedger(self.ledger).save)
+
+    def test_load_after_out_of_order_ids(self):
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('401', 'Revenue', 'revenue')
+        fenwick = FenwickLedger(self.ledger)
+
+        other_ledger = Ledger(sqlite3.connect('test.sqlite3'))
+        other_ledger.record_transaction(date(2016, 9, 1), 'Consulting',
+                                        [('101', 5000), ('401', -5000)])
+        self.ledger.record_transaction(date(2016, 9, 2), 'Consulting',
+                                       [('101', 2000), ('401', -2000)])
+        fenwick.load()
+
+        self.assertReportsMatch(fenwick)
+
+
+if __name__ == '__main__':
+    unittest.main()
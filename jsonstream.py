@@ -0,0 +1,73 @@
+'''Encode JSON incrementally so large responses can be streamed.'''
+import json
+
+# The approximate size, in bytes, of the chunks yielded by iterencode.
+CHUNK_SIZE = 8192
+
+# Sorting keys or indenting would disable the C accelerated encoder.
+_encoder = json.JSONEncoder()
+
+
+def iterencode(value, chunk_size=CHUNK_SIZE):
+    '''Yield the JSON encoding of value in chunks of about chunk_size bytes.
+
+    Dicts, lists and tuples are encoded as usual. Any other iterable, e.g. a
+    generator over rows fetched from the database, is encoded as an array
+    whose elements are consumed one at a time, so the whole document is
+    never held in memory. Containers holding only scalars are handed to the
+    json module at once.
+    '''
+    return chunk(_iterencode(value), chunk_size)
+
+
+def chunk(pieces, chunk_size=CHUNK_SIZE):
+    '''Join an iterable of strings into chunks of about chunk_size bytes.
+
+    Yielding every small piece to the server separately costs a write each.
+    '''
+    buffered = []
+    size = 0
+    for piece in pieces:
+        buffered.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(buffered)
+            buffered = []
+            size = 0
+    if buffered:
+        yield ''.join(buffered)
+
+
+def _iterencode(value):
+    if isinstance(value, dict):
+        if not any(_is_iterable(item) for item in value.itervalues()):
+            yield _encoder.encode(value)
+            return
+        yield '{'
+        for index, (key, item) in enumerate(value.iteritems()):
+            if index:
+                yield ', '
+            yield _encoder.encode(key)
+            yield ': '
+            for piece in _iterencode(item):
+                yield piece
+        yield '}'
+    elif _is_iterable(value):
+        if (isinstance(value, (list, tuple)) and
+                not any(_is_iterable(item) for item in value)):
+            yield _encoder.encode(value)
+            return
+        yield '['
+        for index, item in enumerate(value):
+            if index:
+                yield ', '
+            for piece in _iterencode(item):
+                yield piece
+        yield ']'
+    else:
+        yield _encoder.encode(value)
+
+
+def _is_iterable(value):
+    # Strings have no __iter__ in Python 2.
+    return hasattr(value, '__iter__')
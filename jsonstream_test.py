@@ -0,0 +1,54 @@
+import json
+import unittest
+
+from jsonstream import chunk, iterencode
+
+
+class JsonStreamTestCase(unittest.TestCase):
+    def test_iterencode(self):
+        value = {
+            'name': u'Za\u017c\xf3\u0142\u0107',
+            'empty': [],
+            'accounts': ({'code': str(code), 'balance': code * 100}
+                         for code in xrange(3)),
+            'nested': [{'rows': iter([1, 2])}, None, True, 1.5],
+        }
+
+        self.assertEqual(
+            {
+                'name': u'Za\u017c\xf3\u0142\u0107',
+                'empty': [],
+                'accounts': [{'code': '0', 'balance': 0},
+                             {'code': '1', 'balance': 100},
+                             {'code': '2', 'balance': 200}],
+                'nested': [{'rows': [1, 2]}, None, True, 1.5],
+            },
+            json.loads(''.join(iterencode(value)))
+        )
+
+    def test_iterencode_consumes_iterables_lazily(self):
+        consumed = []
+
+        def rows():
+            for row in xrange(1000):
+                consumed.append(row)
+                yield {'row': row}
+
+        chunks = iterencode({'rows': rows()}, chunk_size=100)
+        first_chunk = next(chunks)
+        self.assertTrue(first_chunk.startswith('{"rows": [{"row": 0}'))
+        self.assertLess(len(consumed), 20)
+
+        rest = ''.join(chunks)
+        self.assertEqual(range(1000), [
+            row['row'] for row in json.loads(first_chunk + rest)['rows']
+        ])
+
+    def test_chunk(self):
+        self.assertEqual(['abc', 'de', 'f'],
+                         list(chunk(['a', 'bc', 'de', 'f'], chunk_size=2)))
+        self.assertEqual([], list(chunk([])))
+
+
+if __name__ == '__main__':
+    unittest.main()
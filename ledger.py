@@ -1,15 +1,293 @@
-from collections import namedtuple
+import binascii
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
 from copy import copy
-from datetime import datetime
+from datetime import date as _date, datetime, timedelta
+import heapq
+from itertools import groupby, islice
+import logging
+import multiprocessing
+from operator import itemgetter
+import os
 import re
 import sqlite3
+import sys
+import threading
+import urllib
+
+_logger = logging.getLogger(__name__)
+_logger.addHandler(logging.NullHandler())
+
+
+# The amount posted to every account on every day it was posted to.
+DAILY_AMOUNTS = '''
+SELECT ti.account_code, t.date, SUM(ti.amount) AS amount
+    FROM transactions t
+    JOIN transaction_items ti ON ti.transaction_id = t.id
+    GROUP BY ti.account_code, t.date
+'''
+
+REBUILD_DAILY_BALANCES = '''
+DELETE FROM account_daily_balances;
+INSERT INTO account_daily_balances(account_code, date, balance)
+    SELECT account_code, date, SUM(amount) OVER (
+        PARTITION BY account_code ORDER BY date
+    )
+    FROM ({daily_amounts});
+'''
+
+# Dates are stored as day ordinals (date.toordinal()); adding this offset
+# turns them into Julian days understood by SQLite's date functions.
+JULIAN_DAY_OFFSET = 1721424.5
+
+
+def _period_start(modifiers):
+    return 'CAST(julianday(t.date + {0}, {1}) - {0} AS INTEGER)'.format(
+        JULIAN_DAY_OFFSET, modifiers
+    )
+
+
+# The first day of the calendar period containing t.date.
+PERIOD_START = {
+    'day': 't.date',
+    # The ordinal of a Monday is 1 modulo 7.
+    'week': 't.date - (t.date + 6) % 7',
+    'month': _period_start("'start of month'"),
+    'quarter': _period_start('''
+        'start of month',
+        '-' || ((CAST(strftime('%m', t.date + {}) AS INTEGER) - 1) % 3)
+            || ' months'
+    '''.format(JULIAN_DAY_OFFSET)),
+    'year': _period_start("'start of year'"),
+}
+
+# Copy a table into one with a new definition and put the copy in place of
+# the original.
+REBUILD_TABLE = '''
+CREATE TABLE {table}_rebuilt{definition};
+INSERT INTO {table}_rebuilt
+    SELECT {columns} FROM {table};
+DROP TABLE {table};
+ALTER TABLE {table}_rebuilt RENAME TO {table};
+'''
+
+REBUILD_ACCOUNT_TOTALS = '''
+DELETE FROM account_totals;
+INSERT INTO account_totals(account_code, balance)
+    SELECT a.code, COALESCE(SUM(i.amount), 0)
+        FROM accounts a
+        LEFT JOIN ({daily_amounts}) i ON i.account_code = a.code
+        GROUP BY a.code;
+'''
+
+# The indexes of the transaction tables, in the main database and archives.
+TRANSACTION_INDEXES = '''
+CREATE INDEX transactions_date ON transactions(date);
+CREATE INDEX transaction_items_transaction_id
+    ON transaction_items(transaction_id, account_code, amount);
+CREATE INDEX transaction_items_account_code
+    ON transaction_items(account_code, transaction_id, amount);
+'''
+
+# The tables of an archive database; see Ledger.archive_year.
+ARCHIVE_SCHEMA = '''
+CREATE TABLE transactions(
+    id INTEGER PRIMARY KEY,
+    date INTEGER NOT NULL,
+    description VARCHAR(255) NOT NULL
+);
+CREATE TABLE transaction_items(
+    id INTEGER PRIMARY KEY,
+    transaction_id INTEGER NOT NULL REFERENCES transactions(id),
+    account_code VARCHAR(255) NOT NULL,
+    amount INTEGER NOT NULL
+);
+''' + TRANSACTION_INDEXES
+
+# The balance of the account a on the last day matching the comparison, e.g.
+# '<= ?' for the end of the day bound to the parameter.
+BALANCE_AT = '''
+COALESCE((
+    SELECT b.balance
+        FROM account_daily_balances b
+        WHERE b.account_code = a.code AND b.date {}
+        ORDER BY b.date DESC
+        LIMIT 1
+), 0)
+'''
+
+# The amount closing entries dated between the days bound to the parameters
+# posted to the account a; income statements leave it out.
+CLOSED_BETWEEN = '''
+COALESCE((
+    SELECT SUM(c.closed_amount)
+        FROM closing_balances c
+        WHERE c.account_code = a.code AND c.end_date BETWEEN ? AND ?
+), 0)
+'''
+
+# The balance of every account excluding its descendants and the total of
+# its subtree, given a query of (code, balance) of the accounts.
+ROLL_UP = '''
+SELECT tree.ancestor_code,
+       SUM(CASE WHEN tree.depth = 0 THEN balances.balance ELSE 0 END),
+       SUM(balances.balance)
+    FROM account_tree tree
+    JOIN ({}) balances ON balances.code = tree.descendant_code
+    GROUP BY tree.ancestor_code
+'''
 
 
 class Ledger(object):
     ACCOUNT_TYPES = ('asset', 'liability', 'equity', 'revenue', 'expense')
 
-    def __init__(self, database):
+    # Schema migrations applied on top of the tables created by init. The
+    # position of a migration in the list is the schema version it produces
+    # minus one; the current version is kept in PRAGMA user_version.
+    MIGRATIONS = (
+        # Dates are stored as YYYY-MM-DD so that they compare correctly as
+        # strings; normalize any stragglers and index every column that the
+        # reports join or filter on.
+        '''
+        UPDATE transactions SET date = date(date)
+            WHERE date(date) IS NOT NULL AND date <> date(date);
+        CREATE INDEX IF NOT EXISTS transactions_date
+            ON transactions(date);
+        CREATE INDEX IF NOT EXISTS transaction_items_transaction_id
+            ON transaction_items(transaction_id, account_code, amount);
+        CREATE INDEX IF NOT EXISTS transaction_items_account_code
+            ON transaction_items(account_code);
+        ''',
+        # The closing balance of every account on every day it was affected
+        # by a transaction. Balance sheets read the latest row on or before
+        # the requested date instead of summing the whole history.
+        '''
+        CREATE TABLE IF NOT EXISTS account_daily_balances(
+            account_code VARCHAR(255) NOT NULL REFERENCES accounts(code),
+            date VARCHAR(255) NOT NULL,
+            balance INTEGER NOT NULL,
+            PRIMARY KEY (account_code, date)
+        ) WITHOUT ROWID;
+        ''' + REBUILD_DAILY_BALANCES.format(daily_amounts=DAILY_AMOUNTS),
+        # Let account ledgers find the transactions of an account's items
+        # without reading the items themselves.
+        '''
+        DROP INDEX IF EXISTS transaction_items_account_code;
+        CREATE INDEX transaction_items_account_code
+            ON transaction_items(account_code, transaction_id, amount);
+        ''',
+        # The current balance of every account for trial balances and
+        # balance lookups.
+        '''
+        CREATE TABLE IF NOT EXISTS account_totals(
+            account_code VARCHAR(255) PRIMARY KEY REFERENCES accounts(code),
+            balance INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        ''' + REBUILD_ACCOUNT_TOTALS.format(daily_amounts=DAILY_AMOUNTS),
+        # Store dates as day ordinals instead of strings. Integers are more
+        # compact, compare faster and convert to dates without parsing.
+        REBUILD_TABLE.format(
+            table='transactions',
+            definition='''(
+                id INTEGER PRIMARY KEY,
+                date INTEGER NOT NULL,
+                description VARCHAR(255) NOT NULL
+            )''',
+            columns='id, CAST(julianday(date) - {} AS INTEGER), '
+                    'description'.format(JULIAN_DAY_OFFSET)
+        ) + REBUILD_TABLE.format(
+            table='account_daily_balances',
+            definition='''(
+                account_code VARCHAR(255) NOT NULL REFERENCES accounts(code),
+                date INTEGER NOT NULL,
+                balance INTEGER NOT NULL,
+                PRIMARY KEY (account_code, date)
+            ) WITHOUT ROWID''',
+            columns='account_code, CAST(julianday(date) - {} AS INTEGER), '
+                    'balance'.format(JULIAN_DAY_OFFSET)
+        ) + '''
+        CREATE INDEX transactions_date ON transactions(date);
+        ''',
+        # Accounts can be grouped under a parent account of the same type.
+        # account_tree is the closure of the hierarchy: a row for every
+        # account and each of its ancestors, including itself at depth 0.
+        '''
+        ALTER TABLE accounts
+            ADD COLUMN parent_code VARCHAR(255) REFERENCES accounts(code);
+        CREATE TABLE IF NOT EXISTS account_tree(
+            ancestor_code VARCHAR(255) NOT NULL REFERENCES accounts(code),
+            descendant_code VARCHAR(255) NOT NULL REFERENCES accounts(code),
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_code, descendant_code)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS account_tree_descendant_code
+            ON account_tree(descendant_code);
+        INSERT INTO account_tree(ancestor_code, descendant_code, depth)
+            SELECT code, code, 0 FROM accounts;
+        ''',
+        # Transactions of past years can be moved to archive databases; see
+        # archive_year. IDs are never reused so that they're unique across
+        # archives, and every archive records the range of IDs it holds.
+        REBUILD_TABLE.format(
+            table='transactions',
+            definition='''(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                date INTEGER NOT NULL,
+                description VARCHAR(255) NOT NULL
+            )''',
+            columns='id, date, description'
+        ) + REBUILD_TABLE.format(
+            table='transaction_items',
+            definition='''(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                transaction_id INTEGER NOT NULL REFERENCES transactions(id),
+                account_code VARCHAR(255) NOT NULL REFERENCES accounts(code),
+                amount INTEGER NOT NULL
+            )''',
+            columns='id, transaction_id, account_code, amount'
+        ) + TRANSACTION_INDEXES + '''
+        CREATE TABLE IF NOT EXISTS archives(
+            year INTEGER PRIMARY KEY,
+            path VARCHAR(255) NOT NULL,
+            first_day INTEGER NOT NULL,
+            last_day INTEGER NOT NULL,
+            first_id INTEGER,
+            last_id INTEGER
+        );
+        ''',
+        # Closed periods; see close_period. closing_balances keeps the
+        # balance of every account after closing, i.e. its opening balance
+        # for the next period, and the amount the closing entry posted to it.
+        '''
+        CREATE TABLE IF NOT EXISTS period_closings(
+            end_date INTEGER PRIMARY KEY,
+            transaction_id INTEGER REFERENCES transactions(id),
+            retained_earnings_code VARCHAR(255) NOT NULL
+                REFERENCES accounts(code)
+        );
+        CREATE TABLE IF NOT EXISTS closing_balances(
+            account_code VARCHAR(255) NOT NULL REFERENCES accounts(code),
+            end_date INTEGER NOT NULL REFERENCES period_closings(end_date),
+            balance INTEGER NOT NULL,
+            closed_amount INTEGER NOT NULL,
+            PRIMARY KEY (account_code, end_date)
+        ) WITHOUT ROWID;
+        ''',
+    )
+
+    # The schema version introducing archives.
+    ARCHIVES_VERSION = 7
+
+    def __init__(self, database, cache=None, accounts=None):
         self.db = database
+        self.cache = cache
+        # The registry must only be shared by ledgers using the same
+        # connection; see AccountRegistry.
+        self.accounts = accounts if accounts is not None else AccountRegistry()
+        # Objects notified of committed writes; see _notify.
+        self.listeners = []
+        # Connections to archives by path; see get_partitions.
+        self._archive_connections = {}
 
     def init(self):
         '''Initialize the database.'''
@@ -32,191 +310,1530 @@ class Ledger(object):
         );
         ''')
         self.db.commit()
+        self.migrate()
+
+    def migrate(self):
+        '''Bring the database schema up to date.'''
+        version = self.get_schema_version()
+        for migration in self.MIGRATIONS[version:]:
+            version += 1
+            self.db.executescript(
+                'BEGIN; {} PRAGMA user_version = {}; COMMIT;'.format(
+                    migration, version
+                )
+            )
+
+    def get_schema_version(self):
+        '''Return the version of the database schema.'''
+        return self.db.execute('PRAGMA user_version').fetchone()[0]
 
     def drop(self):
         '''Reset the ledger.'''
+        self.close_archives()
         self.db.executescript('''
+        DROP TABLE IF EXISTS closing_balances;
+        DROP TABLE IF EXISTS period_closings;
+        DROP TABLE IF EXISTS archives;
+        DROP TABLE IF EXISTS account_tree;
+        DROP TABLE IF EXISTS account_totals;
+        DROP TABLE IF EXISTS account_daily_balances;
         DROP TABLE IF EXISTS transaction_items;
         DROP TABLE IF EXISTS transactions;
         DROP TABLE IF EXISTS accounts;
+        PRAGMA user_version = 0;
         ''')
         self.db.commit()
+        self.accounts.clear()
+        if self.cache is not None:
+            self.cache.clear()
 
     def reset(self):
         '''Reset the ledger.'''
         self.drop()
         self.init()
 
-    def create_account(self, code, name, type):
-        '''Create an account with a given code and name.'''
+    def rebuild_balances(self, processes=1):
+        '''Recompute daily and current account balances from items.
+
+        Archives are summed by a pool of processes if processes is greater
+        than one; see archive_year.
+        '''
+        daily_amounts = DAILY_AMOUNTS
+        if self._load_archived_amounts(processes):
+            daily_amounts = '''
+            SELECT account_code, date, SUM(amount) AS amount
+                FROM (
+                    {}
+                    UNION ALL
+                    SELECT account_code, date, amount
+                        FROM temp.archived_amounts
+                )
+                GROUP BY account_code, date
+            '''.format(DAILY_AMOUNTS)
+        try:
+            self.db.executescript('BEGIN; {} {} COMMIT;'.format(
+                REBUILD_DAILY_BALANCES.format(daily_amounts=daily_amounts),
+                REBUILD_ACCOUNT_TOTALS.format(daily_amounts=daily_amounts)
+            ))
+        finally:
+            self.db.execute('DROP TABLE IF EXISTS temp.archived_amounts')
+
+    def check_balances(self, processes=1):
+        '''Compare current account balances with their items.
+
+        Return a list of (code, recorded balance, actual balance) of the
+        accounts whose balances are out of sync; see rebuild_balances.
+        '''
+        items = 'SELECT account_code, amount FROM transaction_items'
+        if self._load_archived_amounts(processes):
+            items += '''
+            UNION ALL
+            SELECT account_code, amount FROM temp.archived_amounts
+            '''
+        try:
+            return self.db.execute('''
+            SELECT a.code, t.balance, COALESCE(i.balance, 0)
+                FROM accounts a
+                LEFT JOIN account_totals t ON t.account_code = a.code
+                LEFT JOIN (
+                    SELECT account_code, SUM(amount) AS balance
+                        FROM ({})
+                        GROUP BY account_code
+                ) i ON i.account_code = a.code
+                WHERE t.balance IS NOT COALESCE(i.balance, 0)
+                ORDER BY a.code
+            '''.format(items)).fetchall()
+        finally:
+            self.db.execute('DROP TABLE IF EXISTS temp.archived_amounts')
+
+    def _load_archived_amounts(self, processes):
+        '''Copy the daily amounts of all archives to a temporary table.
+
+        Return False, leaving the table out, if there are no archives.
+        '''
+        paths = [self._get_archive_path(path)
+                 for _, path, _, _ in self._get_archives()]
+        if not paths:
+            return False
+
+        if processes > 1 and len(paths) > 1:
+            pool = multiprocessing.Pool(min(processes, len(paths)))
+            try:
+                partial_amounts = pool.map(_get_archived_amounts, paths)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            partial_amounts = map(_get_archived_amounts, paths)
+
+        self.db.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS archived_amounts(
+            account_code VARCHAR(255) NOT NULL,
+            date INTEGER NOT NULL,
+            amount INTEGER NOT NULL
+        )
+        ''')
+        for rows in partial_amounts:
+            self.db.executemany(
+                'INSERT INTO temp.archived_amounts VALUES (?, ?, ?)', rows
+            )
+        self.db.commit()
+        return True
+
+    def archive_year(self, year, path):
+        '''Move the transactions dated in a year to an archive database.
+
+        The archive is created at path, relative to the directory of the
+        ledger's database unless absolute, and is only read afterwards.
+        Transactions can no longer be recorded in the year or before it.
+        Years must be archived in order: the transactions of earlier years
+        have to be archived first.
+
+        Balances stay in the ledger's database so reports never read
+        archives. Listing transactions and account ledgers, income
+        statement series and checking or rebuilding balances read the
+        archives of the years they cover.
+        '''
+        if self.db.execute('SELECT 1 FROM archives WHERE year = ?',
+                           (year,)).fetchone() is not None:
+            raise LedgerError('The year {} is already archived'.format(year))
+        # Partitions are read in date order so no archive may follow
+        # transactions left in the ledger's database.
+        if self.db.execute('SELECT 1 FROM transactions WHERE date < ?',
+                           (_to_day(_date(year, 1, 1)),)).fetchone():
+            raise LedgerError(
+                'The years before {} must be archived first'.format(year)
+            )
+        archive_path = self._get_archive_path(path)
+        if os.path.exists(archive_path):
+            raise LedgerError('The file "{}" already exists'.format(
+                archive_path
+            ))
+        archive = sqlite3.connect(archive_path)
+        try:
+            archive.executescript(ARCHIVE_SCHEMA)
+        finally:
+            archive.close()
+
+        days = (_to_day(_date(year, 1, 1)), _to_day(_date(year, 12, 31)))
+        archived = False
+        self.db.commit()
+        self.db.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+        try:
+            while True:
+                # The copy is committed before the originals are deleted in
+                # a transaction of its own, so that a crash can't lose them.
+                self.db.execute('''
+                INSERT OR IGNORE INTO archive.transactions
+                    SELECT id, date, description
+                        FROM main.transactions
+                        WHERE date BETWEEN ? AND ?
+                ''', days)
+                self.db.execute('''
+                INSERT OR IGNORE INTO archive.transaction_items
+                    SELECT ti.id, ti.transaction_id, ti.account_code,
+                           ti.amount
+                        FROM main.transactions t
+                        JOIN main.transaction_items ti
+                            ON ti.transaction_id = t.id
+                        WHERE t.date BETWEEN ? AND ?
+                ''', days)
+                self.db.commit()
+
+                self.db.execute('''
+                DELETE FROM main.transaction_items
+                    WHERE id IN (SELECT id FROM archive.transaction_items)
+                ''')
+                self.db.execute('''
+                DELETE FROM main.transactions
+                    WHERE id IN (SELECT id FROM archive.transactions)
+                ''')
+                # Transactions recorded since the copy are copied, too.
+                if self.db.execute('''
+                SELECT 1 FROM main.transactions WHERE date BETWEEN ? AND ?
+                ''', days).fetchone() is None:
+                    break
+                self.db.rollback()
+
+            self.db.execute('''
+            INSERT INTO archives(year, path, first_day, last_day, first_id,
+                                 last_id)
+                SELECT ?, ?, ?, ?, MIN(id), MAX(id) FROM archive.transactions
+            ''', (year, path) + days)
+            self.db.commit()
+            archived = True
+        finally:
+            if not archived:
+                self.db.rollback()
+            self.db.execute('DETACH DATABASE archive')
+            if not archived:
+                os.remove(archive_path)
+
+    def get_partitions(self, start_date=None, end_date=None):
+        '''Return connections to the databases holding transactions.
+
+        The archives of the years overlapping start_date to end_date come
+        first, oldest first, followed by the ledger's database. Archives are
+        opened once and kept open until close_archives is called.
+        '''
+        return [
+            self._open_archive(path)
+            for _, path, _, _ in self._get_archives(start_date, end_date)
+        ] + [self.db]
+
+    def close_archives(self):
+        '''Close the connections to archives opened by the ledger.'''
+        for archive in self._archive_connections.itervalues():
+            archive.close()
+        self._archive_connections.clear()
+
+    def _open_archive(self, path):
+        archive_path = self._get_archive_path(path)
+        archive = self._archive_connections.get(archive_path)
+        if archive is not None and not os.path.exists(archive_path):
+            # Removed since it was opened; report it like a missing one.
+            del self._archive_connections[archive_path]
+            archive.close()
+            archive = None
+        if archive is None:
+            archive = _connect_archive(archive_path)
+            self._archive_connections[archive_path] = archive
+        return archive
+
+    def _get_archives(self, start_date=None, end_date=None):
+        '''Return (year, path, first ID, last ID) of archives by year.'''
+        if self.get_schema_version() < self.ARCHIVES_VERSION:
+            return []
+        return self.db.execute('''
+        SELECT year, path, first_id, last_id
+            FROM archives
+            WHERE last_day >= ? AND first_day <= ?
+            ORDER BY year
+        ''', (
+            0 if start_date is None else _to_day(start_date),
+            sys.maxint if end_date is None else _to_day(end_date)
+        )).fetchall()
+
+    def _get_archive_path(self, path):
+        if os.path.isabs(path):
+            return path
+        for _, name, database_path in self.db.execute(
+                'PRAGMA database_list'):
+            if name == 'main':
+                return os.path.join(os.path.dirname(database_path), path)
+
+    def _check_dates_open(self, cursor, dates):
+        '''Raise ValueError if any date is in a closed period or archive.'''
+        closed_until, archived_until = cursor.execute('''
+        SELECT (SELECT MAX(end_date) FROM period_closings),
+               (SELECT MAX(year) FROM archives)
+        ''').fetchone()
+        first_date = min(dates)
+        if closed_until is not None and first_date.toordinal() <= closed_until:
+            raise ValueError('the books are closed until {}'.format(
+                _from_day(closed_until)
+            ))
+        if archived_until is not None and first_date.year <= archived_until:
+            raise ValueError('the years until {} are archived'.format(
+                archived_until
+            ))
+
+    def close_period(self, end_date, retained_earnings_code,
+                     description='Closing entry'):
+        '''Close the books at the end of a day.
+
+        A closing transaction dated end_date moves the balances revenue and
+        expense accounts have accumulated since the previous closing to the
+        retained earnings account, an equity account. The balances of all
+        accounts afterwards are kept as the opening balances of the next
+        period; see get_period_closing. Transactions can no longer be
+        recorded on or before end_date. Income statements leave closing
+        transactions out so they still show the result of the period.
+
+        Return the ID of the closing transaction or None if there was
+        nothing to close.
+        '''
+        retained_earnings = self.get_account(retained_earnings_code)
+        if retained_earnings is None or retained_earnings.type != 'equity':
+            raise ValueError(
+                'unknown equity account code {}'.format(
+                    retained_earnings_code
+                )
+            )
+        while True:
+            balances = self._get_balances(end_date)
+            items = [(code, -balance)
+                     for code, _, type, balance in balances
+                     if type in ('revenue', 'expense') and balance]
+            if items:
+                items.append((retained_earnings_code,
+                              -sum(amount for _, amount in items)))
+            closed_amounts = dict(items)
+
+            c = self.db.cursor()
+            try:
+                # Checked even when there's nothing to move so that no closing
+                # lands in a closed period or an archived year.
+                self._check_dates_open(c, [end_date])
+                tx_id = None
+                if items:
+                    tx_id = self._insert_transaction(c, end_date, description,
+                                                     items)
+                c.execute('''
+                INSERT INTO period_closings(end_date, transaction_id,
+                                            retained_earnings_code)
+                    VALUES (?, ?, ?)
+                ''', (_to_day(end_date), tx_id, retained_earnings_code))
+                # The balances were read before the write lock was taken; if
+                # a transaction was recorded meanwhile, start over.
+                balances = self._get_balances(end_date)
+                if any(balance for _, _, type, balance in balances
+                       if type in ('revenue', 'expense')):
+                    self.db.rollback()
+                    continue
+                c.executemany('''
+                INSERT INTO closing_balances(account_code, end_date, balance,
+                                             closed_amount)
+                    VALUES (?, ?, ?, ?)
+                ''', [
+                    (code, _to_day(end_date), balance,
+                     closed_amounts.get(code, 0))
+                    for code, _, _, balance in balances
+                ])
+            except:
+                self.db.rollback()
+                raise
+            finally:
+                c.close()
+            break
+
+        self.db.commit()
+        if tx_id is not None:
+            self._notify('on_transaction_recorded', tx_id,
+                         Transaction(end_date, description, items))
+        self._notify('on_period_closed', end_date, closed_amounts)
+        return tx_id
+
+    def get_period_closing(self, end_date):
+        '''Return the PeriodClosing at the end of a day or None.'''
+        row = self.db.execute('''
+        SELECT transaction_id, retained_earnings_code
+            FROM period_closings
+            WHERE end_date = ?
+        ''', (_to_day(end_date),)).fetchone()
+        if row is None:
+            return None
+        rows = self._add_accounts(self.db.execute('''
+        SELECT account_code, balance
+            FROM closing_balances
+            WHERE end_date = ?
+        ''', (_to_day(end_date),)))
+        return PeriodClosing(
+            end_date=end_date,
+            transaction_id=row[0],
+            retained_earnings=self.get_account(row[1]),
+            balances=dict((Account(code, name, type), balance)
+                          for code, name, type, balance in rows)
+        )
+
+    def get_closed_amounts(self, start_date=None, end_date=None):
+        '''Return the amounts closing entries posted in a date range.
+
+        Return a list of (date, {account code: amount}) pairs by date.
+        '''
+        rows = self.db.execute('''
+        SELECT end_date, account_code, closed_amount
+            FROM closing_balances
+            WHERE end_date BETWEEN ? AND ? AND closed_amount <> 0
+            ORDER BY end_date
+        ''', (
+            0 if start_date is None else _to_day(start_date),
+            sys.maxint if end_date is None else _to_day(end_date)
+        ))
+        return [
+            (_from_day(day), dict((code, amount) for _, code, amount in rows))
+            for day, rows in groupby(rows, itemgetter(0))
+        ]
+
+    def create_account(self, code, name, type, parent_code=None):
+        '''Create an account with a given code and name.
+
+        The account can be placed under a parent account of the same type.
+        '''
         if type not in self.ACCOUNT_TYPES:
             raise ValueError('unknown account type {}'.format(type))
-        if self.get_account(code):
+        accounts = self._get_accounts()
+        if code in accounts:
             raise LedgerError('The account "{}" already exists'.format(code))
-        self.db.execute(
-            'INSERT INTO accounts(code, name, type) VALUES (?, ?, ?)',
-            (code, name, type)
-        ).close()
+        if parent_code is not None:
+            parent = accounts.get(parent_code)
+            if parent is None:
+                raise ValueError(
+                    'unknown parent account code {}'.format(parent_code)
+                )
+            if parent.type != type:
+                raise ValueError(
+                    'the account must have the type of its parent, {}'.format(
+                        parent.type
+                    )
+                )
+        try:
+            self.db.execute(
+                '''INSERT INTO accounts(code, name, type, parent_code)
+                   VALUES (?, ?, ?, ?)''',
+                (code, name, type, parent_code)
+            ).close()
+            self.db.execute(
+                'INSERT INTO account_totals(account_code, balance) '
+                'VALUES (?, 0)',
+                (code,)
+            ).close()
+            self.db.execute('''
+            INSERT INTO account_tree(ancestor_code, descendant_code, depth)
+                SELECT ?, ?, 0
+                UNION ALL
+                SELECT ancestor_code, ?, depth + 1
+                    FROM account_tree
+                    WHERE descendant_code = ?
+            ''', (code, code, code, parent_code)).close()
+        except:
+            self.db.rollback()
+            raise
         self.db.commit()
+        account = Account(code, name, type)
+        self.accounts.add(account, parent_code)
+        self._notify('on_account_created', account)
 
     def get_balance_sheet(self, date):
         '''Return a balance sheet.'''
-        rows = self.db.execute('''
-        SELECT
-            a.code, a.name, a.type, SUM(
-                CASE
-                    WHEN date(t.date) <= date(?) THEN ti.amount
-                    ELSE 0
-                END
-            )
-            FROM accounts a
-            LEFT JOIN transaction_items ti ON a.code = ti.account_code
-            LEFT JOIN transactions t ON ti.transaction_id = t.id
-            GROUP BY a.code
-        ''', (date,)).fetchall()
-
-        retained_earnings = 0
-        accounts_by_type = {'asset': {}, 'liability': {}, 'equity': {}}
-        for code, name, type, balance in rows:
-            if type in ('revenue', 'expense'):
-                retained_earnings -= balance
-            else:
-                accounts_by_type[type][Account(code, name, type)] = balance
+        return self._get_cached_report(
+            ReportCache.balance_sheet_key(date),
+            self._get_balance_sheet, date
+        )
+
+    def _get_balance_sheet(self, date):
+        return _balance_sheet_from_rows(date, self._get_balances(date))
+
+    def _get_balances(self, date):
+        return self._add_accounts(self.db.execute(
+            'SELECT a.code, {} FROM accounts a'.format(
+                BALANCE_AT.format('<= ?')
+            ),
+            (_to_day(date),)
+        ))
+
+    def _add_accounts(self, rows):
+        '''Turn (code, balance) rows into (code, name, type, balance).'''
+        accounts = self._get_accounts()
+        result = []
+        for code, balance in rows:
+            account = accounts.get(code)
+            if account is None:
+                # Created by another connection after the registry synced.
+                accounts.clear()
+                account = self._get_accounts().get(code)
+            result.append(account + (balance,))
+        return result
+
+    def get_classified_balance_sheet(self, date):
+        '''Return a balance sheet with subtotals of account hierarchies.'''
+        return self._get_cached_report(
+            ReportCache.balance_sheet_key(date, classified=True),
+            self._get_classified_balance_sheet, date
+        )
 
-        return BalanceSheet(
+    def _get_classified_balance_sheet(self, date):
+        nodes = self._get_account_nodes(self.db.execute(
+            ROLL_UP.format('SELECT a.code, {} AS balance FROM accounts a'
+                           .format(BALANCE_AT.format('<= ?'))),
+            (_to_day(date),)
+        ))
+        return ClassifiedBalanceSheet(
             date=date,
-            retained_earnings=retained_earnings,
-            **accounts_by_type
+            retained_earnings=-sum(
+                node.balance for node in nodes
+                if node.account.type in ('revenue', 'expense')
+            ),
+            **_group_nodes(nodes, ('asset', 'liability', 'equity'))
         )
 
+    def _get_account_nodes(self, rows):
+        totals = dict((code, (balance, total))
+                      for code, balance, total in rows)
+        return [
+            AccountNode(account, depth, *totals.get(account.code, (0, 0)))
+            for account, depth in self._get_accounts().walk()
+        ]
+
+    def get_balance_sheet_series(self, dates, chunk_size=500):
+        '''Return a list of balance sheets on the specified dates.
+
+        Each chunk of dates is answered by one query seeking the balance of
+        every account on every date in the daily balances index.
+        '''
+        dates = sorted(dates)
+        days = sorted(set(_to_day(date) for date in dates))
+        rows_by_day = {}
+        for start in xrange(0, len(days), chunk_size):
+            chunk = days[start:start + chunk_size]
+            rows = self.db.execute('''
+            SELECT d.day, a.code, {}
+                FROM ({}) d, accounts a
+                ORDER BY d.day
+            '''.format(BALANCE_AT.format('<= d.day'),
+                       ' UNION ALL '.join(['SELECT ? AS day'] * len(chunk))),
+                chunk)
+            for day, day_rows in groupby(rows, itemgetter(0)):
+                rows_by_day[day] = self._add_accounts(
+                    row[1:] for row in day_rows
+                )
+        return [
+            _balance_sheet_from_rows(date, rows_by_day.get(_to_day(date), []))
+            for date in dates
+        ]
+
     def get_income_statement(self, start_date, end_date):
         '''Return an income statement.'''
-        rows = self.db.execute('''
-        SELECT
-            a.code, a.name, a.type, SUM(
-                CASE
-                    WHEN date(?) <= date(t.date) AND date(t.date) <= date(?)
-                        THEN ti.amount
-                    ELSE 0
-                END
-            )
+        return self._get_cached_report(
+            ReportCache.income_statement_key(start_date, end_date),
+            self._get_income_statement, start_date, end_date
+        )
+
+    def _get_income_statement(self, start_date, end_date):
+        query = '''
+        SELECT a.code, {} - {} - {}
             FROM accounts a
-            LEFT JOIN transaction_items ti ON a.code = ti.account_code
-            LEFT JOIN transactions t ON ti.transaction_id = t.id
-            WHERE a.type IN ("revenue", "expense")
-            GROUP BY a.code
-        ''', (start_date, end_date)).fetchall()
-
-        accounts_by_type = {'revenue': {}, 'expense': {}}
-        for code, name, type, balance in rows:
-            accounts_by_type[type][Account(code, name, type)] = balance
+            WHERE a.type IN ('revenue', 'expense')
+        '''.format(BALANCE_AT.format('<= ?'), BALANCE_AT.format('< ?'),
+                   CLOSED_BETWEEN)
+        rows = self.db.execute(query, (
+            _to_day(end_date), _to_day(start_date), _to_day(start_date),
+            _to_day(end_date)
+        ))
+        return _income_statement_from_rows(start_date, end_date,
+                                           self._add_accounts(rows))
 
-        return IncomeStatement(
+    def get_classified_income_statement(self, start_date, end_date):
+        '''Return an income statement with subtotals of account hierarchies.'''
+        return self._get_cached_report(
+            ReportCache.income_statement_key(start_date, end_date,
+                                             classified=True),
+            self._get_classified_income_statement, start_date, end_date
+        )
+
+    def _get_classified_income_statement(self, start_date, end_date):
+        nodes = self._get_account_nodes(self.db.execute(
+            ROLL_UP.format('''
+            SELECT a.code, {} - {} - {} AS balance
+                FROM accounts a
+                WHERE a.type IN ('revenue', 'expense')
+            '''.format(BALANCE_AT.format('<= ?'), BALANCE_AT.format('< ?'),
+                       CLOSED_BETWEEN)),
+            (_to_day(end_date), _to_day(start_date), _to_day(start_date),
+             _to_day(end_date))
+        ))
+        return ClassifiedIncomeStatement(
             start_date=start_date,
             end_date=end_date,
-            **accounts_by_type
+            **_group_nodes(nodes, ('revenue', 'expense'))
         )
 
+    def get_income_statement_series(self, start_date, end_date, period):
+        '''Return a list of income statements for consecutive periods.
+
+        The period is one of PERIODS; see split_periods. All statements are
+        computed with a single query grouping items by account and period.
+        '''
+        periods = list(split_periods(start_date, end_date, period))
+        period_starts = [_to_day(start) for start, _ in periods]
+
+        accounts = [account for account in self._get_accounts().values()
+                    if account.type in ('revenue', 'expense')]
+        balances = dict((account[0], [0] * len(periods))
+                        for account in accounts)
+        query = '''
+        SELECT ti.account_code, {} AS period_start, SUM(ti.amount)
+            FROM transactions t
+            JOIN transaction_items ti ON ti.transaction_id = t.id
+            WHERE t.date BETWEEN ? AND ?
+            GROUP BY ti.account_code, period_start
+        '''.format(PERIOD_START[period])
+        for db in self.get_partitions(start_date, end_date):
+            rows = db.execute(query, (_to_day(start_date), _to_day(end_date)))
+            for code, period_start, balance in rows:
+                if code in balances:
+                    # The first period may start after its calendar start,
+                    # which is still mapped to index 0. Periods spanning
+                    # two archived years are summed from both.
+                    balances[code][bisect_left(period_starts,
+                                               period_start)] += balance
+        for closing_date, amounts in self.get_closed_amounts(start_date,
+                                                             end_date):
+            index = bisect_left(period_starts, _to_day(closing_date) + 1) - 1
+            for code, amount in amounts.iteritems():
+                if code in balances:
+                    balances[code][index] -= amount
+
+        return [
+            _income_statement_from_rows(start, end, [
+                account + (balances[account[0]][index],)
+                for account in accounts
+            ])
+            for index, (start, end) in enumerate(periods)
+        ]
+
+    def _get_cached_report(self, key, get_report, *args):
+        if self.cache is None:
+            return get_report(*args)
+
+        version = self.cache.sync(self.db)
+        report = self.cache.get(key)
+        if report is None:
+            report = get_report(*args)
+            self.cache.put(key, report, version)
+        return report
+
     def get_account(self, code):
         '''Return the account identified by the specified code.'''
-        row = self.db.execute('SELECT * FROM accounts WHERE code = ?',
-                              (code,)).fetchone()
-        if row is None:
+        return self._get_accounts().get(code)
+
+    def get_parent_account(self, code):
+        '''Return the parent of the specified account or None.'''
+        accounts = self._get_accounts()
+        return accounts.get(accounts.get_parent_code(code))
+
+    def _get_accounts(self):
+        self.accounts.sync(self.db)
+        return self.accounts
+
+    def get_account_ledger(self, code, start_date=None, end_date=None,
+                           after_id=None, limit=None):
+        '''Return the items posted to an account with running balances.
+
+        Items are ordered by date and ID. Only the ones dated between
+        start_date and end_date and following the item identified by
+        after_id are returned; at most limit of them. Return None if the
+        account doesn't exist.
+        '''
+        account_ledger = self.iter_account_ledger(
+            code, start_date, end_date, after_id, limit
+        )
+        if account_ledger is None:
             return None
-        return Account(row[0], row[1], row[2])
+        return account_ledger._replace(items=list(account_ledger.items))
+
+    def iter_account_ledger(self, code, start_date=None, end_date=None,
+                            after_id=None, limit=None):
+        '''Like get_account_ledger but with items fetched as iterated.'''
+        account = self.get_account(code)
+        if account is None:
+            return None
+
+        conditions = ['ti.account_code = ?']
+        params = [code]
+        first_date = start_date
+        if after_id is not None:
+            # The item is looked for in the most recent partitions first.
+            for db in reversed(self.get_partitions()):
+                row = db.execute('''
+                SELECT t.date
+                    FROM transaction_items ti
+                    JOIN transactions t ON t.id = ti.transaction_id
+                    WHERE ti.id = ? AND ti.account_code = ?
+                ''', (after_id, code)).fetchone()
+                if row is not None:
+                    break
+            else:
+                raise ValueError('unknown item {} of account {}'.format(
+                    after_id, code
+                ))
+            after_date = row[0]
+            if start_date is None or start_date < _from_day(after_date):
+                first_date = _from_day(after_date)
+            opening_balance = self._get_balance_before(code, after_date)
+            opening_balance += db.execute('''
+            SELECT COALESCE(SUM(ti.amount), 0)
+                FROM transaction_items ti
+                JOIN transactions t ON t.id = ti.transaction_id
+                WHERE ti.account_code = ? AND t.date = ? AND ti.id <= ?
+            ''', (code, after_date, after_id)).fetchone()[0]
+            conditions.append('(t.date, ti.id) > (?, ?)')
+            params.extend([after_date, after_id])
+        elif start_date is not None:
+            opening_balance = self._get_balance_before(
+                code, _to_day(start_date)
+            )
+        else:
+            opening_balance = 0
+
+        if start_date is not None:
+            conditions.append('t.date >= ?')
+            params.append(_to_day(start_date))
+        if end_date is not None:
+            conditions.append('t.date <= ?')
+            params.append(_to_day(end_date))
+        query = '''
+        SELECT ti.id, t.id, t.date, t.description, ti.amount,
+               ? + SUM(ti.amount) OVER (ORDER BY t.date, ti.id)
+            FROM transaction_items ti
+            JOIN transactions t ON t.id = ti.transaction_id
+            WHERE {}
+            ORDER BY t.date, ti.id
+            LIMIT ?
+        '''.format(' AND '.join(conditions))
+
+        return AccountLedger(
+            account=account,
+            opening_balance=opening_balance,
+            items=self._iter_account_ledger_items(
+                self.get_partitions(first_date, end_date), query, params,
+                opening_balance, limit
+            )
+        )
+
+    def _iter_account_ledger_items(self, partitions, query, params,
+                                   opening_balance, limit):
+        # Partitions are in date order so the items of each one continue
+        # the running balance of the previous one.
+        count = 0
+        running_balance = opening_balance
+        for db in partitions:
+            remaining = -1 if limit is None else limit - count
+            if remaining == 0:
+                break
+            rows = db.execute(query,
+                              [running_balance] + params + [remaining])
+            for item_id, tx_id, date, description, amount, balance in rows:
+                yield AccountLedgerItem(item_id, tx_id, _from_day(date),
+                                        description, amount, balance)
+                count += 1
+                running_balance = balance
+
+    def _get_balance_before(self, code, date):
+        row = self.db.execute('''
+        SELECT balance
+            FROM account_daily_balances
+            WHERE account_code = ? AND date < ?
+            ORDER BY date DESC
+            LIMIT 1
+        ''', (code, date)).fetchone()
+        return 0 if row is None else row[0]
 
     def record_transaction(self, date, description, items):
         '''Record a transaction.'''
-        if not items:
-            raise ValueError('cannot record an empty transaction')
-        if sum(item[1] for item in items) != 0:
-            raise ValueError('unbalanced transaction items')
+        _validate_items(items)
+        accounts = self._get_accounts()
+        for account_code, _ in items:
+            if account_code not in accounts:
+                raise ValueError(
+                    'unknown account code {}'.format(account_code)
+                )
 
         try:
             c = self.db.cursor()
+            tx_id = self._insert_transaction(c, date, description, items)
+        except:
+            self.db.rollback()
+            raise
+        finally:
+            c.close()
+
+        self.db.commit()
+        self._notify('on_transaction_recorded', tx_id,
+                     Transaction(date, description, items))
+        return tx_id
+
+    def _insert_transaction(self, cursor, date, description, items):
+        cursor.execute(
+            'INSERT INTO transactions(date, description) VALUES (?, ?)',
+            (_to_day(date), description)
+        )
+        tx_id = cursor.lastrowid
+        # Checked once the write lock is held so that the date can't be
+        # closed or archived meanwhile.
+        self._check_dates_open(cursor, [date])
+
+        cursor.executemany(
+            '''INSERT INTO transaction_items(transaction_id, account_code,
+                                            amount)
+               VALUES (?, ?, ?)''',
+            [(tx_id, account_code, amount)
+             for account_code, amount in items]
+        )
+
+        amounts_by_account = {}
+        for account_code, amount in items:
+            amounts_by_account[account_code] = (
+                amounts_by_account.get(account_code, 0) + amount
+            )
+        for account_code, amount in amounts_by_account.iteritems():
+            self._post_daily_balance(cursor, account_code, date, amount)
+        self._post_totals(cursor, amounts_by_account)
+        return tx_id
+
+    def record_transactions(self, transactions, batch_size=1000):
+        '''Record many transactions committing once per batch.
+
+        The transactions are (date, description, items) tuples. They are
+        consumed lazily so a generator reading from a file works, too. If a
+        transaction is invalid the batch containing it is rolled back and the
+        error is raised; batches committed earlier remain recorded.
+
+        The error raised gets two attributes: transaction_ids, the IDs of
+        the transactions committed before it, and index, the position of
+        the failing transaction. If the database rejected the batch as a
+        whole, index is the position of the first transaction of the batch.
+
+        Return the list of the IDs of the recorded transactions.
+        '''
+        accounts = self._get_accounts()
+
+        tx_ids = []
+        batch = []
+        try:
+            for transaction in transactions:
+                batch.append(transaction)
+                if len(batch) >= batch_size:
+                    tx_ids.extend(self._record_batch(batch, accounts))
+                    batch = []
+            if batch:
+                tx_ids.extend(self._record_batch(batch, accounts))
+        except Exception as exc:
+            exc.transaction_ids = tx_ids
+            # Errors reading the transactions leave batch_index unset.
+            exc.index = len(tx_ids) + getattr(exc, 'batch_index', len(batch))
+            raise
+        return tx_ids
+
+    def _record_batch(self, transactions, accounts):
+        amounts = {}
+        for index, (date, description, items) in enumerate(transactions):
+            try:
+                _validate_items(items)
+                for account_code, amount in items:
+                    if account_code not in accounts:
+                        raise ValueError(
+                            'unknown account code {}'.format(account_code)
+                        )
+                    key = (account_code, date)
+                    amounts[key] = amounts.get(key, 0) + amount
+            except ValueError as exc:
+                exc.batch_index = index
+                raise
+
+        c = self.db.cursor()
+        try:
+            # The first insert takes the write lock so the IDs following the
+            # one assigned by SQLite can be allocated without a race.
+            date, description, _ = transactions[0]
             c.execute(
                 'INSERT INTO transactions(date, description) VALUES (?, ?)',
-                (date.strftime('%Y-%m-%d'), description)
+                (_to_day(date), description)
+            )
+            tx_ids = range(c.lastrowid, c.lastrowid + len(transactions))
+            self._check_dates_open(
+                c, [date for date, _, _ in transactions]
+            )
+
+            c.executemany(
+                '''INSERT INTO transactions(id, date, description)
+                   VALUES (?, ?, ?)''',
+                [
+                    (tx_id, _to_day(date), description)
+                    for tx_id, (date, description, _)
+                    in zip(tx_ids[1:], transactions[1:])
+                ]
+            )
+            c.executemany(
+                '''INSERT INTO transaction_items(transaction_id, account_code,
+                                                amount)
+                   VALUES (?, ?, ?)''',
+                [
+                    (tx_id, account_code, amount)
+                    for tx_id, (_, _, items) in zip(tx_ids, transactions)
+                    for account_code, amount in items
+                ]
             )
-            tx_id = c.lastrowid
 
-            for account_code, amount in items:
-                c.execute(
-                    'SELECT 1 FROM accounts WHERE code = ?',
-                    (account_code,)
+            # Posting in date order means the daily balances updated for each
+            # day are only the ones just created.
+            amounts_by_account = {}
+            for (account_code, date), amount in sorted(
+                    amounts.iteritems(), key=lambda item: item[0][1]):
+                self._post_daily_balance(c, account_code, date, amount)
+                amounts_by_account[account_code] = (
+                    amounts_by_account.get(account_code, 0) + amount
                 )
-                if c.fetchone() is None:
-                    raise ValueError(
-                        'unknown account code {}'.format(account_code)
-                    )
-                c.execute('''INSERT INTO transaction_items(transaction_id,
-                                                           account_code,
-                                                           amount)
-                                                           VALUES (?, ?, ?)''',
-                          (tx_id, account_code, amount))
-        except:
+            self._post_totals(c, amounts_by_account)
+        except BaseException as exc:
             self.db.rollback()
+            exc.batch_index = 0
             raise
         finally:
             c.close()
 
         self.db.commit()
-        return tx_id
+        for tx_id, transaction in zip(tx_ids, transactions):
+            self._notify('on_transaction_recorded', tx_id,
+                         Transaction(*transaction))
+        return tx_ids
+
+    def _notify(self, event, *args):
+        # The write has already been committed so a failing listener must
+        # neither fail it nor keep the others from being notified.
+        for listener in self.listeners:
+            try:
+                getattr(listener, event)(*args)
+            except Exception:
+                _logger.exception('%r failed to handle %s', listener, event)
+
+    def _post_daily_balance(self, cursor, account_code, date, amount):
+        date = _to_day(date)
+        cursor.execute('''
+        INSERT OR IGNORE INTO account_daily_balances(account_code, date,
+                                                     balance)
+            SELECT ?, ?, COALESCE((
+                SELECT balance
+                    FROM account_daily_balances
+                    WHERE account_code = ? AND date < ?
+                    ORDER BY date DESC
+                    LIMIT 1
+            ), 0)
+        ''', (account_code, date, account_code, date))
+        cursor.execute('''
+        UPDATE account_daily_balances
+            SET balance = balance + ?
+            WHERE account_code = ? AND date >= ?
+        ''', (amount, account_code, date))
+
+    def _post_totals(self, cursor, amounts_by_account):
+        cursor.executemany('''
+        UPDATE account_totals SET balance = balance + ? WHERE account_code = ?
+        ''', [(amount, account_code)
+              for account_code, amount in amounts_by_account.iteritems()])
+
+    def get_account_balance(self, code):
+        '''Return the current balance of an account or None.'''
+        row = self.db.execute(
+            'SELECT balance FROM account_totals WHERE account_code = ?',
+            (code,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def get_trial_balance(self, date=None):
+        '''Return a trial balance on a date or, by default, the current one.'''
+        if date is None:
+            rows = self._add_accounts(self.db.execute(
+                'SELECT account_code, balance FROM account_totals'
+            ))
+        else:
+            rows = self._get_balances(date)
+        return TrialBalance(
+            date=date,
+            accounts=dict((Account(code, name, type), balance)
+                          for code, name, type, balance in rows)
+        )
 
     def count_transactions(self):
         '''Return the number of transactions.'''
-        return self.db.execute(
-            'SELECT COUNT(*) FROM transactions'
-        ).fetchone()[0]
+        return sum(
+            db.execute('SELECT COUNT(*) FROM transactions').fetchone()[0]
+            for db in self.get_partitions()
+        )
 
     def count_transaction_items(self):
         '''Return the number of transaction items.'''
-        return self.db.execute(
-            'SELECT COUNT(*) FROM transaction_items'
-        ).fetchone()[0]
+        return sum(
+            db.execute('SELECT COUNT(*) FROM transaction_items').fetchone()[0]
+            for db in self.get_partitions()
+        )
+
+    def get_transactions(self, **kwargs):
+        '''Return registered transactions.
+
+        The keyword arguments are the same as the ones of iter_transactions.
+        '''
+        return [tx for _, tx in self.iter_transactions(**kwargs)]
+
+    def iter_transactions(self, after_id=None, limit=None, start_date=None,
+                          end_date=None, account_code=None, page_size=500):
+        '''Iterate over (ID, transaction) pairs ordered by ID.
+
+        Only transactions with IDs greater than after_id, dated between
+        start_date and end_date and affecting account_code are returned; at
+        most limit of them. Transactions are read page_size at a time so
+        memory use doesn't depend on the size of the ledger.
+        '''
+        partitions = self.get_partitions(start_date, end_date)
+        if len(partitions) == 1:
+            return self._iter_transactions(
+                self.db, after_id, limit, start_date, end_date, account_code,
+                page_size
+            )
+        # IDs are unique across partitions so merging the (ID, transaction)
+        # pairs never compares transactions.
+        return islice(heapq.merge(*[
+            self._iter_transactions(db, after_id, limit, start_date,
+                                    end_date, account_code, page_size)
+            for db in partitions
+        ]), limit)
+
+    def _iter_transactions(self, db, after_id, limit, start_date, end_date,
+                           account_code, page_size):
+        conditions = ['id > ?']
+        params = [after_id or 0]
+        if start_date is not None:
+            conditions.append('date >= ?')
+            params.append(_to_day(start_date))
+        if end_date is not None:
+            conditions.append('date <= ?')
+            params.append(_to_day(end_date))
+        if account_code is not None:
+            conditions.append('''id IN (
+                SELECT transaction_id
+                    FROM transaction_items
+                    WHERE account_code = ?
+            )''')
+            params.append(account_code)
+        query = '''
+        SELECT id, date, description
+            FROM transactions
+            WHERE {}
+            ORDER BY id
+            LIMIT ?
+        '''.format(' AND '.join(conditions))
 
-    def get_transactions(self):
-        '''Return all registered transactions.'''
-        txs = {}
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = page_size if remaining is None else min(page_size,
+                                                           remaining)
+            rows = db.execute(query, params + [size]).fetchall()
+            if not rows:
+                return
 
-        rows = self.db.execute('SELECT * FROM transactions').fetchall()
-        for tx_id, date, description in rows:
-            date = datetime.strptime(date, '%Y-%m-%d').date()
-            txs[tx_id] = Transaction(date, description, [])
+            items = {}
+            item_rows = db.execute('''
+            SELECT transaction_id, account_code, amount
+                FROM transaction_items
+                WHERE transaction_id IN ({})
+                ORDER BY id
+            '''.format(', '.join('?' * len(rows))), [row[0] for row in rows])
+            for tx_id, account_code, amount in item_rows:
+                items.setdefault(tx_id, []).append((account_code, amount))
 
-        rows = self.db.execute('SELECT * FROM transaction_items').fetchall()
-        for _, tx_id, account_code, amount in rows:
-            txs[tx_id].items.append((account_code, amount))
+            for tx_id, date, description in rows:
+                yield tx_id, Transaction(_from_day(date), description,
+                                         items[tx_id])
 
-        return txs.values()
+            if len(rows) < size:
+                return
+            params[0] = rows[-1][0]
+            if remaining is not None:
+                remaining -= len(rows)
 
     def get_transaction(self, tx_id):
         '''Return the specified transaction.'''
-        row = self.db.execute('SELECT * FROM transactions WHERE id = ?',
-                              (tx_id,)).fetchone()
-        if row is None:
-            return None
+        for _, transaction in self.get_transactions_by_ids([tx_id]):
+            return transaction
+        return None
+
+    def get_transactions_by_ids(self, tx_ids, chunk_size=500):
+        '''Return a list of (ID, transaction) pairs ordered by ID.
+
+        Transactions are read with one query per chunk_size IDs. Unknown IDs
+        are skipped.
+        '''
+        tx_ids = sorted(set(tx_ids))
+        transactions = self._get_transactions_by_ids(self.db, tx_ids,
+                                                     chunk_size)
+        found_ids = set(tx_id for tx_id, _ in transactions)
+        for _, path, first_id, last_id in self._get_archives():
+            archived_ids = [
+                tx_id for tx_id in tx_ids
+                if first_id <= tx_id <= last_id and tx_id not in found_ids
+            ]
+            if archived_ids:
+                transactions.extend(self._get_transactions_by_ids(
+                    self._open_archive(path), archived_ids, chunk_size
+                ))
+        transactions.sort(key=itemgetter(0))
+        return transactions
+
+    def _get_transactions_by_ids(self, db, tx_ids, chunk_size):
+        transactions = []
+        for start in xrange(0, len(tx_ids), chunk_size):
+            chunk = tx_ids[start:start + chunk_size]
+            rows = db.execute('''
+            SELECT t.id, t.date, t.description, ti.account_code, ti.amount
+                FROM transactions t
+                JOIN transaction_items ti ON ti.transaction_id = t.id
+                WHERE t.id IN ({})
+                ORDER BY t.id, ti.id
+            '''.format(', '.join('?' * len(chunk))), chunk)
+            for tx_id, tx_rows in groupby(rows, itemgetter(0)):
+                tx_rows = list(tx_rows)
+                transactions.append((tx_id, Transaction(
+                    _from_day(tx_rows[0][1]), tx_rows[0][2],
+                    [(row[3], row[4]) for row in tx_rows]
+                )))
+        return transactions
+
+
+def _balance_sheet_from_rows(date, rows):
+    retained_earnings = 0
+    accounts_by_type = {'asset': {}, 'liability': {}, 'equity': {}}
+    for code, name, type, balance in rows:
+        if type in ('revenue', 'expense'):
+            retained_earnings -= balance
+        else:
+            accounts_by_type[type][Account(code, name, type)] = balance
+
+    return BalanceSheet(
+        date=date,
+        retained_earnings=retained_earnings,
+        **accounts_by_type
+    )
+
+
+def _income_statement_from_rows(start_date, end_date, rows):
+    accounts_by_type = {'revenue': {}, 'expense': {}}
+    for code, name, type, balance in rows:
+        accounts_by_type[type][Account(code, name, type)] = balance
+
+    return IncomeStatement(
+        start_date=start_date,
+        end_date=end_date,
+        **accounts_by_type
+    )
+
+
+def _sum_closed_amounts(closings, start_date, end_date):
+    '''Sum the amounts of closings dated in a range by account code.
+
+    The closings are (date, {account code: amount}) pairs as returned by
+    Ledger.get_closed_amounts.
+    '''
+    totals = {}
+    for date, amounts in closings:
+        if start_date <= date <= end_date:
+            for code, amount in amounts.iteritems():
+                totals[code] = totals.get(code, 0) + amount
+    return totals
+
+
+def _group_nodes(nodes, types):
+    nodes_by_type = dict((type, []) for type in types)
+    for node in nodes:
+        if node.account.type in nodes_by_type:
+            nodes_by_type[node.account.type].append(node)
+    return nodes_by_type
+
+
+def _validate_items(items):
+    if not items:
+        raise ValueError('cannot record an empty transaction')
+    if sum(item[1] for item in items) != 0:
+        raise ValueError('unbalanced transaction items')
+
+
+# Whether SQLite supports URI filenames; see _supports_uri_filenames.
+_uri_filenames = None
+
+
+def _connect_archive(path):
+    '''Open an archive database; see Ledger.archive_year.'''
+    if not os.path.exists(path):
+        raise LedgerError('The archive "{}" is missing'.format(path))
+    if _supports_uri_filenames():
+        return sqlite3.connect('file:{}?mode=ro&immutable=1'.format(
+            urllib.quote(path)
+        ))
+    return sqlite3.connect(path)
+
+
+def _supports_uri_filenames():
+    '''Return whether archives can be opened read-only and immutable.'''
+    global _uri_filenames
+    if _uri_filenames is None:
+        db = sqlite3.connect(':memory:')
+        try:
+            _uri_filenames = any(
+                row[0] == 'USE_URI'
+                for row in db.execute('PRAGMA compile_options')
+            )
+        finally:
+            db.close()
+    return _uri_filenames
+
+
+def _get_archived_amounts(path):
+    '''Return the daily amounts of an archive; run by worker processes.'''
+    archive = _connect_archive(path)
+    try:
+        return archive.execute(DAILY_AMOUNTS).fetchall()
+    finally:
+        archive.close()
+
+
+_DATE_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2})\Z')
+_dates_by_string = {}
+_dates_by_day = {}
+# Bound the caches so that arbitrary input can't grow them indefinitely.
+_DATE_CACHE_SIZE = 100000
+
+
+def parse_date(value):
+    '''Parse a YYYY-MM-DD date; raise ValueError if it's invalid.
+
+    Same as datetime.strptime(value, '%Y-%m-%d').date() but much faster for
+    zero-padded dates, especially ones seen before.
+    '''
+    date = _dates_by_string.get(value)
+    if date is None:
+        match = _DATE_PATTERN.match(value)
+        if match is None:
+            # strptime also accepts months and days that aren't zero-padded.
+            date = datetime.strptime(value, '%Y-%m-%d').date()
+        else:
+            date = _date(*[int(part) for part in match.groups()])
+        if len(_dates_by_string) >= _DATE_CACHE_SIZE:
+            _dates_by_string.clear()
+        _dates_by_string[value] = date
+    return date
+
 
-        date = datetime.strptime(row[1], '%Y-%m-%d').date()
-        description = row[2]
+def _to_day(date):
+    return date.toordinal()
 
-        items = []
-        rows = self.db.execute(
-            'SELECT * FROM transaction_items WHERE transaction_id = ?',
-            (tx_id,)
-        ).fetchall()
-        for row in rows:
-            items.append((row[2], row[3]))
 
-        return Transaction(date, description, items)
+def _from_day(day):
+    date = _dates_by_day.get(day)
+    if date is None:
+        date = _date.fromordinal(day)
+        if len(_dates_by_day) >= _DATE_CACHE_SIZE:
+            _dates_by_day.clear()
+        _dates_by_day[day] = date
+    return date
+
+
+PERIODS = ('day', 'week', 'month', 'quarter', 'year')
+
+
+def split_periods(start_date, end_date, period):
+    '''Iterate over (start, end) of calendar periods covering a date range.
+
+    The first and the last period are truncated to the range.
+    '''
+    if period not in PERIODS:
+        raise ValueError('unknown period {}'.format(period))
+
+    while start_date <= end_date:
+        next_start_date = _get_next_period_start(start_date, period)
+        yield start_date, min(next_start_date - timedelta(1), end_date)
+        start_date = next_start_date
+
+
+def _get_next_period_start(date, period):
+    if period == 'day':
+        return date + timedelta(1)
+    if period == 'week':
+        return date + timedelta(7 - date.weekday())
+    if period == 'year':
+        return _date(date.year + 1, 1, 1)
+
+    month = date.month - 1
+    if period == 'quarter':
+        month -= month % 3
+    months = date.year * 12 + month + (3 if period == 'quarter' else 1)
+    return _date(months // 12, months % 12 + 1, 1)
 
 
 class LedgerError(RuntimeError):
     pass
 
 
+class AccountRegistry(object):
+    '''The chart of accounts of a database connection kept in memory.
+
+    The registry is loaded on first use and reloaded after another
+    connection commits a change to the database, as reported by PRAGMA
+    data_version. Changes made through the connection itself aren't
+    reported so the ledger adds new accounts to the registry directly.
+    '''
+
+    def __init__(self):
+        self.version = 0
+        self._accounts = None
+        self._parent_codes = None
+        self._tree = None
+        self._data_version = None
+
+    def sync(self, db):
+        '''Reload the accounts if the database was changed elsewhere.'''
+        data_version = db.execute('PRAGMA data_version').fetchone()[0]
+        if self._accounts is None or data_version != self._data_version:
+            self._accounts = {}
+            self._parent_codes = {}
+            self._tree = None
+            rows = db.execute(
+                'SELECT code, name, type, parent_code FROM accounts'
+            )
+            for code, name, type, parent_code in rows:
+                self._accounts[code] = Account(code, name, type)
+                self._parent_codes[code] = parent_code
+            self._data_version = data_version
+            self.version += 1
+
+    def get(self, code):
+        '''Return the account with the specified code or None.'''
+        return self._accounts.get(code)
+
+    def get_parent_code(self, code):
+        '''Return the code of the parent of an account or None.'''
+        return self._parent_codes.get(code)
+
+    def values(self):
+        '''Return a list of all accounts.'''
+        return self._accounts.values()
+
+    def walk(self):
+        '''Return a list of (account, depth) of all accounts.
+
+        Every account is followed by its descendants; siblings are ordered
+        by code.
+        '''
+        if self._tree is None:
+            children = {}
+            for code in sorted(self._accounts, reverse=True):
+                children.setdefault(self._parent_codes[code], []).append(code)
+            self._tree = []
+            stack = [(code, 0) for code in children.get(None, [])]
+            while stack:
+                code, depth = stack.pop()
+                self._tree.append((self._accounts[code], depth))
+                stack.extend((child, depth + 1)
+                             for child in children.get(code, []))
+        return self._tree
+
+    def add(self, account, parent_code=None):
+        '''Register an account created through the connection.'''
+        if self._accounts is not None:
+            self._accounts[account.code] = account
+            self._parent_codes[account.code] = parent_code
+            self._tree = None
+            self.version += 1
+
+    def clear(self):
+        '''Forget all accounts; they're reloaded on the next sync.'''
+        self._accounts = None
+
+    def __contains__(self, code):
+        return code in self._accounts
+
+
+class ReportCache(object):
+    '''A thread-safe LRU cache of balance sheets and income statements.
+
+    The cache can be shared by all ledgers using the same database. Writes
+    are detected on read by comparing the highest transaction ID and the
+    number of accounts with the ones seen last time, so writes made by other
+    connections and processes are noticed, too. A new transaction evicts
+    only the reports it could have affected: balance sheets on or after its
+    date and income statements covering it. A new account evicts everything.
+    '''
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._token = binascii.hexlify(os.urandom(4))
+        self._entries = OrderedDict()
+        self._state = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def balance_sheet_key(date, classified=False):
+        key = ('balance_sheet', date)
+        return key + ('classified',) if classified else key
+
+    @staticmethod
+    def income_statement_key(start_date, end_date, classified=False):
+        key = ('income_statement', start_date, end_date)
+        return key + ('classified',) if classified else key
+
+    def sync(self, db):
+        '''Evict reports affected by writes since the last call.
+
+        Return the cache version to pass to put.
+        '''
+        with self._lock:
+            previous_state = self._state
+        state = db.execute('''
+        SELECT COALESCE((SELECT MAX(id) FROM transactions), 0),
+               (SELECT COUNT(*) FROM accounts)
+        ''').fetchone()
+
+        # The affected dates are found before taking the lock; None means
+        # everything is affected.
+        affected = ()
+        if previous_state is not None and state != previous_state:
+            last_tx_id, account_count = previous_state
+            if state[0] < last_tx_id or state[1] != account_count:
+                affected = None
+            else:
+                affected = db.execute('''
+                SELECT MIN(date), MAX(date) FROM transactions WHERE id > ?
+                ''', (last_tx_id,)).fetchone()
+
+        # The state is swapped and the reports evicted at once so no other
+        # thread sees the new state while stale reports are still cached.
+        with self._lock:
+            if self._state != previous_state:
+                # Another thread synced meanwhile, possibly to a different
+                # state; unless it's this one evict everything to be safe.
+                if self._state != state:
+                    self._clear()
+            elif affected is None:
+                self._clear()
+            elif affected:
+                self._invalidate(_from_day(affected[0]),
+                                 _from_day(affected[1]))
+            self._state = state
+            return self.version
+
+    def get(self, key):
+        '''Return the cached report or None.'''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, report, version):
+        '''Cache a report computed at the specified cache version.'''
+        with self._lock:
+            # Something was invalidated while the report was being computed
+            # so it may be stale.
+            if version != self.version:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (version, report)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_etag(self, key):
+        '''Return an entity tag of the cached report or None.'''
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return '{}-{}-{}'.format(
+            self._token, entry[0], '-'.join(str(part) for part in key)
+        )
+
+    def invalidate(self, start_date, end_date):
+        '''Evict reports affected by transactions in the date range.'''
+        with self._lock:
+            self._invalidate(start_date, end_date)
+
+    def clear(self):
+        '''Evict all reports.'''
+        with self._lock:
+            self._clear()
+
+    def _invalidate(self, start_date, end_date):
+        self.version += 1
+        for key in self._entries.keys():
+            if key[0] == 'balance_sheet':
+                affected = key[1] >= start_date
+            else:
+                affected = key[1] <= end_date and key[2] >= start_date
+            if affected:
+                del self._entries[key]
+
+    def _clear(self):
+        self.version += 1
+        self._entries.clear()
+
+
 Account = namedtuple('Account', 'code name type')
 Transaction = namedtuple('Transaction', 'date description items')
+AccountLedger = namedtuple('AccountLedger', 'account opening_balance items')
+AccountLedgerItem = namedtuple(
+    'AccountLedgerItem', 'id transaction_id date description amount balance'
+)
+# An account in a classified report with its own balance and the total of
+# the balances of it and its descendants.
+AccountNode = namedtuple('AccountNode', 'account depth balance total')
+# The balances of accounts, including the closing entry, are the opening
+# balances of the next period.
+PeriodClosing = namedtuple(
+    'PeriodClosing', 'end_date transaction_id retained_earnings balances'
+)
 
 
 class BalanceSheet(namedtuple('BalanceSheet',
@@ -234,6 +1851,37 @@ class BalanceSheet(namedtuple('BalanceSheet',
         return -sum(self.equity.itervalues()) + self.retained_earnings
 
 
+class ClassifiedBalanceSheet(BalanceSheet):
+    '''A balance sheet whose asset, liability and equity are AccountNode lists.
+
+    Every account is followed by its descendants; see AccountRegistry.walk.
+    '''
+
+    @property
+    def total_assets(self):
+        return _sum_roots(self.asset)
+
+    @property
+    def total_liabilities(self):
+        return -_sum_roots(self.liability)
+
+    @property
+    def total_equity(self):
+        return -_sum_roots(self.equity) + self.retained_earnings
+
+
+class TrialBalance(namedtuple('TrialBalance', 'date accounts')):
+    @property
+    def total_debits(self):
+        return sum(balance for balance in self.accounts.itervalues()
+                   if balance > 0)
+
+    @property
+    def total_credits(self):
+        return -sum(balance for balance in self.accounts.itervalues()
+                    if balance < 0)
+
+
 class IncomeStatement(namedtuple('_IncomeStatement',
                                  'start_date end_date revenue expense')):
     @property
@@ -259,3 +1907,22 @@ class IncomeStatement(namedtuple('_IncomeStatement',
         if self.net_result < 0:
             return - self.net_result
         return 0
+
+
+class ClassifiedIncomeStatement(IncomeStatement):
+    '''An income statement whose revenue and expense are AccountNode lists.
+
+    Every account is followed by its descendants; see AccountRegistry.walk.
+    '''
+
+    @property
+    def total_revenues(self):
+        return -_sum_roots(self.revenue)
+
+    @property
+    def total_expenses(self):
+        return _sum_roots(self.expense)
+
+
+def _sum_roots(nodes):
+    return sum(node.total for node in nodes if node.depth == 0)
@@ -1,9 +1,11 @@
 from datetime import date
+import os
 import unittest
 import sqlite3
 
-from ledger import Account, BalanceSheet, IncomeStatement, Ledger, \
-    LedgerError, Transaction
+from benchmarks.generator import populate
+from ledger import Account, AccountNode, BalanceSheet, IncomeStatement, \
+    Ledger, LedgerError, ReportCache, Transaction, parse_date, split_periods
 
 
 class LedgerTestCase(unittest.TestCase):
@@ -12,6 +14,62 @@ class LedgerTestCase(unittest.TestCase):
         self.ledger = Ledger(self.db)
         self.ledger.reset()
 
+    def test_init_migrates_schema(self):
+        self.assertEqual(len(Ledger.MIGRATIONS),
+                         self.ledger.get_schema_version())
+
+        indexes = set(row[0] for row in self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        ))
+        self.assertIn('transactions_date', indexes)
+        self.assertIn('transaction_items_transaction_id', indexes)
+        self.assertIn('transaction_items_account_code', indexes)
+
+    def test_migrate_is_idempotent(self):
+        self.ledger.migrate()
+        self.ledger.init()
+
+        self.assertEqual(len(Ledger.MIGRATIONS),
+                         self.ledger.get_schema_version())
+
+    def test_migrate_string_dates(self):
+        self.ledger.drop()
+        # The schema before dates were stored as day ordinals.
+        self.ledger.MIGRATIONS = Ledger.MIGRATIONS[:4]
+        self.ledger.init()
+        self.db.executescript('''
+        INSERT INTO accounts(code, name, type)
+            VALUES ('101', 'Cash', 'asset'), ('401', 'Revenue', 'revenue');
+        INSERT INTO transactions(id, date, description)
+            VALUES (1, '2016-09-01', 'Consulting'),
+                   (2, '2016-10-03', 'Consulting');
+        INSERT INTO transaction_items(transaction_id, account_code, amount)
+            VALUES (1, '101', 5000), (1, '401', -5000),
+                   (2, '101', 7000), (2, '401', -7000);
+        ''')
+        self.ledger.rebuild_balances()
+
+        del self.ledger.MIGRATIONS
+        self.ledger.migrate()
+
+        self.assertEqual(
+            Transaction(date(2016, 10, 3), 'Consulting',
+                        [('101', 7000), ('401', -7000)]),
+            self.ledger.get_transaction(2)
+        )
+        self.assertEqual(
+            {Account('101', 'Cash', 'asset'): 5000},
+            self.ledger.get_balance_sheet(date(2016, 9, 30)).asset
+        )
+        self.assertEqual(
+            [7000],
+            [statement.total_revenues
+             for statement in self.ledger.get_income_statement_series(
+                 date(2016, 10, 1), date(2016, 10, 31), 'month'
+             )]
+        )
+        self.assertEqual([], self.ledger.check_balances())
+
     def test_create_account(self):
         self.ledger.create_account('101', 'Cash', 'asset')
         self.ledger.create_account('201', 'Bank Loan', 'liability')
@@ -53,6 +111,26 @@ class LedgerTestCase(unittest.TestCase):
                                      [('101', 500000), ('301', -500000)]),
                          self.ledger.get_transaction(tx_id))
 
+    def test_failing_listener(self):
+        class Listener(object):
+            def __init__(self):
+                self.tx_ids = []
+
+            def on_transaction_recorded(self, tx_id, transaction):
+                self.tx_ids.append(tx_id)
+                raise KeyError(tx_id)
+
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('301', 'Share Capital', 'equity')
+        listeners = [Listener(), Listener()]
+        self.ledger.listeners.extend(listeners)
+
+        # Listeners are notified after the commit; their errors are logged.
+        tx_id = self.ledger.record_transaction(date(2016, 9, 1), 'Investment',
+                                               [('101', 5), ('301', -5)])
+        self.assertEqual([[tx_id], [tx_id]],
+                         [listener.tx_ids for listener in listeners])
+
     def test_record_transaction_unknown_account(self):
         with self.assertRaises(ValueError):
             self.ledger.record_transaction(
@@ -67,6 +145,26 @@ class LedgerTestCase(unittest.TestCase):
         self.assertEqual(0, self.ledger.count_transactions())
         self.assertEqual(0, self.ledger.count_transaction_items())
 
+    def test_accounts_created_by_other_connections(self):
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.assertEqual(Account('101', 'Cash', 'asset'),
+                         self.ledger.get_account('101'))
+
+        other_db = sqlite3.connect('test.sqlite3')
+        Ledger(other_db).create_account('301', 'Share Capital', 'equity')
+        other_db.close()
+
+        self.assertEqual(Account('301', 'Share Capital', 'equity'),
+                         self.ledger.get_account('301'))
+        self.ledger.record_transaction(date(2016, 9, 1), 'Investment',
+                                       [('101', 500000), ('301', -500000)])
+        self.assertEqual(
+            {Account('301', 'Share Capital', 'equity'): -500000},
+            self.ledger.get_balance_sheet(date(2016, 9, 1)).equity
+        )
+        with self.assertRaises(LedgerError):
+            self.ledger.create_account('301', 'Share Capital', 'equity')
+
     def test_record_transaction_no_items(self):
         self.ledger.create_account('101', 'Cash', 'asset')
         self.ledger.create_account('301', 'Share Capital', 'equity')
@@ -78,9 +176,100 @@ class LedgerTestCase(unittest.TestCase):
                 []
             )
 
+    def test_record_transactions(self):
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('102', 'Equipment', 'asset')
+        self.ledger.create_account('301', 'Share Capital', 'equity')
+
+        tx_ids = self.ledger.record_transactions(
+            iter([
+                (date(2016, 9, 2), "Buy a laptop",
+                 [('101', -100000), ('102', 100000)]),
+                (date(2016, 9, 1), "Record the funder's investment",
+                 [('101', 500000), ('301', -500000)]),
+            ]),
+            batch_size=1
+        )
+
+        self.assertEqual(2, len(tx_ids))
+        self.assertEqual(Transaction(date(2016, 9, 2), "Buy a laptop",
+                                     [('101', -100000), ('102', 100000)]),
+                         self.ledger.get_transaction(tx_ids[0]))
+        self.assertEqual(
+            {
+                Account('101', 'Cash', 'asset'): 400000,
+                Account('102', 'Equipment', 'asset'): 100000,
+            },
+            self.ledger.get_balance_sheet(date(2016, 9, 2)).asset
+        )
+
+    def test_record_transactions_invalid(self):
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('301', 'Share Capital', 'equity')
+
+        with self.assertRaises(ValueError):
+            self.ledger.record_transactions(
+                [
+                    (date(2016, 9, 1), "Record the funder's investment",
+                     [('101', 500000), ('301', -500000)]),
+                    (date(2016, 9, 2), "Buy a laptop",
+                     [('101', -100000), ('102', 100000)]),
+                    (date(2016, 9, 3), "Record another investment",
+                     [('101', 500000), ('301', -500000)]),
+                ],
+                batch_size=2
+            )
+
+        self.assertEqual(0, self.ledger.count_transactions())
+        self.assertEqual(0, self.ledger.count_transaction_items())
+
+    def test_record_transactions_later_batch_invalid(self):
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('301', 'Share Capital', 'equity')
+        transactions = [
+            (date(2016, 9, day), 'Investment',
+             [('101', 100), ('301', -100)])
+            for day in range(1, 6)
+        ]
+        transactions[3] = (date(2016, 9, 4), 'Unbalanced', [('101', 100)])
+
+        with self.assertRaises(ValueError) as context:
+            self.ledger.record_transactions(transactions, batch_size=2)
+
+        self.assertEqual([1, 2], context.exception.transaction_ids)
+        self.assertEqual(3, context.exception.index)
+        self.assertEqual(2, self.ledger.count_transactions())
+
     def test_get_transaction_non_existent(self):
         self.assertIsNone(self.ledger.get_transaction(1))
 
+    def test_get_transactions_by_ids(self):
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('301', 'Share Capital', 'equity')
+        self.ledger.create_account('401', 'Revenue', 'revenue')
+        self.ledger.record_transactions([
+            (date(2016, 9, day), 'Transaction #{}'.format(day),
+             [('101', day * 100), ('301', -day * 50), ('401', -day * 50)])
+            for day in range(1, 8)
+        ])
+
+        self.assertEqual(
+            [
+                (2, Transaction(date(2016, 9, 2), 'Transaction #2',
+                                [('101', 200), ('301', -100),
+                                 ('401', -100)])),
+                (3, Transaction(date(2016, 9, 3), 'Transaction #3',
+                                [('101', 300), ('301', -150),
+                                 ('401', -150)])),
+                (7, Transaction(date(2016, 9, 7), 'Transaction #7',
+                                [('101', 700), ('301', -350),
+                                 ('401', -350)])),
+            ],
+            self.ledger.get_transactions_by_ids([7, 3, 2, 3, 99],
+                                                chunk_size=2)
+        )
+        self.assertEqual([], self.ledger.get_transactions_by_ids([]))
+
     def test_get_transactions(self):
         self.ledger.create_account('101', 'Cash', 'asset')
         self.ledger.create_account('102', 'Equipment', 'asset')
@@ -104,6 +293,88 @@ class LedgerTestCase(unittest.TestCase):
             self.ledger.get_transactions()
         )
 
+    def test_iter_transactions(self):
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('102', 'Equipment', 'asset')
+        self.ledger.create_account('301', 'Share Capital', 'equity')
+        tx_ids = [
+            self.ledger.record_transaction(date(2016, 9, day),
+                                           "Investment",
+                                           [('101', 1000), ('301', -1000)])
+            for day in range(1, 6)
+        ]
+        laptop_id = self.ledger.record_transaction(
+            date(2016, 9, 3), "Buy a laptop", [('101', -500), ('102', 500)]
+        )
+
+        self.assertEqual(
+            tx_ids[1:] + [laptop_id],
+            [tx_id for tx_id, _ in self.ledger.iter_transactions(
+                after_id=tx_ids[0], page_size=2
+            )]
+        )
+        self.assertEqual(
+            tx_ids[1:4],
+            [tx_id for tx_id, _ in self.ledger.iter_transactions(
+                limit=3, start_date=date(2016, 9, 2), page_size=2
+            )]
+        )
+        self.assertEqual(
+            [(laptop_id, Transaction(date(2016, 9, 3), "Buy a laptop",
+                                     [('101', -500), ('102', 500)]))],
+            list(self.ledger.iter_transactions(
+                end_date=date(2016, 9, 3), account_code='102'
+            ))
+        )
+
+    def test_get_account_ledger(self):
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('102', 'Equipment', 'asset')
+        self.ledger.create_account('301', 'Share Capital', 'equity')
+        self.ledger.record_transaction(date(2016, 9, 1),
+                                       "Record the funder's investment",
+                                       [('101', 500000), ('301', -500000)])
+        laptop_id = self.ledger.record_transaction(
+            date(2016, 9, 3), "Buy a laptop", [('101', -100000),
+                                               ('102', 100000)]
+        )
+        phone_id = self.ledger.record_transaction(
+            date(2016, 9, 2), "Buy a phone", [('101', -50000),
+                                              ('102', 50000)]
+        )
+        self.ledger.record_transaction(date(2016, 9, 3), "Buy a desk",
+                                       [('101', -20000), ('102', 20000)])
+
+        account_ledger = self.ledger.get_account_ledger(
+            '101', start_date=date(2016, 9, 2), end_date=date(2016, 9, 3),
+            limit=2
+        )
+        self.assertEqual(Account('101', 'Cash', 'asset'),
+                         account_ledger.account)
+        self.assertEqual(500000, account_ledger.opening_balance)
+        self.assertEqual(
+            [
+                (phone_id, date(2016, 9, 2), -50000, 450000),
+                (laptop_id, date(2016, 9, 3), -100000, 350000),
+            ],
+            [(item.transaction_id, item.date, item.amount, item.balance)
+             for item in account_ledger.items]
+        )
+
+        account_ledger = self.ledger.get_account_ledger(
+            '101', start_date=date(2016, 9, 2),
+            after_id=account_ledger.items[-1].id
+        )
+        self.assertEqual(350000, account_ledger.opening_balance)
+        self.assertEqual(
+            [("Buy a desk", -20000, 330000)],
+            [(item.description, item.amount, item.balance)
+             for item in account_ledger.items]
+        )
+
+    def test_get_account_ledger_non_existent(self):
+        self.assertIsNone(self.ledger.get_account_ledger('101'))
+
     def test_get_balance_sheet(self):
         self.ledger.create_account('101', 'Cash', 'asset')
         self.ledger.create_account('102', 'Equipment', 'asset')
@@ -135,6 +406,476 @@ class LedgerTestCase(unittest.TestCase):
             self.ledger.get_balance_sheet(date(2016, 9, 1))
         )
 
+    def test_get_balance_sheet_backdated(self):
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('301', 'Share Capital', 'equity')
+        self.ledger.record_transaction(date(2016, 9, 5),
+                                       "Record the funder's investment",
+                                       [('101', 500000), ('301', -500000)])
+        self.ledger.record_transaction(date(2016, 9, 1),
+                                       "Record the initial investment",
+                                       [('101', 100000), ('301', -100000)])
+
+        self.assertEqual(
+            {Account('101', 'Cash', 'asset'): 100000},
+            self.ledger.get_balance_sheet(date(2016, 9, 4)).asset
+        )
+        self.assertEqual(
+            {Account('101', 'Cash', 'asset'): 600000},
+            self.ledger.get_balance_sheet(date(2016, 9, 5)).asset
+        )
+
+    def test_rebuild_balances(self):
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('301', 'Share Capital', 'equity')
+        self.ledger.record_transaction(date(2016, 9, 1),
+                                       "Record the funder's investment",
+                                       [('101', 500000), ('301', -500000)])
+        self.ledger.record_transaction(date(2016, 9, 2),
+                                       "Record the second investment",
+                                       [('101', 100000), ('301', -100000)])
+        expected = self.ledger.get_balance_sheet(date(2016, 9, 2))
+
+        self.db.execute('DELETE FROM account_daily_balances')
+        self.db.commit()
+        self.ledger.rebuild_balances()
+
+        self.assertEqual(expected,
+                         self.ledger.get_balance_sheet(date(2016, 9, 2)))
+        self.assertEqual(
+            [('101', date(2016, 9, 1).toordinal(), 500000),
+             ('101', date(2016, 9, 2).toordinal(), 600000)],
+            self.db.execute('''
+            SELECT * FROM account_daily_balances
+                WHERE account_code = '101'
+                ORDER BY date
+            ''').fetchall()
+        )
+
+    def test_archive_year(self):
+        accounts = populate(self.ledger, 10, 1000, seed=1)
+        account_code = accounts[0][0]
+        # The last ID is archived.
+        last_id = self.ledger.record_transaction(
+            date(2011, 3, 1), 'Back-dated',
+            [(account_code, 500), (accounts[1][0], -500)]
+        )
+        tx_ids = [tx_id for tx_id, _ in self.ledger.iter_transactions()]
+        expected = self._get_history(account_code, tx_ids)
+
+        for year in (2010, 2011):
+            path = 'test-{}.sqlite3'.format(year)
+            self.addCleanup(os.remove, path)
+            self.ledger.archive_year(year, path)
+
+        self.assertEqual(expected, self._get_history(account_code, tx_ids))
+        self.assertEqual(
+            [], self.ledger.get_transactions(end_date=date(2011, 12, 31),
+                                             start_date=date(2011, 1, 1),
+                                             limit=0)
+        )
+        self.assertEqual(
+            0, self.db.execute('''
+            SELECT COUNT(*) FROM transactions WHERE date < ?
+            ''', (date(2012, 1, 1).toordinal(),)).fetchone()[0]
+        )
+        self.assertEqual(
+            2, len(self.ledger.get_partitions(date(2011, 6, 1)))
+        )
+        self.assertEqual(
+            3, len(self.ledger.get_partitions(end_date=date(2011, 6, 1)))
+        )
+
+        with self.assertRaises(LedgerError):
+            self.ledger.archive_year(2010, 'test-2010-again.sqlite3')
+        with self.assertRaises(ValueError):
+            self.ledger.record_transaction(date(2011, 5, 1), 'Late',
+                                           [('101', 1), ('401', -1)])
+        with self.assertRaises(ValueError):
+            self.ledger.record_transactions([
+                (date(2012, 5, 1), 'Late', [(account_code, 0)]),
+                (date(2010, 5, 1), 'Late', [(account_code, 0)]),
+            ])
+
+        # IDs of archived transactions aren't reused.
+        self.assertGreater(
+            self.ledger.record_transaction(date(2014, 1, 1), 'New',
+                                           [(account_code, 0)]),
+            last_id
+        )
+
+        self.db.execute('DELETE FROM account_daily_balances')
+        self.db.execute('UPDATE account_totals SET balance = 0')
+        self.db.commit()
+        self.ledger.rebuild_balances(processes=2)
+        self.assertEqual([], self.ledger.check_balances())
+        self.assertEqual(expected[:3],
+                         self._get_history(account_code, tx_ids)[:3])
+
+    def test_archive_years_in_order(self):
+        self.ledger.create_account('100', 'Cash', 'asset')
+        self.ledger.create_account('300', 'Capital', 'equity')
+        for year, amount in [(2014, 1), (2015, 10), (2016, 100)]:
+            self.ledger.record_transaction(date(year, 6, 1), 'Investment',
+                                           [('100', amount),
+                                            ('300', -amount)])
+
+        with self.assertRaises(LedgerError):
+            self.ledger.archive_year(2015, 'test-2015.sqlite3')
+        self.assertFalse(os.path.exists('test-2015.sqlite3'))
+
+        self.addCleanup(os.remove, 'test-2015.sqlite3')
+        self.addCleanup(os.remove, 'test-2014.sqlite3')
+        self.ledger.archive_year(2014, 'test-2014.sqlite3')
+        self.ledger.archive_year(2015, 'test-2015.sqlite3')
+        with self.assertRaises(ValueError):
+            self.ledger.record_transaction(date(2014, 7, 1), 'Late',
+                                           [('100', 1), ('300', -1)])
+        # Nothing would be moved but the year is archived all the same.
+        with self.assertRaises(ValueError):
+            self.ledger.close_period(date(2015, 6, 30), '300')
+        self.assertIsNone(self.ledger.get_period_closing(date(2015, 6, 30)))
+        self.assertEqual(
+            [(date(2014, 6, 1), 1), (date(2015, 6, 1), 11),
+             (date(2016, 6, 1), 111)],
+            [(item.date, item.balance)
+             for item in self.ledger.get_account_ledger('100').items]
+        )
+
+        # Archives are opened once and closed explicitly.
+        partitions = self.ledger.get_partitions()
+        self.assertEqual(3, len(partitions))
+        self.assertIs(partitions[0], self.ledger.get_partitions()[0])
+        self.ledger.close_archives()
+        with self.assertRaises(sqlite3.ProgrammingError):
+            partitions[0].execute('SELECT 1')
+
+    def test_reports_do_not_read_archives(self):
+        populate(self.ledger, 10, 500, seed=1)
+        expected = (
+            self.ledger.get_balance_sheet(date(2012, 6, 30)),
+            self.ledger.get_income_statement(date(2011, 1, 1),
+                                             date(2012, 12, 31)),
+            self.ledger.get_transactions(start_date=date(2012, 1, 1)),
+        )
+        self.ledger.archive_year(2010, 'test-2010.sqlite3')
+        os.remove('test-2010.sqlite3')
+
+        self.assertEqual(
+            expected,
+            (
+                self.ledger.get_balance_sheet(date(2012, 6, 30)),
+                self.ledger.get_income_statement(date(2011, 1, 1),
+                                                 date(2012, 12, 31)),
+                self.ledger.get_transactions(start_date=date(2012, 1, 1)),
+            )
+        )
+        with self.assertRaises(LedgerError):
+            self.ledger.get_transactions()
+
+    def _get_history(self, account_code, tx_ids):
+        return (
+            self.ledger.get_balance_sheet(date(2012, 6, 30)),
+            self.ledger.get_income_statement_series(
+                date(2010, 6, 1), date(2012, 6, 30), 'quarter'
+            ),
+            self.ledger.get_account_ledger(account_code, limit=20),
+            self.ledger.get_account_ledger(account_code,
+                                           start_date=date(2011, 12, 1),
+                                           limit=20),
+            self.ledger.get_account_ledger(account_code, after_id=10,
+                                           limit=200),
+            list(self.ledger.iter_transactions(page_size=50)),
+            list(self.ledger.iter_transactions(after_id=tx_ids[100],
+                                               limit=30)),
+            self.ledger.get_transactions_by_ids(tx_ids[::7]),
+            self.ledger.count_transactions(),
+            self.ledger.count_transaction_items(),
+        )
+
+    def test_close_period(self):
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('320', 'Retained Earnings', 'equity')
+        self.ledger.create_account('401', 'Revenue', 'revenue')
+        self.ledger.create_account('501', 'Travel', 'expense')
+        self.ledger.record_transaction(date(2015, 6, 1), 'Consulting',
+                                       [('101', 10000), ('401', -10000)])
+        self.ledger.record_transaction(date(2015, 7, 1), 'Travel',
+                                       [('101', -3000), ('501', 3000)])
+        expected = (
+            self.ledger.get_income_statement(date(2015, 1, 1),
+                                             date(2015, 12, 31)),
+            self.ledger.get_income_statement_series(
+                date(2015, 1, 1), date(2015, 12, 31), 'quarter'
+            ),
+        )
+
+        with self.assertRaises(ValueError):
+            self.ledger.close_period(date(2015, 12, 31), '401')
+        tx_id = self.ledger.close_period(date(2015, 12, 31), '320')
+        self.assertEqual(
+            Transaction(date(2015, 12, 31), 'Closing entry',
+                        [('401', 10000), ('501', -3000), ('320', -7000)]),
+            self.ledger.get_transaction(tx_id)
+        )
+
+        # Income statements still show the result of the closed period.
+        self.assertEqual(
+            expected,
+            (
+                self.ledger.get_income_statement(date(2015, 1, 1),
+                                                 date(2015, 12, 31)),
+                self.ledger.get_income_statement_series(
+                    date(2015, 1, 1), date(2015, 12, 31), 'quarter'
+                ),
+            )
+        )
+        self.assertEqual(
+            7000, self.ledger.get_classified_income_statement(
+                date(2015, 1, 1), date(2015, 12, 31)
+            ).net_income
+        )
+        balance_sheet = self.ledger.get_balance_sheet(date(2015, 12, 31))
+        self.assertEqual(0, balance_sheet.retained_earnings)
+        self.assertEqual(
+            {Account('320', 'Retained Earnings', 'equity'): -7000},
+            balance_sheet.equity
+        )
+
+        closing = self.ledger.get_period_closing(date(2015, 12, 31))
+        self.assertEqual(tx_id, closing.transaction_id)
+        self.assertEqual(Account('320', 'Retained Earnings', 'equity'),
+                         closing.retained_earnings)
+        self.assertEqual(
+            {
+                Account('101', 'Cash', 'asset'): 7000,
+                Account('320', 'Retained Earnings', 'equity'): -7000,
+                Account('401', 'Revenue', 'revenue'): 0,
+                Account('501', 'Travel', 'expense'): 0,
+            },
+            closing.balances
+        )
+        self.assertIsNone(self.ledger.get_period_closing(date(2015, 12, 30)))
+
+        with self.assertRaises(ValueError):
+            self.ledger.record_transaction(date(2015, 12, 31), 'Late',
+                                           [('101', 100), ('401', -100)])
+        with self.assertRaises(ValueError):
+            self.ledger.close_period(date(2015, 6, 30), '320')
+
+        # Nothing to close.
+        self.assertIsNone(self.ledger.close_period(date(2016, 1, 31), '320'))
+        self.ledger.record_transaction(date(2016, 2, 1), 'Consulting',
+                                       [('101', 500), ('401', -500)])
+        self.ledger.close_period(date(2016, 12, 31), '320')
+        self.assertEqual(
+            [(date(2015, 12, 31), {'401': 10000, '501': -3000,
+                                   '320': -7000}),
+             (date(2016, 12, 31), {'401': 500, '320': -500})],
+            self.ledger.get_closed_amounts()
+        )
+        self.assertEqual(
+            500, self.ledger.get_income_statement(
+                date(2015, 6, 1), date(2016, 12, 31)
+            ).total_revenues - 10000
+        )
+        self.assertEqual([], self.ledger.check_balances())
+
+    def test_create_account_with_parent(self):
+        self.ledger.create_account('100', 'Current Assets', 'asset')
+        self.ledger.create_account('101', 'Cash', 'asset', parent_code='100')
+
+        self.assertEqual(Account('100', 'Current Assets', 'asset'),
+                         self.ledger.get_parent_account('101'))
+        self.assertIsNone(self.ledger.get_parent_account('100'))
+        with self.assertRaises(ValueError):
+            self.ledger.create_account('102', 'Bank', 'asset',
+                                       parent_code='999')
+        with self.assertRaises(ValueError):
+            self.ledger.create_account('201', 'Loan', 'liability',
+                                       parent_code='100')
+
+    def test_get_classified_balance_sheet(self):
+        self.ledger.create_account('100', 'Current Assets', 'asset')
+        self.ledger.create_account('110', 'Cash', 'asset', parent_code='100')
+        self.ledger.create_account('111', 'Petty Cash', 'asset',
+                                   parent_code='110')
+        self.ledger.create_account('120', 'Receivables', 'asset',
+                                   parent_code='100')
+        self.ledger.create_account('200', 'Equipment', 'asset')
+        self.ledger.create_account('300', 'Share Capital', 'equity')
+        self.ledger.create_account('400', 'Revenue', 'revenue')
+        self.ledger.create_account('410', 'Consulting', 'revenue',
+                                   parent_code='400')
+        self.ledger.record_transaction(date(2016, 9, 1), 'Investment',
+                                       [('110', 50000), ('111', 1000),
+                                        ('200', 20000), ('300', -71000)])
+        self.ledger.record_transaction(date(2016, 9, 2), 'Consulting',
+                                       [('100', 300), ('120', 4000),
+                                        ('410', -4300)])
+
+        balance_sheet = self.ledger.get_classified_balance_sheet(
+            date(2016, 9, 30)
+        )
+
+        self.assertEqual(
+            [
+                AccountNode(Account('100', 'Current Assets', 'asset'), 0,
+                            300, 55300),
+                AccountNode(Account('110', 'Cash', 'asset'), 1, 50000, 51000),
+                AccountNode(Account('111', 'Petty Cash', 'asset'), 2, 1000,
+                            1000),
+                AccountNode(Account('120', 'Receivables', 'asset'), 1, 4000,
+                            4000),
+                AccountNode(Account('200', 'Equipment', 'asset'), 0, 20000,
+                            20000),
+            ],
+            balance_sheet.asset
+        )
+        self.assertEqual(75300, balance_sheet.total_assets)
+        self.assertEqual(4300, balance_sheet.retained_earnings)
+        self.assertEqual(75300, balance_sheet.total_equity)
+
+        income_statement = self.ledger.get_classified_income_statement(
+            date(2016, 9, 2), date(2016, 9, 30)
+        )
+        self.assertEqual(
+            [
+                AccountNode(Account('400', 'Revenue', 'revenue'), 0, 0,
+                            -4300),
+                AccountNode(Account('410', 'Consulting', 'revenue'), 1,
+                            -4300, -4300),
+            ],
+            income_statement.revenue
+        )
+        self.assertEqual(4300, income_statement.net_income)
+
+    def test_get_balance_sheet_series(self):
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('102', 'Equipment', 'asset')
+        self.ledger.create_account('201', 'Bank Loan', 'liability')
+        self.ledger.create_account('301', 'Share Capital', 'equity')
+        self.ledger.create_account('401', 'Revenue', 'revenue')
+        self.ledger.record_transaction(date(2016, 9, 1),
+                                       "Record the funder's investment",
+                                       [('101', 500000), ('301', -500000)])
+        self.ledger.record_transaction(date(2016, 9, 2),
+                                       "Buy a laptop",
+                                       [('101', -40000), ('102', 100000),
+                                        ('201', -60000)])
+        self.ledger.record_transaction(date(2016, 10, 4),
+                                       "Consulting for Acme, Inc.",
+                                       [('101', 1000), ('401', -1000)])
+        self.ledger.record_transaction(date(2016, 11, 4),
+                                       "Consulting for Acme, Inc.",
+                                       [('101', 2000), ('401', -2000)])
+        dates = [date(2016, 8, 31), date(2016, 9, 1), date(2016, 9, 30),
+                 date(2016, 10, 31), date(2016, 12, 31)]
+
+        self.assertEqual(
+            [self.ledger.get_balance_sheet(day) for day in dates],
+            self.ledger.get_balance_sheet_series(reversed(dates))
+        )
+        self.assertEqual(
+            [self.ledger.get_balance_sheet(day) for day in sorted(dates * 2)],
+            self.ledger.get_balance_sheet_series(dates * 2, chunk_size=2)
+        )
+
+    def test_get_income_statement_series(self):
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('401', 'Consulting Revenue', 'revenue')
+        self.ledger.create_account('501', 'Business Travel', 'expense')
+        for day in (date(2016, 1, 10), date(2016, 2, 29), date(2016, 3, 1),
+                    date(2016, 4, 30), date(2016, 7, 1)):
+            self.ledger.record_transaction(day, "Consulting",
+                                           [('101', 1000), ('401', -1000)])
+            self.ledger.record_transaction(day, "Travel",
+                                           [('101', -100), ('501', 100)])
+
+        for period in ('week', 'month', 'quarter', 'year'):
+            periods = list(split_periods(date(2016, 1, 15),
+                                         date(2016, 7, 1), period))
+            self.assertEqual(
+                [self.ledger.get_income_statement(start, end)
+                 for start, end in periods],
+                self.ledger.get_income_statement_series(
+                    date(2016, 1, 15), date(2016, 7, 1), period
+                )
+            )
+
+    def test_split_periods(self):
+        self.assertEqual(
+            [(date(2016, 1, 15), date(2016, 1, 31)),
+             (date(2016, 2, 1), date(2016, 2, 29)),
+             (date(2016, 3, 1), date(2016, 3, 10))],
+            list(split_periods(date(2016, 1, 15), date(2016, 3, 10), 'month'))
+        )
+        self.assertEqual(
+            [(date(2016, 11, 15), date(2016, 12, 31)),
+             (date(2017, 1, 1), date(2017, 3, 31))],
+            list(split_periods(date(2016, 11, 15), date(2017, 3, 31),
+                               'quarter'))
+        )
+        self.assertEqual(
+            [(date(2016, 9, 1), date(2016, 9, 4)),
+             (date(2016, 9, 5), date(2016, 9, 6))],
+            list(split_periods(date(2016, 9, 1), date(2016, 9, 6), 'week'))
+        )
+        with self.assertRaises(ValueError):
+            list(split_periods(date(2016, 9, 1), date(2016, 9, 6), 'decade'))
+
+    def test_get_trial_balance(self):
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('102', 'Equipment', 'asset')
+        self.ledger.create_account('301', 'Share Capital', 'equity')
+        self.ledger.create_account('401', 'Revenue', 'revenue')
+        self.ledger.record_transaction(date(2016, 9, 1),
+                                       "Record the funder's investment",
+                                       [('101', 500000), ('301', -500000)])
+        self.ledger.record_transactions([
+            (date(2016, 9, 2), "Buy a laptop",
+             [('101', -100000), ('102', 100000)]),
+            (date(2016, 9, 3), "Consulting",
+             [('101', 20000), ('401', -20000)]),
+        ])
+
+        trial_balance = self.ledger.get_trial_balance()
+        self.assertEqual(
+            {
+                Account('101', 'Cash', 'asset'): 420000,
+                Account('102', 'Equipment', 'asset'): 100000,
+                Account('301', 'Share Capital', 'equity'): -500000,
+                Account('401', 'Revenue', 'revenue'): -20000,
+            },
+            trial_balance.accounts
+        )
+        self.assertEqual(520000, trial_balance.total_debits)
+        self.assertEqual(520000, trial_balance.total_credits)
+        self.assertEqual(
+            400000,
+            self.ledger.get_trial_balance(date(2016, 9, 2)).accounts[
+                Account('101', 'Cash', 'asset')
+            ]
+        )
+        self.assertEqual(420000, self.ledger.get_account_balance('101'))
+        self.assertIsNone(self.ledger.get_account_balance('999'))
+
+    def test_check_balances(self):
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('301', 'Share Capital', 'equity')
+        self.ledger.record_transaction(date(2016, 9, 1),
+                                       "Record the funder's investment",
+                                       [('101', 500000), ('301', -500000)])
+        self.assertEqual([], self.ledger.check_balances())
+
+        self.db.execute("UPDATE account_totals SET balance = 0 "
+                        "WHERE account_code = '101'")
+        self.db.commit()
+        self.assertEqual([('101', 0, 500000)], self.ledger.check_balances())
+
+        self.ledger.rebuild_balances()
+        self.assertEqual([], self.ledger.check_balances())
+
     def test_get_income_statement(self):
         self.ledger.create_account('101', 'Cash', 'asset')
         self.ledger.create_account('102', 'Equipment', 'asset')
@@ -179,5 +920,110 @@ class LedgerTestCase(unittest.TestCase):
         )
 
 
+class ParseDateTestCase(unittest.TestCase):
+    def test_parse_date(self):
+        self.assertEqual(date(2016, 9, 1), parse_date('2016-09-01'))
+        self.assertEqual(date(2016, 2, 29), parse_date('2016-02-29'))
+        self.assertEqual(date(2016, 9, 1), parse_date('2016-9-1'))
+
+    def test_parse_invalid_date(self):
+        for value in ('2016-09-01x', '2015-02-29', '01.09.2016', '16-09-01'):
+            with self.assertRaises(ValueError):
+                parse_date(value)
+
+
+class ReportCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite3.connect('test.sqlite3')
+        self.cache = ReportCache()
+        self.ledger = Ledger(self.db, cache=self.cache)
+        self.ledger.reset()
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('301', 'Share Capital', 'equity')
+        self.ledger.create_account('401', 'Revenue', 'revenue')
+        self.ledger.record_transaction(date(2016, 9, 1),
+                                       "Record the funder's investment",
+                                       [('101', 500000), ('301', -500000)])
+
+    def test_hits_and_misses(self):
+        balance_sheet = self.ledger.get_balance_sheet(date(2016, 9, 1))
+
+        self.assertIs(balance_sheet,
+                      self.ledger.get_balance_sheet(date(2016, 9, 1)))
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_invalidation(self):
+        self.ledger.get_balance_sheet(date(2016, 9, 1))
+        self.ledger.get_balance_sheet(date(2016, 9, 5))
+        self.ledger.get_income_statement(date(2016, 9, 1), date(2016, 9, 2))
+        self.ledger.get_income_statement(date(2016, 9, 4), date(2016, 9, 6))
+
+        # Written through another connection, as another process would.
+        Ledger(sqlite3.connect('test.sqlite3')).record_transaction(
+            date(2016, 9, 5), "Consulting",
+            [('101', 1000), ('401', -1000)]
+        )
+
+        self.assertEqual(
+            {Account('101', 'Cash', 'asset'): 501000},
+            self.ledger.get_balance_sheet(date(2016, 9, 5)).asset
+        )
+        self.assertEqual(
+            {Account('401', 'Revenue', 'revenue'): -1000},
+            self.ledger.get_income_statement(
+                date(2016, 9, 4), date(2016, 9, 6)
+            ).revenue
+        )
+        self.ledger.get_balance_sheet(date(2016, 9, 1))
+        self.ledger.get_income_statement(date(2016, 9, 1), date(2016, 9, 2))
+        self.assertEqual((2, 6), (self.cache.hits, self.cache.misses))
+
+    def test_new_account_invalidates_everything(self):
+        self.ledger.get_balance_sheet(date(2016, 9, 1))
+        etag = self.cache.get_etag(ReportCache.balance_sheet_key(
+            date(2016, 9, 1)
+        ))
+
+        self.ledger.create_account('102', 'Equipment', 'asset')
+
+        self.assertIn(Account('102', 'Equipment', 'asset'),
+                      self.ledger.get_balance_sheet(date(2016, 9, 1)).asset)
+        self.assertNotEqual(etag, self.cache.get_etag(
+            ReportCache.balance_sheet_key(date(2016, 9, 1))
+        ))
+
+    def test_concurrent_sync(self):
+        key = ReportCache.balance_sheet_key(date(2016, 9, 5))
+        self.ledger.get_balance_sheet(date(2016, 9, 5))
+        Ledger(sqlite3.connect('test.sqlite3')).record_transaction(
+            date(2016, 9, 5), "Consulting",
+            [('101', 1000), ('401', -1000)]
+        )
+
+        cache = self.cache
+        db = self.db
+        seen = []
+
+        class Connection(object):
+            # Another thread syncs while the first one is querying.
+            def execute(self, sql, parameters=()):
+                if 'MIN(date)' in sql and not seen:
+                    seen.append(cache.sync(db))
+                    seen.append(cache.get(key))
+                return db.execute(sql, parameters)
+
+        version = cache.sync(Connection())
+        self.assertEqual([version, None], seen)
+        self.assertIsNone(cache.get(key))
+
+    def test_max_size(self):
+        self.cache.max_size = 1
+        self.ledger.get_balance_sheet(date(2016, 9, 1))
+        self.ledger.get_balance_sheet(date(2016, 9, 2))
+        self.ledger.get_balance_sheet(date(2016, 9, 1))
+
+        self.assertEqual((0, 3), (self.cache.hits, self.cache.misses))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,298 @@
+'''Collect request and SQL metrics and expose them in the Prometheus format.'''
+from bisect import bisect_left
+from collections import OrderedDict
+import itertools
+import os
+import pstats
+import re
+import sqlite3
+import threading
+import timeit
+
+# Upper bounds, in seconds, of the buckets of latency histograms.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+# How many SQLite virtual machine instructions make a progress step.
+VM_STEP = 1000
+
+# How many rows iterating over a cursor fetches at a time.
+ITERATION_CHUNK_SIZE = 256
+
+# How many normalized statements are remembered before starting afresh.
+NORMALIZED_CACHE_SIZE = 1024
+
+_PLACEHOLDER_LIST = re.compile(r'\?(\s*,\s*\?)+')
+_WHITESPACE = re.compile(r'\s+')
+_normalized = {}
+
+
+class Metrics(object):
+    '''A thread-safe registry of counters and histograms.
+
+    Every metric is identified by a name and a tuple of (label, value)
+    pairs. render returns all of them in the Prometheus text format, along
+    with the slowest functions of the profiled requests.
+    '''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._counters = OrderedDict()
+        self._histograms = OrderedDict()
+        self._profile = None
+        self._lock = threading.Lock()
+
+    def increment(self, name, labels=(), value=1):
+        '''Add value to a counter.'''
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        '''Record a value, e.g. a duration in seconds, in a histogram.'''
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Counts of values falling into each bucket but no lower one,
+                # followed by the sum and the count of values. Buckets are
+                # made cumulative when rendered.
+                histogram = self._histograms[key] = [0] * len(self.buckets) + [
+                    0.0, 0
+                ]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def add_profile(self, profile):
+        '''Merge the statistics of a cProfile.Profile.'''
+        stats = pstats.Stats(profile)
+        with self._lock:
+            if self._profile is None:
+                self._profile = stats
+            else:
+                self._profile.add(stats)
+
+    def render(self, profile_limit=20):
+        '''Return all metrics in the Prometheus text format.
+
+        Profiled functions are limited to the profile_limit with the most
+        time spent in their own code.
+        '''
+        lines = []
+        with self._lock:
+            declared = set()
+            for (name, labels), value in self._counters.iteritems():
+                _declare(lines, declared, name, 'counter')
+                lines.append(_sample(name, labels, value))
+            for (name, labels), histogram in self._histograms.iteritems():
+                _declare(lines, declared, name, 'histogram')
+                for bound, count in zip(self.buckets,
+                                        _cumulative(histogram)):
+                    lines.append(_sample(name + '_bucket',
+                                         labels + (('le', repr(bound)),),
+                                         count))
+                lines.append(_sample(name + '_bucket',
+                                     labels + (('le', '+Inf'),),
+                                     histogram[-1]))
+                lines.append(_sample(name + '_sum', labels, histogram[-2]))
+                lines.append(_sample(name + '_count', labels, histogram[-1]))
+            if self._profile is not None:
+                self._render_profile(lines, profile_limit)
+        return ''.join(line + '\n' for line in lines)
+
+    def _render_profile(self, lines, limit):
+        functions = sorted(self._profile.stats.iteritems(),
+                           key=lambda item: item[1][2], reverse=True)
+        lines.append('# TYPE ledger_profile_self_seconds gauge')
+        lines.append('# TYPE ledger_profile_cumulative_seconds gauge')
+        for (filename, line, function), stats in functions[:limit]:
+            labels = (('function', '{}:{}({})'.format(
+                os.path.basename(filename), line, function
+            )),)
+            lines.append(_sample('ledger_profile_self_seconds', labels,
+                                 stats[2]))
+            lines.append(_sample('ledger_profile_cumulative_seconds', labels,
+                                 stats[3]))
+
+
+def _cumulative(counts):
+    total = 0
+    for count in counts:
+        total += count
+        yield total
+
+
+def _declare(lines, declared, name, type):
+    if name not in declared:
+        declared.add(name)
+        lines.append('# TYPE {} {}'.format(name, type))
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join(
+            '{}="{}"'.format(label, _escape(value)) for label, value in labels
+        ) + '}'
+    return '{} {}'.format(name, repr(value) if isinstance(value, float)
+                          else value)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def normalize_statement(sql):
+    '''Return the SQL statement with whitespace and IN lists collapsed.'''
+    normalized = _normalized.get(sql)
+    if normalized is None:
+        if len(_normalized) >= NORMALIZED_CACHE_SIZE:
+            _normalized.clear()
+        normalized = _normalized[sql] = _PLACEHOLDER_LIST.sub(
+            '?, ...', _WHITESPACE.sub(' ', sql).strip()
+        )
+    return normalized
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    '''A connection recording the timing of the statements it executes.
+
+    Pass it as the factory to sqlite3.connect and set the metrics attribute.
+    Every statement is recorded under its normalized text: the time spent
+    executing it and the rows fetched. After count_steps is called, the
+    virtual machine steps, in units of VM_STEP instructions, that SQLite ran
+    for it are recorded, too. SQLite doesn't report the rows it scans so the
+    steps are the closest measure of its work.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.metrics = None
+        self.steps = 0
+
+    def count_steps(self):
+        '''Count virtual machine steps; it slows every statement down.'''
+        self.set_progress_handler(self._count_step, VM_STEP)
+
+    def _count_step(self):
+        self.steps += 1
+        return 0
+
+    def cursor(self, factory=None):
+        return sqlite3.Connection.cursor(self,
+                                         factory or InstrumentedCursor)
+
+    def executescript(self, sql):
+        start, steps = timeit.default_timer(), self.steps
+        try:
+            return sqlite3.Connection.executescript(self, sql)
+        finally:
+            _record_statement(self, 'script', start, steps)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # Statements run by executescript aren't recorded one by one.
+    _statement = 'script'
+    # Rows and steps are counted here and added to the metrics once per
+    # statement, when the cursor is exhausted, reused, closed or collected.
+    _rows = 0
+    _steps = 0
+
+    def execute(self, sql, parameters=()):
+        return self._execute(sqlite3.Cursor.execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self._execute(sqlite3.Cursor.executemany, sql, parameters)
+
+    def _execute(self, method, sql, parameters):
+        self._record_fetches()
+        self._statement = normalize_statement(sql)
+        start, steps = timeit.default_timer(), self.connection.steps
+        try:
+            return method(self, sql, parameters)
+        finally:
+            _record_statement(self.connection, self._statement, start, steps)
+
+    def fetchone(self):
+        steps = self.connection.steps
+        row = sqlite3.Cursor.fetchone(self)
+        self._steps += self.connection.steps - steps
+        if row is None:
+            self._record_fetches()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        steps = self.connection.steps
+        rows = sqlite3.Cursor.fetchmany(self, size)
+        self._steps += self.connection.steps - steps
+        self._rows += len(rows)
+        if len(rows) < size:
+            self._record_fetches()
+        return rows
+
+    def fetchall(self):
+        steps = self.connection.steps
+        rows = sqlite3.Cursor.fetchall(self)
+        self._steps += self.connection.steps - steps
+        self._rows += len(rows)
+        self._record_fetches()
+        return rows
+
+    def __iter__(self):
+        # Rows are fetched in chunks so iterating costs no Python call per
+        # row.
+        return itertools.chain.from_iterable(iter(self._fetch_chunk, []))
+
+    def _fetch_chunk(self):
+        return self.fetchmany(ITERATION_CHUNK_SIZE)
+
+    def next(self):
+        steps = self.connection.steps
+        try:
+            row = sqlite3.Cursor.next(self)
+        except StopIteration:
+            self._record_fetches()
+            raise
+        self._steps += self.connection.steps - steps
+        self._rows += 1
+        return row
+
+    def close(self):
+        self._record_fetches()
+        sqlite3.Cursor.close(self)
+
+    def __del__(self):
+        self._record_fetches()
+
+    def _record_fetches(self):
+        rows, steps = self._rows, self._steps
+        if not rows and not steps:
+            return
+        self._rows = self._steps = 0
+        metrics = self.connection.metrics
+        if metrics is not None:
+            labels = (('statement', self._statement),)
+            if rows:
+                metrics.increment('ledger_sql_rows_total', labels, rows)
+            if steps:
+                metrics.increment('ledger_sql_vm_steps_total', labels,
+                                  steps)
+
+
+def _record_statement(connection, statement, start, steps):
+    metrics = connection.metrics
+    if metrics is None:
+        return
+    labels = (('statement', statement),)
+    metrics.observe('ledger_sql_seconds', labels,
+                    timeit.default_timer() - start)
+    if connection.steps > steps:
+        metrics.increment('ledger_sql_vm_steps_total', labels,
+                          connection.steps - steps)
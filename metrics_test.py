@@ -0,0 +1,137 @@
+import cProfile
+import sqlite3
+import unittest
+
+from metrics import InstrumentedConnection, Metrics, normalize_statement
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_render_counters_and_histograms(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        metrics.increment('requests_total', (('route', '/a"b'),))
+        metrics.increment('requests_total', (('route', '/a"b'),), 2)
+        metrics.observe('seconds', (), 0.5)
+        metrics.observe('seconds', (), 2.0)
+
+        self.assertEqual(
+            '# TYPE requests_total counter\n'
+            'requests_total{route="/a\\"b"} 3\n'
+            '# TYPE seconds histogram\n'
+            'seconds_bucket{le="0.1"} 0\n'
+            'seconds_bucket{le="1.0"} 1\n'
+            'seconds_bucket{le="+Inf"} 2\n'
+            'seconds_sum 2.5\n'
+            'seconds_count 2\n',
+            metrics.render()
+        )
+
+    def test_render_profile(self):
+        metrics = Metrics()
+        for _ in xrange(2):
+            profile = cProfile.Profile()
+            profile.enable()
+            sorted(range(1000))
+            profile.disable()
+            metrics.add_profile(profile)
+
+        rendered = metrics.render(profile_limit=1)
+        self.assertIn('# TYPE ledger_profile_self_seconds gauge', rendered)
+        self.assertEqual(1, rendered.count('ledger_profile_self_seconds{'))
+        self.assertEqual(
+            1, rendered.count('ledger_profile_cumulative_seconds{')
+        )
+
+    def test_normalize_statement(self):
+        self.assertEqual(
+            'SELECT id FROM transactions WHERE id IN (?, ...)',
+            normalize_statement('''
+            SELECT id
+                FROM transactions WHERE id IN (?, ?,?)
+            ''')
+        )
+
+
+class InstrumentedConnectionTestCase(unittest.TestCase):
+    def test_statements_are_recorded(self):
+        db = sqlite3.connect(':memory:', factory=InstrumentedConnection)
+        db.metrics = Metrics()
+        db.executescript('CREATE TABLE numbers (n INTEGER);')
+        db.executemany('INSERT INTO numbers VALUES (?)',
+                       [(n,) for n in xrange(100)])
+        self.assertEqual(
+            [(3,)], db.execute('SELECT n FROM numbers WHERE n IN (3, ?)',
+                               (200,)).fetchall()
+        )
+        self.assertEqual(
+            100, len(list(db.cursor().execute('SELECT n FROM numbers')))
+        )
+
+        rendered = db.metrics.render()
+        self.assertIn('ledger_sql_seconds_count{statement="script"} 1',
+                      rendered)
+        self.assertIn(
+            'ledger_sql_seconds_count'
+            '{statement="INSERT INTO numbers VALUES (?)"} 1',
+            rendered
+        )
+        self.assertIn(
+            'ledger_sql_rows_total'
+            '{statement="SELECT n FROM numbers WHERE n IN (3, ?)"} 1',
+            rendered
+        )
+        self.assertIn(
+            'ledger_sql_rows_total{statement="SELECT n FROM numbers"} 100',
+            rendered
+        )
+
+    def test_rows_are_recorded_once_per_statement(self):
+        db = sqlite3.connect(':memory:', factory=InstrumentedConnection)
+        db.metrics = Metrics()
+        db.execute('CREATE TABLE numbers (n INTEGER)')
+        db.executemany('INSERT INTO numbers VALUES (?)',
+                       [(n,) for n in xrange(1000)])
+        increments = []
+        increment = db.metrics.increment
+        db.metrics.increment = lambda *args: (increments.append(args[0]),
+                                              increment(*args))
+
+        self.assertEqual(1000, sum(1 for _ in db.execute(
+            'SELECT n FROM numbers'
+        )))
+        self.assertEqual(['ledger_sql_rows_total'], [
+            name for name in increments if name == 'ledger_sql_rows_total'
+        ])
+
+        # Cursors left unexhausted are recorded when they're collected.
+        self.assertEqual((0,), db.execute(
+            'SELECT n FROM numbers ORDER BY n'
+        ).fetchone())
+        self.assertIn(
+            'ledger_sql_rows_total'
+            '{statement="SELECT n FROM numbers ORDER BY n"} 1',
+            db.metrics.render()
+        )
+
+    def test_count_steps(self):
+        db = sqlite3.connect(':memory:', factory=InstrumentedConnection)
+        db.metrics = Metrics()
+        query = '''
+        WITH RECURSIVE numbers(n) AS (
+            SELECT 1 UNION ALL SELECT n + 1 FROM numbers WHERE n < 10000
+        )
+        SELECT SUM(n) FROM numbers
+        '''
+        db.execute(query).fetchall()
+        self.assertNotIn('ledger_sql_vm_steps_total', db.metrics.render())
+
+        db.count_steps()
+        db.execute(query).fetchall()
+        self.assertIn('ledger_sql_vm_steps_total', db.metrics.render())
+
+    def test_without_metrics(self):
+        db = sqlite3.connect(':memory:', factory=InstrumentedConnection)
+        self.assertEqual((1,), db.execute('SELECT 1').fetchone())
+
+
+if __name__ == '__main__':
+    unittest.main()
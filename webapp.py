@@ -1,32 +1,155 @@
-from datetime import datetime
-from decimal import Decimal
+from collections import OrderedDict, namedtuple
+import cProfile
+import itertools
+import json
 import locale
 import os
+from Queue import Empty, Full, LifoQueue
+import random
 import sqlite3
+import threading
+import timeit
 
-from flask import Flask, g, jsonify, render_template, request
+import click
+from flask import Flask, Markup, Response, g, jsonify, render_template, \
+    request, stream_with_context
 
-from ledger import Ledger, LedgerError
+import jsonstream
+from ledger import AccountRegistry, Ledger, LedgerError, ReportCache, \
+    parse_date, split_periods
+from metrics import InstrumentedConnection, Metrics
+from writer import LedgerWriter
 
 app = Flask(__name__)
 app.config.update(dict(
-    DATABASE_URL=os.path.join(app.root_path, 'database.sqlite3')
+    DATABASE_URL=os.path.join(app.root_path, 'database.sqlite3'),
+    IMPORT_BATCH_SIZE=1000,
+    # Applied in order to every new connection. WAL lets readers proceed
+    # while a transaction is being written and NORMAL synchronization is
+    # safe in WAL mode.
+    SQLITE_PRAGMAS=[
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -16384),
+        ('mmap_size', 256 * 1024 * 1024),
+        ('temp_store', 'MEMORY'),
+    ],
+    # The number of idle connections kept for reuse by later requests; 0
+    # connects on each request.
+    SQLITE_POOL_SIZE=8,
+    # The number of reports kept in memory; 0 disables the cache.
+    REPORT_CACHE_SIZE=256,
+    # The number of rendered sections of HTML reports kept in memory; 0
+    # disables the cache.
+    FRAGMENT_CACHE_SIZE=1024,
+    # The locale whose monetary conventions are used to format amounts.
+    MONETARY_LOCALE=('en_US', 'UTF-8'),
+    # Funnel all writes through a single writer thread that commits them in
+    # groups. Use it with a threaded server, e.g. flask run --with-threads.
+    WRITER_QUEUE=False,
+    # The maximum number of writes committed together by the writer thread and
+    # how many seconds it waits for more writes before committing a group.
+    WRITER_GROUP_SIZE=100,
+    WRITER_GROUP_DELAY=0,
+    # Record request latencies and SQL statement timings, served at /metrics.
+    # It slows writes down by about a third.
+    METRICS=False,
+    # Also count the SQLite virtual machine steps of every statement, which
+    # slows every statement down further.
+    METRICS_VM_STEPS=False,
+    # The fraction of requests profiled with cProfile and how many of the
+    # functions taking the most time are listed at /metrics.
+    PROFILE_SAMPLE_RATE=0,
+    PROFILE_LIMIT=20
 ))
+app.config.from_envvar('LEDGER_SETTINGS', silent=True)
 
+_pools = {}
+_report_caches = {}
+_writers = {}
+_money_formatters = {}
+_locale_lock = threading.Lock()
+_metrics = Metrics()
 
-def connect_db():
-    db = sqlite3.connect(app.config['DATABASE_URL'])
+
+def connect_db(database_url=None, **kwargs):
+    if app.config['METRICS']:
+        kwargs.setdefault('factory', InstrumentedConnection)
+    db = sqlite3.connect(database_url or app.config['DATABASE_URL'], **kwargs)
+    if app.config['METRICS']:
+        db.metrics = _metrics
+        if app.config['METRICS_VM_STEPS']:
+            db.count_steps()
+    for name, value in app.config['SQLITE_PRAGMAS']:
+        db.execute('PRAGMA {} = {}'.format(name, value)).close()
     return db
 
 
+def get_pool():
+    # Connections must not cross a fork and are reopened when the database
+    # is reconfigured, e.g. by tests.
+    key = (os.getpid(), app.config['DATABASE_URL'], app.config['METRICS'])
+    pool = _pools.get(key)
+    if pool is None:
+        pool = _pools.setdefault(key,
+                                 LifoQueue(app.config['SQLITE_POOL_SIZE']))
+    return pool
+
+
+def check_out_db():
+    '''Return an idle pooled connection and its account registry.
+
+    A new connection is opened if none is idle. The most recently returned
+    connection is reused first as its pages are the likeliest to be cached.
+    '''
+    try:
+        return get_pool().get_nowait()
+    except Empty:
+        # Requests are served by many threads but each connection is used
+        # by one request at a time.
+        return connect_db(check_same_thread=False), AccountRegistry()
+
+
+def check_in_db(db, accounts):
+    '''Return a connection to the pool, or close it if the pool is full.'''
+    # Don't hand a connection with a pending transaction to the next request.
+    db.rollback()
+    try:
+        get_pool().put_nowait((db, accounts))
+    except Full:
+        db.close()
+
+
 def get_db():
     if not hasattr(g, 'db'):
-        g.db = connect_db()
+        if app.config['SQLITE_POOL_SIZE']:
+            g.db, g.accounts = check_out_db()
+        else:
+            g.db = connect_db()
     return g.db
 
 
+def get_report_cache():
+    if not app.config['REPORT_CACHE_SIZE']:
+        return None
+    url = app.config['DATABASE_URL']
+    cache = _report_caches.get(url)
+    if cache is None:
+        cache = _report_caches.setdefault(
+            url, ReportCache(app.config['REPORT_CACHE_SIZE'])
+        )
+    return cache
+
+
+def get_account_registry():
+    # The registry belongs to the connection so it's pooled along with it.
+    get_db()
+    return g.get('accounts')
+
+
 def create_ledger():
-    return Ledger(get_db())
+    return Ledger(get_db(), cache=get_report_cache(),
+                  accounts=get_account_registry())
 
 
 def get_ledger():
@@ -35,10 +158,38 @@ def get_ledger():
     return g.ledger
 
 
+def get_writer():
+    url = app.config['DATABASE_URL']
+    key = (os.getpid(), url)
+    writer = _writers.get(key)
+    if writer is None:
+        writer = _writers.setdefault(key, LedgerWriter(
+            lambda: connect_db(url, isolation_level=None),
+            max_group_size=app.config['WRITER_GROUP_SIZE'],
+            max_group_delay=app.config['WRITER_GROUP_DELAY']
+        ))
+    return writer
+
+
+def write_ledger(method, *args, **kwargs):
+    '''Call a Ledger method that writes, via the writer thread if enabled.'''
+    if app.config['WRITER_QUEUE']:
+        return get_writer().call(method, *args, **kwargs)
+    return getattr(get_ledger(), method)(*args, **kwargs)
+
+
 def init_ledger():
     get_ledger().init()
 
 
+def migrate_ledger():
+    get_ledger().migrate()
+
+
+def rebuild_ledger(processes=1):
+    get_ledger().rebuild_balances(processes)
+
+
 def drop_ledger():
     get_ledger().drop()
 
@@ -52,6 +203,48 @@ def init_ledger_command():
     init_ledger()
 
 
+@app.cli.command('migrate')
+def migrate_ledger_command():
+    migrate_ledger()
+
+
+@app.cli.command('rebuild')
+@click.option('--processes', default=1,
+              help='The number of processes reading archives.')
+def rebuild_ledger_command(processes):
+    rebuild_ledger(processes)
+
+
+@app.cli.command('check')
+@click.option('--processes', default=1,
+              help='The number of processes reading archives.')
+def check_ledger_command(processes):
+    mismatches = get_ledger().check_balances(processes)
+    for code, recorded, actual in mismatches:
+        click.echo('Account {}: recorded balance {}, actual balance {}'.format(
+            code, recorded, actual
+        ))
+    if mismatches:
+        click.echo('Run "flask rebuild" to recompute the balances.')
+        raise SystemExit(1)
+
+
+@app.cli.command('archive')
+@click.argument('year', type=int)
+@click.argument('path', required=False)
+def archive_year_command(year, path):
+    if path is None:
+        name, extension = os.path.splitext(
+            os.path.basename(app.config['DATABASE_URL'])
+        )
+        path = '{}-{}{}'.format(name, year, extension)
+    try:
+        get_ledger().archive_year(year, path)
+    except LedgerError as exc:
+        raise click.ClickException(str(exc))
+    click.echo('Archived {} to {}'.format(year, path))
+
+
 @app.cli.command('drop')
 def drop_ledger_command():
     drop_ledger()
@@ -62,15 +255,70 @@ def reset_ledger_command():
     reset_ledger()
 
 
+@app.cli.command('import')
+@click.argument('file', type=click.File('rb'))
+def import_transactions_command(file):
+    tx_ids = get_ledger().record_transactions(
+        (_transaction_from_json(data) for data in _iter_json_documents(file)),
+        batch_size=app.config['IMPORT_BATCH_SIZE']
+    )
+    click.echo('Imported {} transactions'.format(len(tx_ids)))
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = timeit.default_timer()
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    if rate and random.random() < rate:
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+
+@app.after_request
+def set_request_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def record_request_metrics(error):
+    # Streamed responses are torn down once they've been sent so they're
+    # measured in full.
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.disable()
+    if not app.config['METRICS'] or 'request_start' not in g:
+        return
+
+    if profile is not None:
+        _metrics.add_profile(profile)
+        _metrics.increment('ledger_profiled_requests_total')
+    rule = request.url_rule
+    _metrics.observe(
+        'ledger_request_seconds',
+        (
+            ('method', request.method),
+            ('route', rule.rule if rule is not None else 'unmatched'),
+            ('status', str(g.get('response_status', 500))),
+        ),
+        timeit.default_timer() - g.request_start
+    )
+
+
 @app.teardown_appcontext
 def close_db(error):
+    if hasattr(g, 'ledger'):
+        g.ledger.close_archives()
     if hasattr(g, 'db'):
-        g.db.close()
+        if hasattr(g, 'accounts'):
+            check_in_db(g.db, g.accounts)
+        else:
+            g.db.close()
 
 
 def _transaction_to_json(transaction):
     return {
-        'date': transaction.date.strftime('%Y-%m-%d'),
+        'date': transaction.date.isoformat(),
         'description': transaction.description,
         'items': [
             {'account_code': item[0], 'amount': item[1]}
@@ -79,6 +327,44 @@ def _transaction_to_json(transaction):
     }
 
 
+def _transaction_from_json(data):
+    if not isinstance(data, dict):
+        raise ValueError('Expected a JSON object')
+    if 'date' not in data:
+        raise ValueError('Missing "date"')
+    if 'description' not in data:
+        raise ValueError('Missing "description"')
+    if 'items' not in data:
+        raise ValueError('Missing "items"')
+    if not data['items']:
+        raise ValueError('Cannot record an empty transaction')
+    if any('account_code' not in item for item in data['items']):
+        raise ValueError('All items must contain "account_code"')
+    if any('amount' not in item for item in data['items']):
+        raise ValueError('All items must contain "amount"')
+
+    return (
+        parse_date(data['date']),
+        data['description'],
+        [[item['account_code'], item['amount']] for item in data['items']]
+    )
+
+
+def _iter_json_documents(stream):
+    '''Iterate over a JSON array or newline-delimited JSON documents.
+
+    Only the latter are streamed; an array is parsed whole.
+    '''
+    first_line = stream.readline()
+    if first_line.lstrip().startswith('['):
+        return iter(json.loads(first_line + stream.read()))
+    return (
+        json.loads(line)
+        for line in itertools.chain([first_line], stream)
+        if line.strip()
+    )
+
+
 def _account_to_json(account, balance=None):
     result = {'code': account.code, 'name': account.name, 'type': account.type}
     if balance is not None:
@@ -89,8 +375,49 @@ def _account_to_json(account, balance=None):
 
 
 def _accounts_to_json(accounts_and_balances):
-    return [_account_to_json(account, balance)
-            for account, balance in accounts_and_balances.iteritems()]
+    return (_account_to_json(account, balance)
+            for account, balance in accounts_and_balances.iteritems())
+
+
+def _balance_sheet_to_json(balance_sheet):
+    return {
+        'date': balance_sheet.date.strftime('%d.%m.%Y'),
+        'asset': _accounts_to_json(balance_sheet.asset),
+        'liability': _accounts_to_json(balance_sheet.liability),
+        'equity': _accounts_to_json(balance_sheet.equity),
+    }
+
+
+def _account_nodes_to_json(nodes):
+    for node in nodes:
+        data = _account_to_json(node.account, node.total)
+        data['depth'] = node.depth
+        yield data
+
+
+def _classified_balance_sheet_to_json(balance_sheet):
+    return {
+        'date': balance_sheet.date.strftime('%d.%m.%Y'),
+        'asset': _account_nodes_to_json(balance_sheet.asset),
+        'liability': _account_nodes_to_json(balance_sheet.liability),
+        'equity': _account_nodes_to_json(balance_sheet.equity),
+        'retained_earnings': balance_sheet.retained_earnings,
+    }
+
+
+def _classified_income_statement_to_json(income_statement):
+    result = {
+        'start_date': income_statement.start_date.strftime('%d.%m.%Y'),
+        'end_date': income_statement.end_date.strftime('%d.%m.%Y'),
+        'expense': _account_nodes_to_json(income_statement.expense),
+        'revenue': _account_nodes_to_json(income_statement.revenue),
+    }
+
+    if income_statement.net_result >= 0:
+        result['net_income'] = income_statement.net_income
+    else:
+        result['net_loss'] = income_statement.net_loss
+    return result
 
 
 def _income_statement_to_json(income_statement):
@@ -108,22 +435,266 @@ def _income_statement_to_json(income_statement):
     return result
 
 
+class MoneyFormatter(object):
+    '''Format amounts in cents, e.g. 123400 as 1,234.00.
+
+    The conventions are fixed when the formatter is created so formatting
+    touches no global state and is safe to use from many threads.
+    '''
+
+    def __init__(self, decimal_point='.', thousands_sep=',',
+                 grouping=(3, 3, 0), negative_sign='-'):
+        self.decimal_point = decimal_point
+        self.thousands_sep = thousands_sep
+        self.grouping = tuple(grouping)
+        self.negative_sign = negative_sign
+
+    @classmethod
+    def from_locale(cls, name):
+        '''Return a formatter using the monetary conventions of a locale.'''
+        with _locale_lock:
+            previous_name = locale.setlocale(locale.LC_MONETARY)
+            locale.setlocale(locale.LC_MONETARY, name)
+            try:
+                conventions = locale.localeconv()
+            finally:
+                locale.setlocale(locale.LC_MONETARY, previous_name)
+        return cls(conventions['mon_decimal_point'] or '.',
+                   conventions['mon_thousands_sep'],
+                   conventions['mon_grouping'],
+                   conventions['negative_sign'] or '-')
+
+    def __call__(self, cents):
+        units, fraction = divmod(abs(cents), 100)
+        result = '{}{}{:02d}'.format(
+            self._group(str(units)), self.decimal_point, fraction
+        )
+        if cents < 0:
+            return self.negative_sign + result
+        return result
+
+    def _group(self, digits):
+        # grouping lists group sizes from the right; 0 repeats the last size
+        # and CHAR_MAX stops grouping.
+        if not self.thousands_sep:
+            return digits
+        groups = []
+        sizes = list(self.grouping)
+        size = None
+        while True:
+            if sizes:
+                next_size = sizes.pop(0)
+                if next_size == locale.CHAR_MAX:
+                    break
+                if next_size:
+                    size = next_size
+            if size is None or len(digits) <= size:
+                break
+            groups.append(digits[-size:])
+            digits = digits[:-size]
+        groups.append(digits)
+        return self.thousands_sep.join(reversed(groups))
+
+
+class FragmentCache(object):
+    '''A thread-safe LRU cache of rendered sections of HTML reports.
+
+    A fragment is keyed by its template and the section it's rendered from,
+    which holds everything shown, down to the formatted amounts. Sections
+    left unchanged by new transactions, or shared by reports on different
+    dates, are rendered once and nothing needs to be invalidated.
+    '''
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, template, section):
+        '''Return the section rendered with the template.'''
+        key = (template, section)
+        with self._lock:
+            fragment = self._entries.pop(key, None)
+            if fragment is not None:
+                self._entries[key] = fragment
+                self.hits += 1
+                return fragment
+            self.misses += 1
+
+        fragment = Markup(render_template(template, section=section))
+        with self._lock:
+            self._entries[key] = fragment
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return fragment
+
+
+_fragment_cache = FragmentCache()
+
+
+def get_fragment_cache():
+    max_size = app.config['FRAGMENT_CACHE_SIZE']
+    if not max_size:
+        return None
+    _fragment_cache.max_size = max_size
+    return _fragment_cache
+
+
+# A section of an HTML report: rows of accounts sorted by code and a total,
+# with amounts already formatted.
+ReportSection = namedtuple('ReportSection', 'title rows total_label total')
+ReportRow = namedtuple('ReportRow', 'code name balance')
+# Reports with their sections rendered, ready to be put in a page.
+BalanceSheetView = namedtuple('BalanceSheetView',
+                              'date asset liability equity')
+IncomeStatementView = namedtuple(
+    'IncomeStatementView',
+    'start_date end_date revenue expense net_label net_amount'
+)
+
+
+def _balance_sheet_view(balance_sheet):
+    format_money = get_money_formatter()
+    retained_earnings = ReportRow(
+        '', 'Retained Earnings', format_money(balance_sheet.retained_earnings)
+    )
+    return BalanceSheetView(
+        date=balance_sheet.date,
+        asset=_render_section('report_table.html', _report_section(
+            'Assets', balance_sheet.asset, 1,
+            'Total Assets', balance_sheet.total_assets
+        )),
+        liability=_render_section('report_table.html', _report_section(
+            'Liabilities', balance_sheet.liability, -1,
+            'Total Liabilities', balance_sheet.total_liabilities
+        )),
+        equity=_render_section('report_table.html', _report_section(
+            'Equity', balance_sheet.equity, -1,
+            'Total Equity', balance_sheet.total_equity,
+            extra_rows=(retained_earnings,)
+        )),
+    )
+
+
+def _income_statement_view(income_statement):
+    net_result = income_statement.net_result
+    return IncomeStatementView(
+        start_date=income_statement.start_date,
+        end_date=income_statement.end_date,
+        revenue=_render_section('report_rows.html', _report_section(
+            'Revenues', income_statement.revenue, -1,
+            'Total Revenues', income_statement.total_revenues
+        )),
+        expense=_render_section('report_rows.html', _report_section(
+            'Expenses', income_statement.expense, 1,
+            'Total Expenses', income_statement.total_expenses
+        )),
+        net_label='Net Income' if net_result > 0 else 'Net Loss',
+        net_amount=get_money_formatter()(abs(net_result))
+    )
+
+
+def _report_section(title, accounts_and_balances, sign, total_label, total,
+                    extra_rows=()):
+    format_money = get_money_formatter()
+    rows = tuple(
+        ReportRow(account.code, account.name, format_money(sign * balance))
+        for account, balance in sorted(accounts_and_balances.iteritems())
+    )
+    return ReportSection(title, rows + extra_rows, total_label,
+                         format_money(total))
+
+
+def _render_section(template, section):
+    cache = get_fragment_cache()
+    if cache is None:
+        return Markup(render_template(template, section=section))
+    return cache.render(template, section)
+
+
+def get_money_formatter():
+    name = app.config['MONETARY_LOCALE']
+    formatter = _money_formatters.get(name)
+    if formatter is None:
+        try:
+            formatter = MoneyFormatter.from_locale(name)
+        except locale.Error:
+            app.logger.warning(
+                'Locale %s is unavailable; formatting amounts as in en_US',
+                name
+            )
+            formatter = MoneyFormatter()
+        _money_formatters[name] = formatter
+    return formatter
+
+
 @app.template_filter('monetize')
 def monetize(value):
-    value = Decimal(value) / 100
-    locale.setlocale(locale.LC_MONETARY, ('en_US', 'UTF-8'))
-    return locale.currency(value, False, True)
+    return get_money_formatter()(value)
 
 
 @app.route('/accounts/<code>', methods=['GET'])
 def get_account(code):
     account = get_ledger().get_account(code)
     if account:
-        return jsonify(code=account.code, name=account.name, type=account.type)
+        result = _account_to_json(account)
+        parent = get_ledger().get_parent_account(code)
+        if parent is not None:
+            result['parent_code'] = parent.code
+        return jsonify(**result)
     else:
         return 'Account "{}" does not exist'.format(code), 404
 
 
+@app.route('/accounts/<code>/ledger', methods=['GET'])
+def get_account_ledger(code):
+    limit = request.args.get('limit', type=int)
+    try:
+        account_ledger = get_ledger().iter_account_ledger(
+            code,
+            start_date=_get_date_arg('from'),
+            end_date=_get_date_arg('to'),
+            after_id=request.args.get('after_id', type=int),
+            limit=limit
+        )
+    except ValueError as exc:
+        return str(exc), 400
+    if account_ledger is None:
+        return 'Account "{}" does not exist'.format(code), 404
+
+    return _stream_response(
+        _stream_account_ledger_json(account_ledger, limit),
+        'application/json'
+    )
+
+
+def _stream_account_ledger_json(account_ledger, limit):
+    yield '{{"account": {}, "opening_balance": {}, "items": ['.format(
+        json.dumps(_account_to_json(account_ledger.account)),
+        account_ledger.opening_balance
+    )
+    count = 0
+    for item in account_ledger.items:
+        if count:
+            yield ', '
+        yield json.dumps({
+            'id': item.id,
+            'transaction_id': item.transaction_id,
+            'date': item.date.isoformat(),
+            'description': item.description,
+            'amount': item.amount,
+            'balance': item.balance,
+        })
+        count += 1
+    yield ']'
+    # A full page means there may be more items to fetch.
+    if count and count == limit:
+        yield ', "next_after_id": {}'.format(item.id)
+    yield '}'
+
+
 @app.route('/accounts', methods=['POST'])
 def create_account():
     if request.json is None:
@@ -139,9 +710,12 @@ def create_account():
         return '"type" must be one of {}'.format(', '.join(allowed_types)), 400
 
     try:
-        get_ledger().create_account(request.json['code'], request.json['name'],
-                                    request.json['type'])
+        write_ledger('create_account', request.json['code'],
+                     request.json['name'], request.json['type'],
+                     parent_code=request.json.get('parent_code'))
         return 'Created', 201
+    except ValueError as exc:
+        return str(exc), 400
     except LedgerError as exc:
         return str(exc), 409
 
@@ -157,82 +731,378 @@ def get_transaction(id):
 
 @app.route('/transactions', methods=['GET'])
 def get_transactions():
-    transactions = get_ledger().get_transactions()
-    return jsonify({
-        'transactions': [
-            _transaction_to_json(transaction) for transaction in transactions
-        ]
-    })
+    try:
+        start_date = _get_date_arg('from')
+        end_date = _get_date_arg('to')
+    except ValueError as exc:
+        return str(exc), 400
+    limit = request.args.get('limit', type=int)
+    ids = request.args.get('ids')
+    if ids is not None:
+        ignored = [name for name in ('from', 'to', 'account_code', 'after_id')
+                   if name in request.args]
+        if ignored:
+            return '"ids" can\'t be combined with "{}"'.format(
+                '", "'.join(ignored)
+            ), 400
+        try:
+            ids = [int(tx_id) for tx_id in ids.split(',')]
+        except ValueError:
+            return 'Invalid "ids"', 400
+        transactions = get_ledger().get_transactions_by_ids(ids)
+        # All requested transactions are returned at once.
+        limit = None
+    else:
+        transactions = get_ledger().iter_transactions(
+            after_id=request.args.get('after_id', type=int),
+            limit=limit,
+            start_date=start_date,
+            end_date=end_date,
+            account_code=request.args.get('account_code')
+        )
+
+    mimetype = request.accept_mimetypes.best_match(
+        ['application/json', 'application/x-ndjson'],
+        default='application/json'
+    )
+    if mimetype == 'application/x-ndjson':
+        body = _stream_transactions_ndjson(transactions)
+    else:
+        body = _stream_transactions_json(transactions, limit)
+    return _stream_response(body, mimetype)
+
+
+def _json_response(value):
+    '''Stream the JSON encoding of value, consuming iterables lazily.
+
+    The iterables must not read the database; use _stream_response for
+    bodies that need the request context.
+    '''
+    return Response(jsonstream.iterencode(value), mimetype='application/json')
+
+
+def _stream_response(pieces, mimetype):
+    '''Stream strings produced within the request context in chunks.'''
+    return Response(stream_with_context(jsonstream.chunk(pieces)),
+                    mimetype=mimetype)
+
+
+def _get_date_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return parse_date(value)
+
+
+def _stream_transactions_json(transactions, limit):
+    yield '{"transactions": ['
+    count = 0
+    for tx_id, transaction in transactions:
+        if count:
+            yield ', '
+        yield json.dumps(_transaction_to_json(transaction))
+        count += 1
+    yield ']'
+    # A full page means there may be more transactions to fetch.
+    if count and count == limit:
+        yield ', "next_after_id": {}'.format(tx_id)
+    yield '}'
+
+
+def _stream_transactions_ndjson(transactions):
+    for tx_id, transaction in transactions:
+        data = _transaction_to_json(transaction)
+        data['id'] = tx_id
+        yield json.dumps(data) + '\n'
 
 
 @app.route('/transactions', methods=['POST'])
 def record_transaction():
-    if 'date' not in request.json:
-        return 'Missing "date"', 400
-    if 'description' not in request.json:
-        return 'Missing "description"', 400
-    if 'items' not in request.json:
-        return 'Missing "items"', 400
-    if not request.json['items']:
-        return 'Cannot record an empty transaction', 400
-    if any('account_code' not in item for item in request.json['items']):
-        return 'All items must contain "account_code"', 400
-    if any('amount' not in item for item in request.json['items']):
-        return 'All items must contain "amount"', 400
-
     try:
-        date = datetime.strptime(request.json['date'], '%Y-%m-%d').date()
-        transaction_id = get_ledger().record_transaction(
-            date,
-            request.json['description'],
-            [[item['account_code'], item['amount']]
-             for item in request.json['items']]
+        transaction_id = write_ledger(
+            'record_transaction', *_transaction_from_json(request.json)
         )
         return str(transaction_id), 201
     except (ValueError, LedgerError) as exc:
         return str(exc), 400
 
 
+@app.route('/transactions/batch', methods=['POST'])
+def record_transactions():
+    # The body is read and parsed here, not on the writer thread, so a slow
+    # client doesn't hold the write lock. Each batch is committed on its own
+    # whether or not writes are queued.
+    batch_size = app.config['IMPORT_BATCH_SIZE']
+    tx_ids = []
+    batch = []
+    try:
+        for data in _iter_json_documents(request.stream):
+            batch.append(_transaction_from_json(data))
+            if len(batch) >= batch_size:
+                tx_ids.extend(write_ledger('record_transactions', batch,
+                                           batch_size=batch_size))
+                batch = []
+        if batch:
+            tx_ids.extend(write_ledger('record_transactions', batch,
+                                       batch_size=batch_size))
+        return jsonify(transaction_ids=tx_ids), 201
+    except (ValueError, LedgerError) as exc:
+        # Batches before the failing one have been committed. Errors reading
+        # the body have no index within the batch.
+        index = len(tx_ids) + getattr(exc, 'index', len(batch))
+        return jsonify(error=str(exc), transaction_ids=tx_ids,
+                       index=index), 400
+
+
+@app.route('/period-closings', methods=['POST'])
+def close_period():
+    if request.json is None:
+        return 'Expected JSON-encoded data', 400
+    if 'end_date' not in request.json:
+        return 'Missing "end_date"', 400
+    if 'retained_earnings_code' not in request.json:
+        return 'Missing "retained_earnings_code"', 400
+    try:
+        transaction_id = write_ledger(
+            'close_period', parse_date(request.json['end_date']),
+            request.json['retained_earnings_code']
+        )
+    except (ValueError, LedgerError) as exc:
+        return str(exc), 400
+    return jsonify(transaction_id=transaction_id), 201
+
+
+@app.route('/period-closings/<date>', methods=['GET'])
+def get_period_closing(date):
+    try:
+        date = parse_date(date)
+    except ValueError as exc:
+        return str(exc), 400
+    closing = get_ledger().get_period_closing(date)
+    if closing is None:
+        return 'The books were not closed on {}'.format(date), 404
+    return _json_response({
+        'end_date': closing.end_date.isoformat(),
+        'transaction_id': closing.transaction_id,
+        'retained_earnings_code': closing.retained_earnings.code,
+        'opening_balances': (
+            _account_to_json(account, balance)
+            for account, balance in sorted(closing.balances.iteritems())
+        ),
+    })
+
+
+def _report_response(key, render):
+    '''Render a report unless the client has the cached version.'''
+    cache = get_report_cache()
+    etag = cache.get_etag(key) if cache is not None else None
+    if etag is not None and etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = app.make_response(render())
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+
+@app.route('/trial-balance', methods=['GET'])
+def get_trial_balance():
+    try:
+        date = _get_date_arg('date')
+    except ValueError as exc:
+        return str(exc), 400
+    trial_balance = get_ledger().get_trial_balance(date)
+
+    return _json_response({
+        'date': date.strftime('%d.%m.%Y') if date is not None else None,
+        'accounts': _trial_balance_accounts_to_json(trial_balance),
+        'total_debits': trial_balance.total_debits,
+        'total_credits': trial_balance.total_credits,
+    })
+
+
+def _trial_balance_accounts_to_json(trial_balance):
+    for account in sorted(trial_balance.accounts):
+        balance = trial_balance.accounts[account]
+        result = _account_to_json(account)
+        if balance >= 0:
+            result['debit'] = balance
+        else:
+            result['credit'] = -balance
+        yield result
+
+
 @app.route('/balance-sheets/<date>.json', methods=['GET'])
 def get_json_balance_sheet(date):
-    date = datetime.strptime(date, '%Y-%m-%d').date()
+    date = parse_date(date)
     balance_sheet = get_ledger().get_balance_sheet(date)
-    return jsonify(
-        date=balance_sheet.date.strftime('%d.%m.%Y'),
-        asset=_accounts_to_json(balance_sheet.asset),
-        liability=_accounts_to_json(balance_sheet.liability),
-        equity=_accounts_to_json(balance_sheet.equity)
+    return _report_response(
+        ReportCache.balance_sheet_key(date),
+        lambda: _json_response(_balance_sheet_to_json(balance_sheet))
     )
 
 
+@app.route('/balance-sheets/series', methods=['GET'])
+@app.route('/balance-sheets/series.json', methods=['GET'])
+def get_json_balance_sheet_series():
+    try:
+        dates = [period_end for _, period_end in split_periods(
+            *_get_series_args()
+        )]
+    except ValueError as exc:
+        return str(exc), 400
+
+    balance_sheets = get_ledger().get_balance_sheet_series(dates)
+    return _json_response({'balance_sheets': (
+        _balance_sheet_to_json(balance_sheet)
+        for balance_sheet in balance_sheets
+    )})
+
+
 @app.route('/balance-sheets/<date>.html', methods=['GET'])
 def get_html_balance_sheet(date):
-    date = datetime.strptime(date, '%Y-%m-%d').date()
-    return render_template('balance_sheet.html',
-                           balance_sheet=get_ledger().get_balance_sheet(date))
+    date = parse_date(date)
+    balance_sheet = get_ledger().get_balance_sheet(date)
+    return _report_response(
+        ReportCache.balance_sheet_key(date),
+        lambda: render_template('balance_sheet.html',
+                                balance_sheet=_balance_sheet_view(
+                                    balance_sheet
+                                ))
+    )
+
+
+@app.route('/classified-balance-sheets/<date>.json', methods=['GET'])
+def get_json_classified_balance_sheet(date):
+    date = parse_date(date)
+    balance_sheet = get_ledger().get_classified_balance_sheet(date)
+    return _report_response(
+        ReportCache.balance_sheet_key(date, classified=True),
+        lambda: _json_response(
+            _classified_balance_sheet_to_json(balance_sheet)
+        )
+    )
+
+
+@app.route('/classified-balance-sheets/<date>.html', methods=['GET'])
+def get_html_classified_balance_sheet(date):
+    date = parse_date(date)
+    balance_sheet = get_ledger().get_classified_balance_sheet(date)
+    return _report_response(
+        ReportCache.balance_sheet_key(date, classified=True),
+        lambda: render_template('classified_balance_sheet.html',
+                                balance_sheet=balance_sheet)
+    )
 
 
 @app.route('/income-statements/<start_date>-to-<end_date>.json',
            methods=['GET'])
 def get_json_income_statement(start_date, end_date):
-    start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
-    end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
+    start_date = parse_date(start_date)
+    end_date = parse_date(end_date)
     income_statement = get_ledger().get_income_statement(start_date, end_date)
-    return jsonify(
-            **_income_statement_to_json(income_statement)
+    return _report_response(
+        ReportCache.income_statement_key(start_date, end_date),
+        lambda: _json_response(_income_statement_to_json(income_statement))
+    )
+
+
+def _get_income_statement_series():
+    return get_ledger().get_income_statement_series(*_get_series_args())
+
+
+def _get_series_args():
+    '''Return the from and to dates and the step of a report series.'''
+    start_date = _get_date_arg('from')
+    end_date = _get_date_arg('to')
+    if start_date is None or end_date is None:
+        raise ValueError('Missing "from" or "to"')
+    if start_date > end_date:
+        raise ValueError('"from" must not be after "to"')
+    return start_date, end_date, request.args.get('step', 'month')
+
+
+@app.route('/income-statements/series.json', methods=['GET'])
+def get_json_income_statement_series():
+    try:
+        income_statements = _get_income_statement_series()
+    except ValueError as exc:
+        return str(exc), 400
+    return _json_response({'income_statements': (
+        _income_statement_to_json(income_statement)
+        for income_statement in income_statements
+    )})
+
+
+@app.route('/income-statements/series.html', methods=['GET'])
+def get_html_income_statement_series():
+    try:
+        income_statements = _get_income_statement_series()
+    except ValueError as exc:
+        return str(exc), 400
+    return render_template(
+        'income_statement_series.html',
+        income_statements=income_statements,
+        revenue_accounts=sorted(income_statements[0].revenue),
+        expense_accounts=sorted(income_statements[0].expense)
     )
 
 
 @app.route('/income-statements/<start_date>-to-<end_date>.html',
            methods=['GET'])
 def get_html_income_statement(start_date, end_date):
-    start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
-    end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
-    return render_template(
-        'income_statement.html',
-        income_statement=get_ledger().get_income_statement(start_date, end_date)
+    start_date = parse_date(start_date)
+    end_date = parse_date(end_date)
+    income_statement = get_ledger().get_income_statement(start_date, end_date)
+    return _report_response(
+        ReportCache.income_statement_key(start_date, end_date),
+        lambda: render_template('income_statement.html',
+                                income_statement=_income_statement_view(
+                                    income_statement
+                                ))
     )
 
 
+@app.route('/classified-income-statements/<start_date>-to-<end_date>.json',
+           methods=['GET'])
+def get_json_classified_income_statement(start_date, end_date):
+    start_date = parse_date(start_date)
+    end_date = parse_date(end_date)
+    income_statement = get_ledger().get_classified_income_statement(
+        start_date, end_date
+    )
+    return _report_response(
+        ReportCache.income_statement_key(start_date, end_date,
+                                         classified=True),
+        lambda: _json_response(
+            _classified_income_statement_to_json(income_statement)
+        )
+    )
+
+
+@app.route('/classified-income-statements/<start_date>-to-<end_date>.html',
+           methods=['GET'])
+def get_html_classified_income_statement(start_date, end_date):
+    start_date = parse_date(start_date)
+    end_date = parse_date(end_date)
+    income_statement = get_ledger().get_classified_income_statement(
+        start_date, end_date
+    )
+    return _report_response(
+        ReportCache.income_statement_key(start_date, end_date,
+                                         classified=True),
+        lambda: render_template('classified_income_statement.html',
+                                income_statement=income_statement)
+    )
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not app.config['METRICS']:
+        return 'Metrics are disabled', 404
+    return Response(_metrics.render(app.config['PROFILE_LIMIT']),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 if __name__ == '__main__':
     app.run()
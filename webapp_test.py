@@ -1,4 +1,7 @@
 import json
+import locale
+import sqlite3
+import threading
 import unittest
 
 import webapp
@@ -12,6 +15,48 @@ class WebAppTestCase(unittest.TestCase):
         with webapp.app.app_context():
             webapp.reset_ledger()
 
+    def test_connection_pool(self):
+        with webapp.app.app_context():
+            db = webapp.get_db()
+        with webapp.app.app_context():
+            self.assertIs(db, webapp.get_db())
+            self.assertEqual(
+                'wal', db.execute('PRAGMA journal_mode').fetchone()[0]
+            )
+            self.assertEqual(
+                1, db.execute('PRAGMA synchronous').fetchone()[0]
+            )
+
+    def test_connection_pool_across_threads(self):
+        connections = []
+
+        def request():
+            with webapp.app.app_context():
+                connections.append(webapp.get_db())
+                webapp.get_ledger().count_transactions()
+
+        for _ in xrange(3):
+            thread = threading.Thread(target=request)
+            thread.start()
+            thread.join()
+        self.assertEqual(1, len(set(connections)))
+
+        # Connections beyond the pool size are closed when returned.
+        webapp.app.config['SQLITE_POOL_SIZE'] = 1
+        webapp._pools.clear()
+        try:
+            with webapp.app.app_context():
+                first = webapp.get_db()
+                with webapp.app.app_context():
+                    second = webapp.get_db()
+            with webapp.app.app_context():
+                self.assertIs(second, webapp.get_db())
+            self.assertRaises(sqlite3.ProgrammingError, first.execute,
+                              'SELECT 1')
+        finally:
+            webapp.app.config['SQLITE_POOL_SIZE'] = 8
+            webapp._pools.clear()
+
     def test_create_account_and_get_account(self):
         with webapp.app.app_context():
             response = self._create_account('101', 'Cash', 'asset')
@@ -27,6 +72,48 @@ class WebAppTestCase(unittest.TestCase):
                 response
             )
 
+    def test_get_account_ledger(self):
+        with webapp.app.app_context():
+            self._create_account('101', 'Cash', 'asset')
+            self._create_account('320', 'Share Capital', 'equity')
+            for day in range(1, 4):
+                self._record_transaction(
+                    '2016-09-0{}'.format(day),
+                    'Investment #{}'.format(day),
+                    [
+                        {'account_code': '101', 'amount': 10000},
+                        {'account_code': '320', 'amount': -10000}
+                    ]
+                )
+
+            response = self.app.get(
+                '/accounts/101/ledger?from=2016-09-02&limit=1'
+            )
+            self.assertEqual(200, response.status_code)
+            data = json.loads(response.data)
+            self.assertEqual(10000, data['opening_balance'])
+            self.assertEqual(
+                [('2016-09-02', 10000, 20000)],
+                [(item['date'], item['amount'], item['balance'])
+                 for item in data['items']]
+            )
+
+            response = self.app.get(
+                '/accounts/101/ledger?from=2016-09-02&after_id={}'.format(
+                    data['next_after_id']
+                )
+            )
+            data = json.loads(response.data)
+            self.assertEqual(
+                [('2016-09-03', 10000, 30000)],
+                [(item['date'], item['amount'], item['balance'])
+                 for item in data['items']]
+            )
+
+            self.assertEqual(
+                404, self.app.get('/accounts/102/ledger').status_code
+            )
+
     def test_create_account_incomplete(self):
         self.assertEqual(
             400, self._create_account(None, 'Cash', 'asset').status_code
@@ -92,6 +179,37 @@ class WebAppTestCase(unittest.TestCase):
                 response
             )
 
+    def test_record_transaction_with_writer_queue(self):
+        webapp.app.config['WRITER_QUEUE'] = True
+        try:
+            with webapp.app.app_context():
+                self._create_account('101', 'Cash', 'asset')
+                self._create_account('320', 'Share Capital', 'equity')
+
+                self.assertEqual(
+                    409,
+                    self._create_account('101', 'Cash', 'asset').status_code
+                )
+
+                response = self._record_transaction(
+                    '2016-09-01',
+                    "Record the founder's investment",
+                    [
+                        {'account_code': '101', 'amount': 10000},
+                        {'account_code': '320', 'amount': -10000}
+                    ]
+                )
+
+                self.assertEqual(201, response.status_code)
+                self.assertEqual(
+                    200,
+                    self._get_transaction(int(response.get_data())).status_code
+                )
+        finally:
+            webapp.app.config['WRITER_QUEUE'] = False
+            with webapp.app.app_context():
+                webapp.get_writer().stop()
+
     def test_record_transaction_empty(self):
         self._create_account('101', 'Cash', 'asset')
         self._create_account('320', 'Share Capital', 'equity')
@@ -175,6 +293,129 @@ class WebAppTestCase(unittest.TestCase):
         )
         self.assertEqual(400, response.status_code)
 
+    def test_record_transactions_json(self):
+        with webapp.app.app_context():
+            self._create_account('101', 'Cash', 'asset')
+            self._create_account('320', 'Share Capital', 'equity')
+
+            response = self._post_json('/transactions/batch', [
+                {
+                    'date': '2016-09-01',
+                    'description': "Record the founder's investment",
+                    'items': [
+                        {'account_code': '101', 'amount': 10000},
+                        {'account_code': '320', 'amount': -10000}
+                    ]
+                },
+                {
+                    'date': '2016-09-02',
+                    'description': "Record the second investment",
+                    'items': [
+                        {'account_code': '101', 'amount': 5000},
+                        {'account_code': '320', 'amount': -5000}
+                    ]
+                }
+            ])
+
+            self.assertEqual(201, response.status_code)
+            tx_ids = json.loads(response.data)['transaction_ids']
+            self.assertEqual(2, len(tx_ids))
+            self.assertEqual(
+                "Record the second investment",
+                json.loads(
+                    self._get_transaction(tx_ids[1]).data
+                )['description']
+            )
+
+    def test_record_transactions_ndjson(self):
+        with webapp.app.app_context():
+            self._create_account('101', 'Cash', 'asset')
+            self._create_account('320', 'Share Capital', 'equity')
+            transaction = {
+                'date': '2016-09-01',
+                'description': "Record the founder's investment",
+                'items': [
+                    {'account_code': '101', 'amount': 10000},
+                    {'account_code': '320', 'amount': -10000}
+                ]
+            }
+
+            response = self.app.post(
+                '/transactions/batch',
+                content_type='application/x-ndjson',
+                data='\n'.join(json.dumps(transaction) for _ in range(3))
+            )
+
+            self.assertEqual(201, response.status_code)
+            self.assertEqual(
+                3, len(json.loads(response.data)['transaction_ids'])
+            )
+
+    def test_record_transactions_later_batch_invalid(self):
+        with webapp.app.app_context():
+            self._create_account('101', 'Cash', 'asset')
+            self._create_account('320', 'Share Capital', 'equity')
+            transactions = [
+                {
+                    'date': '2016-09-0{}'.format(day),
+                    'description': 'Investment',
+                    'items': [
+                        {'account_code': '101', 'amount': 100},
+                        {'account_code': '320', 'amount': -100}
+                    ]
+                }
+                for day in range(1, 6)
+            ]
+            webapp.app.config['IMPORT_BATCH_SIZE'] = 2
+            try:
+                transactions[3]['items'].pop()
+                response = self._post_json('/transactions/batch',
+                                           transactions)
+                self.assertEqual(400, response.status_code)
+                result = json.loads(response.data)
+                self.assertEqual([1, 2], result['transaction_ids'])
+                self.assertEqual(3, result['index'])
+                self.assertEqual('unbalanced transaction items',
+                                 result['error'])
+
+                transactions[3]['items'] = transactions[0]['items']
+                del transactions[4]['description']
+                response = self._post_json('/transactions/batch',
+                                           transactions)
+                self.assertEqual(400, response.status_code)
+                result = json.loads(response.data)
+                self.assertEqual([3, 4, 5, 6], result['transaction_ids'])
+                self.assertEqual(4, result['index'])
+            finally:
+                webapp.app.config['IMPORT_BATCH_SIZE'] = 1000
+
+    def test_record_transactions_with_writer_queue(self):
+        webapp.app.config['WRITER_QUEUE'] = True
+        try:
+            # Committed per batch, as without the queue.
+            self.test_record_transactions_later_batch_invalid()
+            with webapp.app.app_context():
+                self.assertLessEqual(4, webapp.get_writer().commits)
+        finally:
+            webapp.app.config['WRITER_QUEUE'] = False
+            with webapp.app.app_context():
+                webapp.get_writer().stop()
+
+    def test_record_transactions_invalid(self):
+        self._create_account('101', 'Cash', 'asset')
+
+        response = self._post_json('/transactions/batch', [
+            {
+                'date': '2016-09-01',
+                'items': [
+                    {'account_code': '101', 'amount': 10000},
+                    {'account_code': '320', 'amount': -10000}
+                ]
+            }
+        ])
+
+        self.assertEqual(400, response.status_code)
+
     def test_get_transactions(self):
         with webapp.app.app_context():
             self._create_account('101', 'Cash', 'asset')
@@ -223,6 +464,115 @@ class WebAppTestCase(unittest.TestCase):
                 response
             )
 
+    def test_get_transactions_paginated(self):
+        with webapp.app.app_context():
+            self._create_account('101', 'Cash', 'asset')
+            self._create_account('102', 'Equipment', 'asset')
+            self._create_account('320', 'Share Capital', 'equity')
+            for day in range(1, 6):
+                self._record_transaction(
+                    '2016-09-0{}'.format(day),
+                    'Investment #{}'.format(day),
+                    [
+                        {'account_code': '101', 'amount': 10000},
+                        {'account_code': '320', 'amount': -10000}
+                    ]
+                )
+            self._record_transaction(
+                '2016-09-06',
+                "Buy a computer",
+                [
+                    {'account_code': '101', 'amount': -2000},
+                    {'account_code': '102', 'amount': 2000}
+                ]
+            )
+
+            response = self.app.get('/transactions?limit=2&from=2016-09-02')
+            self.assertEqual(200, response.status_code)
+            data = json.loads(response.data)
+            self.assertEqual(['Investment #2', 'Investment #3'],
+                             [tx['description']
+                              for tx in data['transactions']])
+
+            response = self.app.get(
+                '/transactions?limit=2&from=2016-09-02&after_id={}'.format(
+                    data['next_after_id']
+                )
+            )
+            data = json.loads(response.data)
+            self.assertEqual(['Investment #4', 'Investment #5'],
+                             [tx['description']
+                              for tx in data['transactions']])
+
+            response = self.app.get(
+                '/transactions?to=2016-09-06&account_code=102',
+                headers={'Accept': 'application/x-ndjson'}
+            )
+            self.assertEqual('application/x-ndjson', response.content_type)
+            self.assertEqual(
+                [{
+                    'id': 6,
+                    'date': '2016-09-06',
+                    'description': 'Buy a computer',
+                    'items': [
+                        {'account_code': '101', 'amount': -2000},
+                        {'account_code': '102', 'amount': 2000}
+                    ]
+                }],
+                [json.loads(line)
+                 for line in response.data.splitlines()]
+            )
+
+    def test_get_transactions_by_ids(self):
+        with webapp.app.app_context():
+            self._create_account('101', 'Cash', 'asset')
+            self._create_account('320', 'Share Capital', 'equity')
+            for day in range(1, 6):
+                self._record_transaction(
+                    '2016-09-0{}'.format(day),
+                    'Investment #{}'.format(day),
+                    [
+                        {'account_code': '101', 'amount': 10000},
+                        {'account_code': '320', 'amount': -10000}
+                    ]
+                )
+
+            response = self.app.get('/transactions?ids=4,2,42&limit=1')
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(
+                {'transactions': [
+                    {
+                        'date': '2016-09-02',
+                        'description': 'Investment #2',
+                        'items': [
+                            {'account_code': '101', 'amount': 10000},
+                            {'account_code': '320', 'amount': -10000}
+                        ]
+                    },
+                    {
+                        'date': '2016-09-04',
+                        'description': 'Investment #4',
+                        'items': [
+                            {'account_code': '101', 'amount': 10000},
+                            {'account_code': '320', 'amount': -10000}
+                        ]
+                    }
+                ]},
+                json.loads(response.data)
+            )
+
+            self.assertEqual(400,
+                             self.app.get('/transactions?ids=1,x').status_code)
+            # Filters don't apply to listed transactions.
+            for query in ['from=2016-09-03', 'to=2016-09-03',
+                          'account_code=101', 'after_id=2']:
+                response = self.app.get('/transactions?ids=2,4&' + query)
+                self.assertEqual(400, response.status_code)
+
+    def test_get_transactions_invalid_date(self):
+        response = self.app.get('/transactions?from=20160901')
+        self.assertEqual(400, response.status_code)
+
     def test_get_transaction_non_existent(self):
         self._create_account('101', 'Cash', 'asset')
         self._create_account('320', 'Share Capital', 'equity')
@@ -389,6 +739,347 @@ class WebAppTestCase(unittest.TestCase):
                 response
             )
 
+    def test_get_balance_sheet_series(self):
+        with webapp.app.app_context():
+            self._create_account('101', 'Cash', 'asset')
+            self._create_account('320', 'Share Capital', 'equity')
+            self._record_transaction(
+                '2016-09-01',
+                "Record the founder's investment",
+                [
+                    {'account_code': '101', 'amount': 10000},
+                    {'account_code': '320', 'amount': -10000}
+                ]
+            )
+
+            for url in ('/balance-sheets/series',
+                        '/balance-sheets/series.json'):
+                response = self.app.get(url + '?from=2016-08-15&to=2016-09-15')
+                self.assertEqual(200, response.status_code)
+                self.assertEqual(
+                    [('31.08.2016', 0), ('15.09.2016', 10000)],
+                    [(balance_sheet['date'],
+                      balance_sheet['asset'][0]['balance'])
+                     for balance_sheet
+                     in json.loads(response.data)['balance_sheets']]
+                )
+
+            response = self.app.get(
+                '/balance-sheets/series.json?from=2016-08-15&to=2016-09-15'
+                '&step=decade'
+            )
+            self.assertEqual(400, response.status_code)
+
+    def test_get_income_statement_series(self):
+        with webapp.app.app_context():
+            self._create_account('101', 'Cash', 'asset')
+            self._create_account('401', 'Revenue', 'revenue')
+            self._record_transaction(
+                '2016-09-01',
+                "Consulting",
+                [
+                    {'account_code': '101', 'amount': 10000},
+                    {'account_code': '401', 'amount': -10000}
+                ]
+            )
+
+            response = self.app.get(
+                '/income-statements/series.json'
+                '?from=2016-08-15&to=2016-12-31&step=quarter'
+            )
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(
+                [('15.08.2016', 10000), ('01.10.2016', 0)],
+                [(income_statement['start_date'],
+                  income_statement['revenue'][0]['balance'])
+                 for income_statement
+                 in json.loads(response.data)['income_statements']]
+            )
+
+            response = self.app.get('/income-statements/series.json')
+            self.assertEqual(400, response.status_code)
+
+            response = self.app.get(
+                '/income-statements/series.html'
+                '?from=2016-08-15&to=2016-12-31&step=month'
+            )
+            self.assertEqual(200, response.status_code)
+            self.assertIn('Revenue', response.data)
+            self.assertIn('100.00', response.data)
+            self.assertEqual(5, response.data.count('<th class="period">'))
+
+            for url in [
+                '/income-statements/series.html?from=2016-10-01'
+                '&to=2016-09-01',
+                '/income-statements/series.json?from=2016-10-01'
+                '&to=2016-09-01',
+                '/income-statements/series.html?from=2016-09-01',
+            ]:
+                self.assertEqual(400, self.app.get(url).status_code)
+
+    def test_get_classified_reports(self):
+        with webapp.app.app_context():
+            self._create_account('100', 'Current Assets', 'asset')
+            self._post_json('/accounts', {'code': '101', 'name': 'Cash',
+                                          'type': 'asset',
+                                          'parent_code': '100'})
+            self._create_account('400', 'Revenue', 'revenue')
+            self._post_json('/accounts', {'code': '401',
+                                          'name': 'Consulting Revenue',
+                                          'type': 'revenue',
+                                          'parent_code': '400'})
+            self._record_transaction(
+                '2016-09-01',
+                'Consulting',
+                [
+                    {'account_code': '101', 'amount': 10000},
+                    {'account_code': '401', 'amount': -10000}
+                ]
+            )
+
+            self.assertJson(
+                {'code': '101', 'name': 'Cash', 'type': 'asset',
+                 'parent_code': '100'},
+                self._get_account('101')
+            )
+            self.assertEqual(
+                400,
+                self._post_json('/accounts', {'code': '402', 'name': 'Loan',
+                                              'type': 'liability',
+                                              'parent_code': '400'})
+                .status_code
+            )
+
+            response = self.app.get(
+                '/classified-balance-sheets/2016-09-30.json'
+            )
+            self.assertEqual(200, response.status_code)
+            data = json.loads(response.data)
+            self.assertEqual(
+                [
+                    {'code': '100', 'name': 'Current Assets',
+                     'type': 'asset', 'balance': 10000, 'depth': 0},
+                    {'code': '101', 'name': 'Cash', 'type': 'asset',
+                     'balance': 10000, 'depth': 1},
+                ],
+                data['asset']
+            )
+            self.assertEqual(10000, data['retained_earnings'])
+
+            response = self.app.get(
+                '/classified-income-statements/2016-09-01-to-2016-09-30.json'
+            )
+            data = json.loads(response.data)
+            self.assertEqual([('400', 10000), ('401', 10000)],
+                             [(account['code'], account['balance'])
+                              for account in data['revenue']])
+            self.assertEqual(10000, data['net_income'])
+
+            for url, name in [
+                ('/classified-balance-sheets/2016-09-30.html', 'Cash'),
+                ('/classified-income-statements/2016-09-01-to-2016-09-30.html',
+                 'Consulting Revenue'),
+            ]:
+                response = self.app.get(url)
+                self.assertEqual(200, response.status_code)
+                self.assertIn(name, response.data)
+                self.assertIn('100.00', response.data)
+
+    def test_html_report_fragments(self):
+        with webapp.app.app_context():
+            self._create_account('102', 'Equipment', 'asset')
+            self._create_account('101', 'Cash', 'asset')
+            self._create_account('301', 'Share Capital', 'equity')
+            self._create_account('401', 'Revenue', 'revenue')
+            self._record_transaction(
+                '2016-09-01',
+                'Investment',
+                [
+                    {'account_code': '101', 'amount': 100000},
+                    {'account_code': '301', 'amount': -100000}
+                ]
+            )
+            self._record_transaction(
+                '2016-09-03',
+                'Consulting',
+                [
+                    {'account_code': '101', 'amount': 2500},
+                    {'account_code': '401', 'amount': -2500}
+                ]
+            )
+
+            cache = webapp.get_fragment_cache()
+            response = self.app.get('/balance-sheets/2016-09-01.html')
+            self.assertEqual(200, response.status_code)
+            self.assertLess(response.data.index('101'),
+                            response.data.index('102'))
+            self.assertIn('1,000.00', response.data)
+
+            # Only the asset and equity sections changed since 1 September.
+            hits, misses = cache.hits, cache.misses
+            response = self.app.get('/balance-sheets/2016-09-03.html')
+            self.assertIn('1,025.00', response.data)
+            self.assertEqual(hits + 1, cache.hits)
+            self.assertEqual(misses + 2, cache.misses)
+
+            response = self.app.get(
+                '/income-statements/2016-09-01-to-2016-09-30.html'
+            )
+            self.assertIn('Net Income', response.data)
+            self.assertIn('25.00', response.data)
+
+    def test_get_metrics(self):
+        self.assertEqual(404, self.app.get('/metrics').status_code)
+        with webapp.app.app_context():
+            webapp.app.config['METRICS'] = True
+            webapp.app.config['METRICS_VM_STEPS'] = True
+            webapp.app.config['PROFILE_SAMPLE_RATE'] = 1
+            try:
+                self._create_account('101', 'Cash', 'asset')
+                self.assertEqual(404, self.app.get('/accounts/102')
+                                 .status_code)
+                response = self.app.get('/metrics')
+            finally:
+                webapp.app.config['METRICS'] = False
+                webapp.app.config['METRICS_VM_STEPS'] = False
+                webapp.app.config['PROFILE_SAMPLE_RATE'] = 0
+
+            self.assertEqual(200, response.status_code)
+            self.assertTrue(response.content_type.startswith('text/plain'))
+            self.assertIn(
+                'ledger_request_seconds_count{method="GET",'
+                'route="/accounts/<code>",status="404"}',
+                response.data
+            )
+            self.assertIn('ledger_sql_seconds_count{statement="INSERT INTO '
+                          'accounts', response.data)
+            self.assertIn('ledger_profiled_requests_total', response.data)
+            self.assertIn('ledger_profile_self_seconds{', response.data)
+
+    def test_close_period(self):
+        with webapp.app.app_context():
+            self._create_account('101', 'Cash', 'asset')
+            self._create_account('320', 'Retained Earnings', 'equity')
+            self._create_account('401', 'Revenue', 'revenue')
+            self._record_transaction(
+                '2016-09-01',
+                'Consulting',
+                [
+                    {'account_code': '101', 'amount': 10000},
+                    {'account_code': '401', 'amount': -10000}
+                ]
+            )
+
+            self.assertEqual(
+                400, self._post_json('/period-closings',
+                                     {'end_date': '2016-12-31'}).status_code
+            )
+            response = self._post_json(
+                '/period-closings',
+                {'end_date': '2016-12-31', 'retained_earnings_code': '320'}
+            )
+            self.assertEqual(201, response.status_code)
+            self.assertEqual(2, json.loads(response.data)['transaction_id'])
+
+            response = self.app.get('/period-closings/2016-12-31')
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(
+                {
+                    'end_date': '2016-12-31',
+                    'transaction_id': 2,
+                    'retained_earnings_code': '320',
+                    'opening_balances': [
+                        {'code': '101', 'name': 'Cash', 'type': 'asset',
+                         'balance': 10000},
+                        {'code': '320', 'name': 'Retained Earnings',
+                         'type': 'equity', 'balance': 10000},
+                        {'code': '401', 'name': 'Revenue', 'type': 'revenue',
+                         'balance': 0},
+                    ],
+                },
+                json.loads(response.data)
+            )
+            self.assertEqual(
+                404, self.app.get('/period-closings/2016-12-30').status_code
+            )
+
+            response = self._record_transaction(
+                '2016-12-01',
+                'Late',
+                [
+                    {'account_code': '101', 'amount': 100},
+                    {'account_code': '401', 'amount': -100}
+                ]
+            )
+            self.assertEqual(400, response.status_code)
+
+    def test_get_trial_balance(self):
+        with webapp.app.app_context():
+            self._create_account('101', 'Cash', 'asset')
+            self._create_account('320', 'Share Capital', 'equity')
+            self._record_transaction(
+                '2016-09-02',
+                "Record the founder's investment",
+                [
+                    {'account_code': '101', 'amount': 10000},
+                    {'account_code': '320', 'amount': -10000}
+                ]
+            )
+
+            response = self.app.get('/trial-balance')
+            self.assertEqual(200, response.status_code)
+            self.assertJson(
+                {
+                    'date': None,
+                    'accounts': [
+                        {'code': '101', 'name': 'Cash', 'type': 'asset',
+                         'debit': 10000},
+                        {'code': '320', 'name': 'Share Capital',
+                         'type': 'equity', 'credit': 10000},
+                    ],
+                    'total_debits': 10000,
+                    'total_credits': 10000
+                },
+                response
+            )
+
+            response = self.app.get('/trial-balance?date=2016-09-01')
+            self.assertEqual(
+                0, json.loads(response.data)['total_debits']
+            )
+
+    def test_get_balance_sheet_not_modified(self):
+        with webapp.app.app_context():
+            self._create_account('101', 'Cash', 'asset')
+            self._create_account('320', 'Share Capital', 'equity')
+            self._record_transaction(
+                '2016-09-01',
+                "Record the founder's investment",
+                [
+                    {'account_code': '101', 'amount': 10000},
+                    {'account_code': '320', 'amount': -10000}
+                ]
+            )
+
+            response = self.app.get('/balance-sheets/2016-09-01.json')
+            etag = response.headers['ETag']
+            response = self.app.get('/balance-sheets/2016-09-01.json',
+                                    headers={'If-None-Match': etag})
+            self.assertEqual(304, response.status_code)
+
+            self._record_transaction(
+                '2016-09-01',
+                "Record the second investment",
+                [
+                    {'account_code': '101', 'amount': 5000},
+                    {'account_code': '320', 'amount': -5000}
+                ]
+            )
+            response = self.app.get('/balance-sheets/2016-09-01.json',
+                                    headers={'If-None-Match': etag})
+            self.assertEqual(200, response.status_code)
+            self.assertNotEqual(etag, response.headers['ETag'])
+
     def test_get_income_statement(self):
         with webapp.app.app_context():
             self._create_account('101', 'Cash', 'asset')
@@ -562,6 +1253,22 @@ class MonetizeTestCase(unittest.TestCase):
         self.assertEquals('1.00', webapp.monetize(100))
         self.assertEquals('1,234.00', webapp.monetize(123400))
         self.assertEquals('-1,000.00', webapp.monetize(-100000))
+        self.assertEquals('-0.05', webapp.monetize(-5))
+        self.assertEquals('1,234,567.89', webapp.monetize(123456789))
+
+    def test_money_formatter(self):
+        formatter = webapp.MoneyFormatter(decimal_point=',',
+                                          thousands_sep=' ',
+                                          grouping=(3, 2, 0))
+        self.assertEquals('1 23 45 678,90', formatter(1234567890))
+        self.assertEquals('-678,90', formatter(-67890))
+
+        formatter = webapp.MoneyFormatter(grouping=(3, locale.CHAR_MAX))
+        self.assertEquals('1234,567.00', formatter(123456700))
+
+    def test_money_formatter_from_locale(self):
+        formatter = webapp.MoneyFormatter.from_locale('C')
+        self.assertEquals('1234.56', formatter(123456))
 
 
 if __name__ == '__main__':
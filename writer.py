@@ -0,0 +1,155 @@
+'''Serialize writes to a ledger database through a single thread.'''
+import Queue
+import sqlite3
+import threading
+import time
+
+from ledger import Ledger
+
+
+class LedgerWriter(object):
+    '''Run Ledger writes on a dedicated thread and commit them in groups.
+
+    SQLite allows one writer at a time. Instead of having many threads
+    compete for the lock, and fail with "database is locked", they queue
+    their writes here. The writer thread takes everything queued so far, runs
+    every write in its own savepoint so that a failing one doesn't affect the
+    others, and commits the whole group at once.
+
+    A group holds at most max_group_size writes. If max_group_delay is
+    positive the writer waits up to that many seconds after the first write
+    of a group for more to arrive, trading latency for fewer commits.
+
+    The connection returned by connect must be in autocommit mode
+    (isolation_level=None); the writer manages transactions itself.
+    '''
+
+    def __init__(self, connect, max_group_size=100, max_group_delay=0):
+        self.connect = connect
+        self.max_group_size = max_group_size
+        self.max_group_delay = max_group_delay
+        self.commits = 0
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def call(self, method, *args, **kwargs):
+        '''Call a Ledger method on the writer thread and return its result.
+
+        Exceptions raised by the method are re-raised in the calling thread.
+        The call returns after the write has been committed.
+        '''
+        job = _Job(method, args, kwargs)
+        self.start()
+        self._queue.put(job)
+        return job.wait()
+
+    def start(self):
+        '''Start the writer thread unless it's already running.'''
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='ledger-writer')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self):
+        '''Finish queued writes and stop the writer thread.'''
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self):
+        db = self.connect()
+        ledger = Ledger(_GroupConnection(db))
+        try:
+            while True:
+                jobs = self._get_jobs()
+                # None is queued by stop and is always the last job.
+                stopping = jobs[-1] is None
+                if stopping:
+                    jobs.pop()
+                if jobs:
+                    self._run_group(db, ledger, jobs)
+                if stopping:
+                    return
+        finally:
+            ledger.close_archives()
+            db.close()
+
+    def _get_jobs(self):
+        jobs = [self._queue.get()]
+        deadline = time.time() + self.max_group_delay
+        while jobs[-1] is not None and len(jobs) < self.max_group_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    jobs.append(self._queue.get(timeout=timeout))
+                else:
+                    jobs.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        return jobs
+
+    def _run_group(self, db, ledger, jobs):
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            for job in jobs:
+                db.execute('SAVEPOINT job')
+                try:
+                    job.result = getattr(ledger, job.method)(*job.args,
+                                                             **job.kwargs)
+                except Exception as exc:
+                    job.error = exc
+                    db.execute('ROLLBACK TO job')
+                db.execute('RELEASE job')
+            db.execute('COMMIT')
+            self.commits += 1
+        except Exception as exc:
+            try:
+                db.execute('ROLLBACK')
+            except sqlite3.OperationalError:
+                # BEGIN failed so there's no transaction to roll back.
+                pass
+            # Accounts created by the group were rolled back, too.
+            ledger.accounts.clear()
+            for job in jobs:
+                if job.error is None:
+                    job.error = exc
+        finally:
+            for job in jobs:
+                job.done.set()
+
+
+class _Job(object):
+    def __init__(self, method, args, kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class _GroupConnection(object):
+    '''A connection whose commits and rollbacks are left to the writer.'''
+
+    def __init__(self, db):
+        self._db = db
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
@@ -0,0 +1,135 @@
+from datetime import date
+import sqlite3
+import threading
+import time
+import unittest
+
+from ledger import Ledger
+from writer import LedgerWriter
+
+
+def connect():
+    return sqlite3.connect('test.sqlite3', isolation_level=None)
+
+
+class LedgerWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite3.connect('test.sqlite3')
+        self.ledger = Ledger(self.db)
+        self.ledger.reset()
+        self.ledger.create_account('101', 'Cash', 'asset')
+        self.ledger.create_account('301', 'Share Capital', 'equity')
+        self.writer = LedgerWriter(connect)
+
+    def tearDown(self):
+        self.writer.stop()
+        self.db.close()
+
+    def test_call_returns_result(self):
+        transaction_id = self.writer.call(
+            'record_transaction', date(2016, 9, 1), 'Investment',
+            [('101', 10000), ('301', -10000)]
+        )
+
+        self.assertEqual(
+            (date(2016, 9, 1), 'Investment', [('101', 10000), ('301', -10000)]),
+            self.ledger.get_transaction(transaction_id)
+        )
+
+    def test_call_reraises_errors(self):
+        with self.assertRaises(ValueError):
+            self.writer.call('record_transaction', date(2016, 9, 1), 'Invalid',
+                             [('101', 10000), ('301', -5000)])
+
+    def test_concurrent_writes(self):
+        def record(index):
+            self.writer.call(
+                'record_transaction', date(2016, 9, 1),
+                'Investment #{}'.format(index),
+                [('101', 10000), ('301', -10000)]
+            )
+
+        threads = [threading.Thread(target=record, args=(index,))
+                   for index in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(20, self.ledger.count_transactions())
+        self.assertEqual(200000, self.ledger.get_account_balance('101'))
+
+    def test_group_commit(self):
+        self.writer = LedgerWriter(connect, max_group_size=5)
+        self.writer.start()
+        # Hold the write lock so that the jobs below queue up behind it.
+        self.db.execute('BEGIN IMMEDIATE')
+        results = {}
+
+        def record(index):
+            # Every third transaction is unbalanced.
+            items = [('101', 10000), ('301', -10000 + (index % 3 == 0))]
+            try:
+                results[index] = self.writer.call(
+                    'record_transaction', date(2016, 9, 1),
+                    'Payment #{}'.format(index), items
+                )
+            except ValueError as exc:
+                results[index] = exc
+
+        threads = [threading.Thread(target=record, args=(index,))
+                   for index in range(10)]
+        for thread in threads:
+            thread.start()
+        # The writer never marks jobs done so this counts the queued ones.
+        while self.writer._queue.unfinished_tasks < len(threads):
+            time.sleep(0.01)
+        self.db.rollback()
+        for thread in threads:
+            thread.join()
+
+        # The first group holds whatever was queued when the writer took it;
+        # the others are full.
+        self.assertLessEqual(self.writer.commits, 3)
+        self.assertEqual(6, self.ledger.count_transactions())
+        for index, result in results.iteritems():
+            if index % 3 == 0:
+                self.assertIsInstance(result, ValueError)
+            else:
+                self.assertEqual('Payment #{}'.format(index),
+                                 self.ledger.get_transaction(result)[1])
+
+    def test_failing_write_does_not_affect_others(self):
+        self.writer.start()
+        # Hold the write lock so that the jobs below end up in one group.
+        self.db.execute('BEGIN IMMEDIATE')
+        errors = []
+
+        def call(*args):
+            try:
+                self.writer.call('create_account', *args)
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [
+            threading.Thread(target=call, args=('102', 'Bank', 'asset')),
+            threading.Thread(target=call, args=('101', 'Duplicate', 'asset')),
+            threading.Thread(target=call, args=('401', 'Revenue', 'revenue')),
+        ]
+        for thread in threads:
+            thread.start()
+        self.db.rollback()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(errors))
+        self.assertEqual(('102', 'Bank', 'asset'),
+                         self.ledger.get_account('102'))
+        self.assertEqual(('401', 'Revenue', 'revenue'),
+                         self.ledger.get_account('401'))
+        self.assertEqual(('101', 'Cash', 'asset'),
+                         self.ledger.get_account('101'))
+
+
+if __name__ == '__main__':
+    unittest.main()